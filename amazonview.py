@@ -1,6 +1,8 @@
 import itertools
 import webbrowser
 
+import numpy as np
+
 from datetime import datetime, timedelta, timezone
 
 from PyQt5.QtCore import Qt, QDateTime, QPointF, QEvent
@@ -263,31 +265,23 @@ class AmzHistoryChart(QWidget):
         if self.history is None:
             self.history = dbhelpers.ProductHistoryStats(self.dbsession, self.source.id)
 
-        # Start adding points to the chart
-        last_row = None
-        for row in self.dbsession.query(AmzProductHistory).\
-                                  filter(AmzProductHistory.amz_listing_id == self.source.id,
-                                         AmzProductHistory.timestamp > start_date.replace(tzinfo=None),
-                                         AmzProductHistory.timestamp < earliest.replace(tzinfo=None)).\
-                                  order_by(AmzProductHistory.timestamp.desc()):
-
-            # SqlAlchemy returns naive timestamps
-            time = row.timestamp.replace(tzinfo=timezone.utc).timestamp() * 1000
+        # Start adding points to the chart, from the newest to the oldest
+        history = self.history.history
+        start = start_date.replace(tzinfo=timezone.utc).timestamp()
+        end = earliest.timestamp()
+        rows = np.flatnonzero((history['timestamp'] > start) & (history['timestamp'] < end))[::-1]
 
-            self.rankLine.append(time, row.salesrank or 0)
-            self.priceLine.append(time, row.price or 0)
+        for timestamp, salesrank, price, sale in zip(history['timestamp'][rows].tolist(),
+                                                     np.nan_to_num(history['salesrank'][rows]).tolist(),
+                                                     np.nan_to_num(history['price'][rows]).tolist(),
+                                                     history['sale'][rows].tolist()):
+            time = timestamp * 1000
 
-            if last_row:
-                # It's possible for salesrank to be None
-                try:
-                    slope = (last_row.salesrank - row.salesrank) / (last_row.timestamp.timestamp() - row.timestamp.timestamp())
-                    if slope < -0.3:
-                        self.salesPoints.append(last_row.timestamp.replace(tzinfo=timezone.utc).timestamp() * 1000,
-                                                last_row.salesrank)
-                except (TypeError, AttributeError):
-                    pass
+            self.rankLine.append(time, salesrank)
+            self.priceLine.append(time, price)
 
-            last_row = row
+            if sale:
+                self.salesPoints.append(time, salesrank)
 
         # Calculate the average span between points
         spans = 0
@@ -657,6 +651,8 @@ class AmzPricingWidget(ProwlerTableWidget):
 class AmzSourceViewWidget(ProwlerTableWidget):
     """Shows a table of listings belonging to Amazon or and Amazon list."""
 
+    filterable = True
+
     def __init__(self, parent=None):
         super(AmzSourceViewWidget, self).__init__(parent=parent)
 
@@ -669,6 +665,10 @@ class AmzSourceViewWidget(ProwlerTableWidget):
         self.table.setItemDelegateForColumn(self.model.fieldIndex('Sales Rank'), IntegerDelegate(parent=self))
         self.table.setItemDelegateForColumn(self.model.fieldIndex('Quantity'), IntegerDelegate(parent=self))
         self.table.setItemDelegateForColumn(self.model.fieldIndex('Price'), CurrencyDelegate(parent=self))
+        self.table.setItemDelegateForColumn(self.model.fieldIndex('Cost'), CurrencyDelegate(parent=self))
+        self.table.setItemDelegateForColumn(self.model.fieldIndex('Profit'), CurrencyDelegate(parent=self))
+        self.table.setItemDelegateForColumn(self.model.fieldIndex('Sales/30d'), IntegerDelegate(parent=self))
+        self.table.setItemDelegateForColumn(self.model.fieldIndex('Sales/90d'), IntegerDelegate(parent=self))
         self.table.setItemDelegateForColumn(self.model.fieldIndex('Prime'), BooleanDelegate(terms=['No', 'Yes'], parent=self))
 
     def set_source(self, source):
@@ -681,6 +681,8 @@ class AmzSourceViewWidget(ProwlerTableWidget):
         self.table.horizontalHeader().setSectionResizeMode(self.model.fieldIndex('Title'), QHeaderView.Stretch)
 
     def generate_query(self, source):
+        best_cost = AmzBestCost.unit_cost * AmazonListing.quantity
+
         query = self.dbsession.query(AmazonListing.id.label('id'),
                                      AmazonCategory.name.label('Category'),
                                      AmazonListing.salesrank.label('Sales Rank'),
@@ -688,6 +690,10 @@ class AmzSourceViewWidget(ProwlerTableWidget):
                                      AmazonListing.model.label('Model'),
                                      AmazonListing.quantity.label('Quantity'),
                                      AmazonListing.price.label('Price'),
+                                     label('Cost', best_cost),
+                                     label('Profit', AmazonListing.price - best_cost),
+                                     AmzSalesEstimate.sales_30day.label('Sales/30d'),
+                                     AmzSalesEstimate.sales_90day.label('Sales/90d'),
                                      AmazonListing.hasprime.label('Prime'),
                                      AmazonListing.title.label('Title')).\
                                 filter(Vendor.id == AmazonListing.vendor_id). \
@@ -698,6 +704,13 @@ class AmzSourceViewWidget(ProwlerTableWidget):
         if isinstance(source, List):
             query = query.join(ListMembership).filter_by(list_id=source.id)
 
+        # The lowest cost among all linked vendor listings
+        query = query.outerjoin(AmzBestCost, and_(AmzBestCost.amz_listing_id == AmazonListing.id,
+                                                  AmzBestCost.confidence == 0))
+
+        # Estimated sales, from update_sales_estimates()
+        query = query.outerjoin(AmzSalesEstimate, AmzSalesEstimate.amz_listing_id == AmazonListing.id)
+
         return query
 
 
@@ -717,6 +730,7 @@ class AmazonView(BaseSourceView):
 
         # Custom toolbar buttons
         self.action_search_amazon.triggered.connect(self.on_search_amazon)
+        self.action_estimate_sales.triggered.connect(self.on_estimate_sales)
 
         # Create context actions for the child widgets
         self.action_open_camel3 = QAction(QIcon('icons/camel.png'), 'Open in CamelCamelCamel...', self)
@@ -767,6 +781,9 @@ class AmazonView(BaseSourceView):
         self.action_search_amazon = QAction(QIcon('icons/searchamazon.gif'), 'Search Amazon...', self)
         self.add_toolbar_action(self.action_search_amazon)
 
+        self.action_estimate_sales = QAction(QIcon('icons/reload.png'), 'Estimate sales', self)
+        self.add_toolbar_action(self.action_estimate_sales)
+
         # Create the source view table (the main table)
         self.source_view = AmzSourceViewWidget(self)
         self.layout().addWidget(self.source_view)
@@ -873,6 +890,14 @@ class AmazonView(BaseSourceView):
         if self.selected_source and op.params['addtolist'] == self.selected_source.name:
             self.reload()
 
+    def on_estimate_sales(self):
+        """Estimate the recent sales of every Amazon listing from its product history."""
+        count = dbhelpers.update_sales_estimates(self.dbsession)
+        self.dbsession.commit()
+
+        self.reload()
+        QMessageBox.information(self, 'Estimate sales', 'Sales estimated for %s listings.' % count)
+
     def on_open_camel3(self):
         """Open the selected listing in CamelCamelCamel."""
         sku = self.dbsession.query(Listing.sku).filter_by(id=self.get_selected_id()).scalar()
@@ -3,7 +3,7 @@ import numpy as np
 import pandas as pd
 import itertools
 
-from responseparser import read_quantity
+from responseparser import read_quantity, read_quantities
 
 
 # Remove anything that isn't a character, number, or space from the string
@@ -19,6 +19,16 @@ def translate_quantity(row):
 
     return read_quantity(string)
 
+
+def translate_quantities(quantities):
+    """Translate a whole column of quantities at once. Works like translate_quantity(), given a pandas Series."""
+    strings = quantities.astype(str).str.lower().str.strip()
+
+    # Remove anything in brackets
+    strings = strings.str.replace(r'\[.*\]', '', regex=True)
+
+    return read_quantities(strings)
+
     #
     # # Match '3DZ', '10PK', etc
     # match = re.match(r'(\d+)(dz|pk)', string, re.IGNORECASE)
@@ -45,9 +55,8 @@ def translate_quantity(row):
 if __name__ == '__main__':
     df = pd.read_csv('tigerchef.csv')
 
-    for i, row in df.iterrows():
-        # Translate the quantity
-        df.loc[i, 'quantity'] = translate_quantity(row)
+    # Translate the quantities
+    df['quantity'] = translate_quantities(df['quantity'])
 
     df.to_csv('tigerchef_mod.csv')
 
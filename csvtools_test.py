@@ -1,6 +1,8 @@
 import unittest
 
-from responseparser import read_quantity
+import pandas as pd
+
+from responseparser import read_quantity, read_quantities
 
 
 class ReadQuantityTest(unittest.TestCase):
@@ -115,5 +117,23 @@ class ReadQuantityTest(unittest.TestCase):
             with self.subTest(string=pair[0]):
                 self.assertEqual(read_quantity(pair[0]), pair[1])
 
+    def test_no_eval(self):
+        self.assertIsNone(read_quantity('case of 1/0'))
+        self.assertIsNone(read_quantity('__import__("os") pack'))
+
+    def test_whitespace(self):
+        self.assertEqual(read_quantity('  Pack   of\t12 '), 12)
+
+    def test_list(self):
+        strings = [pair[0] for pair in self.group_1] + [None]
+        expected = [pair[1] for pair in self.group_1] + [None]
+        self.assertEqual(read_quantities(strings), expected)
+
+    def test_series(self):
+        series = pd.Series(['12pk', '2 pair', 'nothing', '12pk'])
+        self.assertEqual(read_quantities(series).tolist()[:2], [12, 4])
+        self.assertEqual(read_quantities(series, pairs_singular=True)[1], 2)
+        self.assertTrue(pd.isnull(read_quantities(series)[2]))
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,28 +1,30 @@
 import re
 import json
 
-from fuzzywuzzy import fuzz
+from rapidfuzz import fuzz, utils
 
 from sqlalchemy.engine import Engine
 from sqlalchemy import create_engine, event
-from sqlalchemy import Table, Column, Integer, Float, String, DateTime, Boolean
-from sqlalchemy import ForeignKey, ForeignKeyConstraint, UniqueConstraint
+from sqlalchemy import Table, Column, Integer, Float, String, DateTime, Boolean, LargeBinary
+from sqlalchemy import ForeignKey, ForeignKeyConstraint, UniqueConstraint, Index
 from sqlalchemy import and_, or_
 
-from sqlalchemy.sql import label
+from sqlalchemy.sql import label, select, table, column, literal_column
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.hybrid import hybrid_method, hybrid_property
 from sqlalchemy.ext.orderinglist import ordering_list
 from sqlalchemy.orm import sessionmaker, scoped_session, relationship, backref
 from sqlalchemy.orm.exc import ObjectDeletedError, NoResultFound
+from sqlalchemy.exc import OperationalError
 
 from sqlalchemy.sql.functions import func
 
-from PyQt5.QtSql import QSqlQuery
-
 
 # Helper function to convert SQLAlchemy queries into QSqlQuery objects
 def saquery_to_qtquery(sa_query):
+    # Imported here, so the database classes can be used without Qt
+    from PyQt5.QtSql import QSqlQuery
+
     statement = sa_query.statement.compile()
     qtquery = QSqlQuery()
     qtquery.prepare(str(statement))
@@ -65,7 +67,7 @@ def brand_match(listing1, listing2):
     fits.append(fuzz.partial_ratio(brand1, brand2))
     fits.append(fuzz.partial_ratio(brand1, title2))
     fits.append(fuzz.partial_ratio(brand2, title1))
-    return max(fits)
+    return round(max(fits))
 
 
 def model_match(listing1, listing2):
@@ -78,17 +80,17 @@ def model_match(listing1, listing2):
     if model1.isdigit() and model2.isdigit():
         fits.append(100 * (model1 in model2 or model2 in model1))
     else:
-        fits.append(fuzz.token_set_ratio(model1, model2))
+        fits.append(fuzz.token_set_ratio(model1, model2, processor=utils.default_process))
 
-    fits.append(fuzz.token_set_ratio(model1, title2))
-    fits.append(fuzz.token_set_ratio(model2, title1))
-    return max(fits)
+    fits.append(fuzz.token_set_ratio(model1, title2, processor=utils.default_process))
+    fits.append(fuzz.token_set_ratio(model2, title1, processor=utils.default_process))
+    return round(max(fits))
 
 
 def title_match(listing1, listing2):
     title1 = str(listing1.title or '').lower()
     title2 = str(listing2.title or '').lower()
-    return fuzz.token_set_ratio(title1, title2)
+    return round(fuzz.token_set_ratio(title1, title2, processor=utils.default_process))
 
 # Database classes
 Base = declarative_base()
@@ -213,10 +215,27 @@ class AmzProductHistory(Base):
     offers = Column(Integer)
     timestamp = Column(DateTime)
 
+    __table_args__ = (Index('ix_amz_history_listing_timestamp', 'amz_listing_id', 'timestamp'), {})
+
     def __repr__(self):
         return "<%s(id=%s)>" % (__class__, self.id)
 
 
+class AmzHistoryBlock(Base):
+    """One UTC day of an Amazon listing's product history, packed into a compressed BLOB by historystore. Older
+    history is moved here from amz_history by historystore.compact().
+    """
+    __tablename__ = 'amz_history_blocks'
+
+    amz_listing_id = Column(Integer, ForeignKey(AmazonListing.id, ondelete='CASCADE'), primary_key=True)
+    day = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False)
+    data = Column(LargeBinary, nullable=False)
+
+    def __repr__(self):
+        return "<%s(amz_listing_id=%s, day=%s, count=%s)>" % (__class__, self.amz_listing_id, self.day, self.count)
+
+
 class AmzPriceAndFees(Base):
     __tablename__ = 'amzpriceandfees'
 
@@ -267,6 +286,7 @@ class ListMembership(Base):
 
 class LinkedProducts(Base):
     __tablename__ = 'linkedproducts'
+    __table_args__ = (Index('ix_linkedproducts_vnd_listing_id', 'vnd_listing_id'), {})
 
     amz_listing_id = Column(Integer, ForeignKey(Listing.id, ondelete='CASCADE'), primary_key=True)
     vnd_listing_id = Column(Integer, ForeignKey(Listing.id, ondelete='CASCADE'), primary_key=True)
@@ -296,6 +316,7 @@ class LinkedProducts(Base):
 class Operation(Base):
     """A sequence of instructions to be processed by the OperationManager class."""
     __tablename__ = 'operations'
+    __table_args__ = (Index('ix_operations_queue', 'operation', 'complete', 'error', 'priority', 'scheduled'), {})
 
     id = Column(Integer, primary_key=True)
     priority = Column(Integer, nullable=False, default=0)
@@ -308,6 +329,10 @@ class Operation(Base):
     error = Column(Boolean, default=False)
     message = Column(String)
 
+    # Set while a worker is processing the operation. Claims that outlive their lease can be taken by another worker.
+    claimed_by = Column(String)
+    lease_expires = Column(DateTime)
+
     listing_id = Column(String, ForeignKey(Listing.id, ondelete='CASCADE'))
     listing = relationship(Listing)
 
@@ -363,6 +388,295 @@ class Operation(Base):
                                           **kwargs)
 
 
+class OperationArchive(Base):
+    """A completed or failed Operation, moved out of the operations table to keep the queue small."""
+    __tablename__ = 'operations_archive'
+    __table_args__ = (Index('ix_operations_archive_status', 'operation', 'complete', 'error'), {})
+
+    id = Column(Integer, primary_key=True)
+    operation_id = Column(Integer)
+    priority = Column(Integer)
+
+    operation = Column(String)
+    param_string = Column(String)
+
+    scheduled = Column(DateTime)
+    complete = Column(Boolean)
+    error = Column(Boolean)
+    message = Column(String)
+
+    listing_id = Column(String)
+    archived = Column(DateTime, default=func.now())
+
+    def __repr__(self):
+        return "<%s(operation='%s', listing_id=%s, error=%s, message='%s')>" % \
+               (__class__, self.operation, self.listing_id, self.error, self.message)
+
+    @property
+    def params(self):
+        if self.param_string:
+            return json.loads(self.param_string)
+        else:
+            return {}
+
+
+class OperationCount(Base):
+    """The number of pending, completed and failed operations of each type, including archived ones. Kept up to
+    date by triggers on the operations and operations_archive tables.
+    """
+    __tablename__ = 'operation_counts'
+
+    operation = Column(String, primary_key=True)
+    pending = Column(Integer, nullable=False, default=0)
+    complete = Column(Integer, nullable=False, default=0)
+    error = Column(Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return "<%s(operation='%s', pending=%s, complete=%s, error=%s)>" % \
+               (__class__, self.operation, self.pending, self.complete, self.error)
+
+
+def _count_trigger(name, table, when, row, sign):
+    """Return the DDL for a trigger that adds (sign=+1) or removes (sign=-1) row's status from operation_counts."""
+    return """
+        CREATE TRIGGER IF NOT EXISTS {name} AFTER {when} ON {table}
+        BEGIN
+            INSERT OR IGNORE INTO operation_counts (operation, pending, complete, error)
+                VALUES ({row}.operation, 0, 0, 0);
+            UPDATE operation_counts
+                SET pending = pending {sign} (coalesce({row}.complete, 0) = 0 AND coalesce({row}.error, 0) = 0),
+                    complete = complete {sign} coalesce({row}.complete, 0),
+                    error = error {sign} coalesce({row}.error, 0)
+                WHERE operation = {row}.operation;
+        END""".format(name=name, table=table, when=when, row=row, sign='+' if sign > 0 else '-')
+
+
+class AmzBestCost(Base):
+    """The lowest unit cost, including vendor tax and shipping, among the vendor listings linked to an Amazon listing
+    with at least a given confidence. There is a row for each confidence level in buckets. Kept up to date by
+    triggers on the linkedproducts, listings and vendors tables.
+    """
+    __tablename__ = 'amz_best_cost'
+
+    buckets = (0, 50, 60, 70, 80, 85, 90, 95, 100)
+
+    amz_listing_id = Column(Integer, ForeignKey(Listing.id, ondelete='CASCADE'), primary_key=True)
+    confidence = Column(Integer, primary_key=True)
+    unit_cost = Column(Float, nullable=False)
+    vnd_listing_id = Column(Integer, ForeignKey(Listing.id, ondelete='CASCADE'))
+
+    def __repr__(self):
+        return "<%s(amz_listing_id=%s, confidence=%s, unit_cost=%s)>" % \
+               (__class__, self.amz_listing_id, self.confidence, self.unit_cost)
+
+
+def _best_cost_insert(amz_ids):
+    """Return the SQL to calculate the rows of amz_best_cost for the Amazon listings in amz_ids, an SQL expression
+    like '= NEW.amz_listing_id' or 'IN (SELECT ...)'.
+    """
+    buckets = ' UNION ALL '.join('SELECT %d AS confidence' % bucket for bucket in AmzBestCost.buckets)
+    unit_cost = 'min(listings.price / listings.quantity * (1 + vendors.tax_rate + vendors.ship_rate))'
+
+    return """
+        INSERT INTO amz_best_cost (amz_listing_id, confidence, unit_cost, vnd_listing_id)
+            SELECT linkedproducts.amz_listing_id, buckets.confidence, {unit_cost}, listings.id
+            FROM linkedproducts
+            JOIN listings ON listings.id = linkedproducts.vnd_listing_id
+            JOIN vendors ON vendors.id = listings.vendor_id
+            JOIN ({buckets}) AS buckets ON linkedproducts.confidence >= buckets.confidence
+            WHERE linkedproducts.amz_listing_id {amz_ids}
+            GROUP BY linkedproducts.amz_listing_id, buckets.confidence
+            HAVING {unit_cost} IS NOT NULL""".format(amz_ids=amz_ids, buckets=buckets, unit_cost=unit_cost)
+
+
+def _best_cost_refresh(amz_ids):
+    """Return the SQL to recalculate the rows of amz_best_cost for the Amazon listings in amz_ids."""
+    return 'DELETE FROM amz_best_cost WHERE amz_listing_id {amz_ids};{insert};'.format(amz_ids=amz_ids,
+                                                                                      insert=_best_cost_insert(amz_ids))
+
+
+def _best_cost_trigger(name, table, when, refresh):
+    """Return the DDL for a trigger that runs refresh, a string of SQL statements."""
+    return """
+        CREATE TRIGGER IF NOT EXISTS {name} AFTER {when} ON {table}
+        BEGIN
+            {refresh}
+        END""".format(name=name, table=table, when=when, refresh=refresh)
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def create_best_cost_triggers(target, connection, tables=(), **kwargs):
+    """When amz_best_cost is created, fill it in and create the triggers that keep it up to date."""
+    if connection.dialect.name != 'sqlite' or AmzBestCost.__table__ not in tables:
+        return
+
+    # Databases created before the index was added need it too
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_linkedproducts_vnd_listing_id '
+                       'ON linkedproducts (vnd_listing_id)')
+
+    connection.execute(_best_cost_trigger('linkedproducts_insert_best_cost', 'linkedproducts', 'INSERT',
+                                          _best_cost_refresh('= NEW.amz_listing_id')))
+    connection.execute(_best_cost_trigger('linkedproducts_delete_best_cost', 'linkedproducts', 'DELETE',
+                                          _best_cost_refresh('= OLD.amz_listing_id')))
+    connection.execute(_best_cost_trigger('linkedproducts_update_best_cost', 'linkedproducts',
+                                          'UPDATE OF amz_listing_id, vnd_listing_id, confidence',
+                                          _best_cost_refresh('IN (OLD.amz_listing_id, NEW.amz_listing_id)')))
+
+    # Changes to a vendor listing's price, or to a vendor's rates, affect every Amazon listing linked to them
+    connection.execute(_best_cost_trigger('listings_update_best_cost', 'listings',
+                                          'UPDATE OF price, quantity, vendor_id',
+                                          _best_cost_refresh('IN (SELECT amz_listing_id FROM linkedproducts '
+                                                             'WHERE vnd_listing_id = NEW.id)')))
+    connection.execute(_best_cost_trigger('vendors_update_best_cost', 'vendors', 'UPDATE OF tax_rate, ship_rate',
+                                          _best_cost_refresh('IN (SELECT linkedproducts.amz_listing_id '
+                                                             'FROM linkedproducts '
+                                                             'JOIN listings ON listings.id = '
+                                                             'linkedproducts.vnd_listing_id '
+                                                             'WHERE listings.vendor_id = NEW.id)')))
+
+    connection.execute(_best_cost_insert('IN (SELECT amz_listing_id FROM linkedproducts)'))
+
+
+class AmzSalesEstimate(Base):
+    """The estimated number of sales of an Amazon listing in the last 30 and 90 days, based on its product history.
+    Calculated in bulk by dbhelpers.update_sales_estimates().
+    """
+    __tablename__ = 'amz_sales_estimates'
+
+    amz_listing_id = Column(Integer, ForeignKey(Listing.id, ondelete='CASCADE'), primary_key=True)
+    sales_30day = Column(Integer, nullable=False, default=0)
+    sales_90day = Column(Integer, nullable=False, default=0)
+    updated = Column(DateTime)
+
+    def __repr__(self):
+        return "<%s(amz_listing_id=%s, sales_30day=%s, sales_90day=%s)>" % \
+               (__class__, self.amz_listing_id, self.sales_30day, self.sales_90day)
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def create_history_index(target, connection, tables=(), **kwargs):
+    """Databases created before the history index was added need it too."""
+    if connection.dialect.name != 'sqlite' or AmzSalesEstimate.__table__ not in tables:
+        return
+
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_amz_history_listing_timestamp '
+                       'ON amz_history (amz_listing_id, timestamp)')
+
+
+# Full-text index of the listings, kept up to date by triggers
+_listings_fts_ddl = ["""
+    CREATE VIRTUAL TABLE listings_fts USING fts5(
+        title, brand, model, sku, upc,
+        content='listings', content_rowid='id', prefix='2 3'
+    )""", """
+    CREATE TRIGGER listings_fts_insert AFTER INSERT ON listings
+    BEGIN
+        INSERT INTO listings_fts (rowid, title, brand, model, sku, upc)
+            VALUES (NEW.id, NEW.title, NEW.brand, NEW.model, NEW.sku, NEW.upc);
+    END""", """
+    CREATE TRIGGER listings_fts_delete AFTER DELETE ON listings
+    BEGIN
+        INSERT INTO listings_fts (listings_fts, rowid, title, brand, model, sku, upc)
+            VALUES ('delete', OLD.id, OLD.title, OLD.brand, OLD.model, OLD.sku, OLD.upc);
+    END""", """
+    CREATE TRIGGER listings_fts_update AFTER UPDATE OF title, brand, model, sku, upc ON listings
+    BEGIN
+        INSERT INTO listings_fts (listings_fts, rowid, title, brand, model, sku, upc)
+            VALUES ('delete', OLD.id, OLD.title, OLD.brand, OLD.model, OLD.sku, OLD.upc);
+        INSERT INTO listings_fts (rowid, title, brand, model, sku, upc)
+            VALUES (NEW.id, NEW.title, NEW.brand, NEW.model, NEW.sku, NEW.upc);
+    END""", """
+    INSERT INTO listings_fts (listings_fts) VALUES ('rebuild')"""]
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def create_listings_fts(target, connection, **kwargs):
+    """Create and fill the full-text index of the listings, if it doesn't exist yet. Skipped if SQLite wasn't built
+    with FTS5.
+    """
+    if connection.dialect.name != 'sqlite' or has_fulltext(connection):
+        return
+
+    try:
+        with connection.begin():
+            for statement in _listings_fts_ddl:
+                connection.execute(statement)
+    except OperationalError:
+        pass
+
+
+def has_fulltext(connection):
+    """Return True if the database has the listings_fts full-text index."""
+    return connection.execute("SELECT count(*) FROM sqlite_master WHERE name = 'listings_fts'").scalar() > 0
+
+
+def fulltext_matches(keywords):
+    """Return a subquery of the (id, rank) of listings whose title, brand, model, SKU or UPC contain words starting
+    with any of the keywords. Lower ranks are better matches.
+    """
+    terms = ' OR '.join('"%s"*' % word.replace('"', '""') for word in keywords)
+    listings_fts = table('listings_fts', column('rowid'), column('rank'))
+
+    return select([listings_fts.c.rowid.label('id'), listings_fts.c.rank.label('rank')]).\
+           where(literal_column('listings_fts').match(terms)).\
+           alias('fts_matches')
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def add_operation_lease_columns(target, connection, **kwargs):
+    """create_all() doesn't add columns to existing tables, so databases created before operations could be claimed
+    need the lease columns added by hand.
+    """
+    if connection.dialect.name != 'sqlite':
+        return
+
+    columns = {row[1] for row in connection.execute('PRAGMA table_info(operations)')}
+
+    for name, type_ in (('claimed_by', 'VARCHAR'), ('lease_expires', 'DATETIME')):
+        if name not in columns:
+            connection.execute('ALTER TABLE operations ADD COLUMN %s %s' % (name, type_))
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def create_queue_index(target, connection, **kwargs):
+    """create_all() only creates indexes along with their tables, so databases created before the queue index was
+    added need it too.
+    """
+    if connection.dialect.name != 'sqlite':
+        return
+
+    connection.execute('CREATE INDEX IF NOT EXISTS ix_operations_queue '
+                       'ON operations (operation, complete, error, priority, scheduled)')
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def create_count_triggers(target, connection, tables=(), **kwargs):
+    """When operation_counts is created, fill it in and create the triggers that keep it up to date."""
+    if connection.dialect.name != 'sqlite' or OperationCount.__table__ not in tables:
+        return
+
+    for table in ('operations', 'operations_archive'):
+        connection.execute(_count_trigger(table + '_insert_counts', table, 'INSERT', 'NEW', +1))
+        connection.execute(_count_trigger(table + '_delete_counts', table, 'DELETE', 'OLD', -1))
+
+    # Archived operations don't change, so only the operations table needs update triggers
+    status_change = 'UPDATE OF operation, complete, error'
+    connection.execute(_count_trigger('operations_update_old_counts', 'operations', status_change, 'OLD', -1))
+    connection.execute(_count_trigger('operations_update_new_counts', 'operations', status_change, 'NEW', +1))
+
+    connection.execute("""
+        INSERT INTO operation_counts (operation, pending, complete, error)
+        SELECT operation, sum(pending), sum(complete), sum(error) FROM (
+            SELECT operation, (coalesce(complete, 0) = 0 AND coalesce(error, 0) = 0) AS pending,
+                   coalesce(complete, 0) AS complete, coalesce(error, 0) AS error
+            FROM operations
+            UNION ALL
+            SELECT operation, 0, coalesce(complete, 0), coalesce(error, 0)
+            FROM operations_archive
+        )
+        GROUP BY operation""")
+
+
 
 
 
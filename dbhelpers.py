@@ -1,5 +1,15 @@
+import collections
+import string
 import datetime
+import itertools
+import time
+
+import numpy as np
+
 from database import *
+import historystore
+
+from sqlalchemy.sql import bindparam, text
 
 
 def get_or_create(session, dtype, **kwargs):
@@ -15,14 +25,158 @@ def get_or_create(session, dtype, **kwargs):
 def add_ids_to_list(session, listing_ids, list_name):
     """Add all listings specified in ids to list named list_name. Will create a new list if necessary. """
     add_list = get_or_create(session, List, name=list_name)
+    session.flush()
 
-    for listing_id in listing_ids:
-        get_or_create(session, ListMembership, list=add_list, listing_id=listing_id)
+    session.execute(ListMembership.__table__.insert().prefix_with('OR IGNORE'),
+                    [{'list_id': add_list.id, 'listing_id': listing_id} for listing_id in set(listing_ids)])
 
     first = session.query(Listing).filter_by(id=listing_ids[0]).first()
     add_list.is_amazon = isinstance(first, AmazonListing)
 
 
+# Folds case the same way as SQLite's NOCASE collation, which only knows about ASCII
+_nocase = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+_vendor_listing_fields = ['title', 'brand', 'model', 'upc', 'quantity', 'price', 'url']
+
+
+def _chunks(iterable, size):
+    """Split an iterable into lists of up to size items."""
+    iterator = iter(iterable)
+    chunk = list(itertools.islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(itertools.islice(iterator, size))
+
+
+def _update_listings_stmt():
+    """Return an UPDATE of the vendor listing fields, for use with executemany. Takes the id as 'listing_id'."""
+    listings = Listing.__table__
+    return listings.update().\
+                    where(listings.c.id == bindparam('listing_id')).\
+                    values({field: bindparam(field) for field in _vendor_listing_fields + ['updated']})
+
+
+def import_vendor_listings(session, vendor_id, rows, list_id=None, chunk_size=1000, journal=None):
+    """Insert or update VendorListings from an iterable of dictionaries, with 'sku', 'title', 'brand', 'model', 'upc',
+    'quantity', 'price' and 'url' keys. Listings are added to the given list, if any. Rows are written in chunks, and
+    the session is committed after each one. This is a generator: after each chunk it yields the number of rows
+    processed so far.
+
+    If journal is a dictionary, enough is recorded in it for revert_vendor_import() to undo the import.
+    """
+    listings = Listing.__table__
+
+    # Map the SKUs already in the database to their listing ids
+    existing = {sku.translate(_nocase): listing_id
+                for listing_id, sku in session.query(Listing.id, Listing.sku).filter_by(vendor_id=vendor_id)}
+
+    update_stmt = _update_listings_stmt()
+    membership_stmt = ListMembership.__table__.insert().prefix_with('OR IGNORE')
+
+    if journal is not None:
+        journal.setdefault('inserted', [])
+        journal.setdefault('updated', [])
+        journal.setdefault('memberships', [])
+        journaled = set()
+        members = {listing_id for listing_id, in session.query(ListMembership.listing_id).filter_by(list_id=list_id)} \
+            if list_id is not None else set()
+
+    processed = 0
+    for chunk in _chunks(rows, chunk_size):
+        updated = datetime.datetime.utcnow()
+        updates = {}
+        inserts = {}
+
+        # If a SKU appears more than once, the last row wins
+        for row in chunk:
+            sku = row.get('sku')
+            if not sku:
+                continue
+
+            values = {field: row.get(field) for field in _vendor_listing_fields}
+            values['updated'] = updated
+
+            key = sku.translate(_nocase)
+            if key in existing:
+                updates[key] = dict(values, listing_id=existing[key])
+            else:
+                inserts[key] = dict(values, vendor_id=vendor_id, sku=sku, type='vendor_listing')
+
+        if updates:
+            # Save the current values of listings that haven't been changed yet
+            if journal is not None:
+                ids = [values['listing_id'] for values in updates.values() if values['listing_id'] not in journaled]
+                for batch in _chunks(ids, 500):
+                    for old in session.query(Listing.id.label('listing_id'),
+                                             *[getattr(Listing, field) for field in _vendor_listing_fields],
+                                             Listing.updated).\
+                                       filter(Listing.id.in_(batch)):
+                        journal['updated'].append(old._asdict())
+                journaled.update(ids)
+
+            session.execute(update_stmt, list(updates.values()))
+
+        if inserts:
+            session.execute(listings.insert(), list(inserts.values()))
+
+            # Get the new ids, and add the rows for the vendor_listings table
+            new_ids = []
+            for skus in _chunks(inserts, 500):
+                for listing_id, sku in session.query(Listing.id, Listing.sku).\
+                                               filter(Listing.vendor_id == vendor_id,
+                                                      Listing.sku.in_(skus)):
+                    existing[sku.translate(_nocase)] = listing_id
+                    new_ids.append({'id': listing_id})
+
+            session.execute(VendorListing.__table__.insert(), new_ids)
+
+            if journal is not None:
+                # Reverting deletes these outright, so later chunks don't need to journal changes to them
+                inserted = [new['id'] for new in new_ids]
+                journal['inserted'].extend(inserted)
+                journaled.update(inserted)
+                members.update(inserted)
+
+        if list_id is not None and (updates or inserts):
+            # Only memberships of listings that were already in the database need undoing
+            if journal is not None:
+                for key in updates:
+                    if existing[key] not in members:
+                        members.add(existing[key])
+                        journal['memberships'].append({'list_id': list_id, 'listing_id': existing[key]})
+
+            session.execute(membership_stmt, [{'list_id': list_id, 'listing_id': existing[key]}
+                                              for key in itertools.chain(updates, inserts)])
+
+        session.commit()
+
+        processed += len(chunk)
+        yield processed
+
+
+def revert_vendor_import(session, journal):
+    """Undo an import made by import_vendor_listings(), using the journal it recorded, and commit."""
+    listings = Listing.__table__
+    memberships = ListMembership.__table__
+
+    # Deleting the new listings also deletes their vendor_listings rows and list memberships
+    for ids in _chunks(journal.get('inserted', []), 500):
+        session.execute(listings.delete().where(listings.c.id.in_(ids)))
+
+    if journal.get('updated'):
+        session.execute(_update_listings_stmt(), journal['updated'])
+
+    if journal.get('memberships'):
+        delete_stmt = memberships.delete().\
+                                  where(and_(memberships.c.list_id == bindparam('b_list_id'),
+                                             memberships.c.listing_id == bindparam('b_listing_id')))
+        session.execute(delete_stmt, [{'b_list_id': m['list_id'], 'b_listing_id': m['listing_id']}
+                                      for m in journal['memberships']])
+
+    session.commit()
+
+
 def remove_ids_from_list(session, listing_ids, list_name):
     """Remove all specified listings from the given list."""
     rm_list = session.query(List).filter_by(name=list_name).first()
@@ -86,6 +240,27 @@ def set_watch(session, listing_id, time):
         session.add(watch)
 
 
+def archive_operations(session, retention):
+    """Move completed and failed operations scheduled more than retention (a timedelta) ago into the
+    operations_archive table. Returns the number of operations archived.
+    """
+    cutoff = datetime.datetime.utcnow() - retention
+    finished = and_(or_(Operation.complete == True, Operation.error == True),
+                    Operation.scheduled < cutoff)
+
+    columns = ['operation_id', 'priority', 'operation', 'param_string', 'scheduled', 'complete', 'error', 'message',
+               'listing_id', 'archived']
+    rows = session.query(Operation.id, Operation.priority, Operation.operation, Operation.param_string,
+                         Operation.scheduled, Operation.complete, Operation.error, Operation.message,
+                         Operation.listing_id, func.now()).\
+                   filter(finished)
+
+    session.execute(OperationArchive.__table__.insert().from_select(columns, rows.statement))
+    archived = session.execute(Operation.__table__.delete().where(finished)).rowcount
+
+    return archived
+
+
 def get_or_create_category(session, productcategory_id, product_group):
     """Get or create an Amazon product category, given a ProductCategoryId or ProductGroup value. If both values are
     None, returns the 'Unknown' category.
@@ -101,81 +276,251 @@ def get_or_create_category(session, productcategory_id, product_group):
     return category or get_or_create(session, AmazonCategory, name='Unknown')
 
 
-class ProductHistoryStats:
-    """A helper class for working with Amazon product history data."""
+SalePoint = collections.namedtuple('SalePoint', ['timestamp', 'salesrank'])
+DataPoint = collections.namedtuple('DataPoint', ['timestamp', 'salesrank', 'hasprime', 'merchant_id', 'offers'])
 
-    _sale_slope = -0.3
+# An observation shows a sale if the sales rank fell faster than this, in ranks per second, since the listing's
+# previous observation. Both ProductHistoryStats and update_sales_estimates() use it.
+sale_slope = -0.3
 
-    def __init__(self, session, amz_listing_id):
-        """Initialize the object."""
 
+class ProductHistoryStats:
+    """A helper class for working with Amazon product history data. The history of one or more listings is loaded
+    once, into NumPy arrays sorted by listing and time, and statistics for every listing are calculated from those.
+    Methods that return an array give one value for each id in listing_ids, in order.
+    """
+
+    def __init__(self, session, amz_listing_ids):
+        """Initialize the object. amz_listing_ids can be a single id, or a list of them. History isn't loaded until
+        it is needed.
+        """
         self._session = session
-        self._listing_id = amz_listing_id
+
+        if isinstance(amz_listing_ids, (int, np.integer)):
+            self._listing_id = amz_listing_ids
+            amz_listing_ids = [amz_listing_ids]
+        else:
+            self._listing_id = None
+
+        self.listing_ids = np.unique(np.array(list(amz_listing_ids), dtype=np.int64))
+        self._history = None
+        self._sale_ids = None
+
+    def _load(self):
+        """Load the history of every listing, from both the compact store and amz_history."""
+        history = historystore.read(self._session, self.listing_ids.tolist())
+        history['group'] = np.searchsorted(self.listing_ids, history.pop('amz_listing_id'))
+
+        # A sale shows up as a steep drop in sales rank since the previous observation of the same listing
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slopes = np.diff(history['salesrank']) / np.diff(history['timestamp'])
+
+        same_listing = np.diff(history['group']) == 0
+        history['sale'] = np.concatenate([[False], same_listing & (slopes < sale_slope)])
+
+        return history
+
+    @property
+    def history(self):
+        """A dictionary of NumPy arrays: the group (index into listing_ids), id (-1 if compacted), timestamp (in
+        seconds since the epoch), salesrank, price, offers, hasprime and merchant_id of each observation, and whether
+        it shows a sale. NULLs are NaN.
+        """
+        if self._history is None:
+            self._history = self._load()
+
+        return self._history
+
+    def _window(self, days=None):
+        """Return a mask of the observations from the last number of days, or all of them if days is None."""
+        timestamps = self.history['timestamp']
+        if days is None:
+            return np.ones(len(timestamps), dtype=bool)
+
+        return timestamps >= time.time() - days * 86400
+
+    def _per_listing(self, values, mask):
+        """Return the sum and count of values[mask] for each listing, ignoring NaNs."""
+        mask = mask & ~np.isnan(values)
+        group = self.history['group'][mask]
+
+        sums = np.bincount(group, weights=values[mask], minlength=len(self.listing_ids))
+        counts = np.bincount(group, minlength=len(self.listing_ids))
+        return sums, counts
+
+    def average(self, column='salesrank', days=None):
+        """Return the average of column ('salesrank', 'price' or 'offers') over the last number of days, or over all
+        history if days is None. NaN if there are no observations.
+        """
+        sums, counts = self._per_listing(self.history[column], self._window(days))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return sums / counts
+
+    def sales_counts(self, days=None):
+        """Return the number of sales seen over the last number of days, or over all history."""
+        mask = self.history['sale'] & self._window(days)
+        return np.bincount(self.history['group'][mask], minlength=len(self.listing_ids))
+
+    def sales_velocity(self, days=30):
+        """Return the estimated number of sales per day, over the last number of days. Listings with less history
+        than that are measured over the history they have. NaN if there is none.
+        """
+        window = self._window(days)
+        timestamps = self.history['timestamp']
+        group = self.history['group'][window]
+
+        first = np.full(len(self.listing_ids), np.inf)
+        np.minimum.at(first, group, timestamps[window])
+
+        span = (time.time() - first) / 86400
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(np.isfinite(first), self.sales_counts(days) / span, np.nan)
+
+    def volatility(self, column='salesrank', days=None):
+        """Return the standard deviation of the relative change in column between consecutive observations, over the
+        last number of days or all history. NaN if there are fewer than two observations.
+        """
+        values = self.history[column]
+        window = self._window(days)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            changes = np.concatenate([[np.nan], np.diff(values) / values[:-1]])
+
+        # Only compare observations of the same listing, both inside the window
+        changes[1:][np.diff(self.history['group']) != 0] = np.nan
+        changes[1:][~window[:-1]] = np.nan
+        changes[~np.isfinite(changes)] = np.nan
+
+        sums, counts = self._per_listing(changes, window)
+        squares, _ = self._per_listing(changes ** 2, window)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = sums / counts
+            return np.sqrt(np.maximum(squares / counts - mean ** 2, 0))
+
+    def ranked_by_velocity(self, days=30):
+        """Return the listing ids, ordered from the fastest estimated seller to the slowest."""
+        velocity = np.nan_to_num(self.sales_velocity(days), nan=-1)
+        return self.listing_ids[np.argsort(-velocity, kind='stable')]
+
+    def _group(self, amz_listing_id=None):
+        """Return the index in listing_ids of the given listing, or of the one given to __init__(). Raises ValueError
+        if that listing's history wasn't loaded.
+        """
+        if amz_listing_id is None:
+            amz_listing_id = self._listing_id
+        if amz_listing_id is None:
+            raise ValueError('No listing given, and more than one was loaded.')
+
+        group = int(np.searchsorted(self.listing_ids, amz_listing_id))
+        if group == len(self.listing_ids) or self.listing_ids[group] != amz_listing_id:
+            raise ValueError('The history of listing %s was not loaded.' % amz_listing_id)
+
+        return group
+
+    def _scalar(self, values):
+        """Return the value for the listing given to __init__(), or None if it is NaN."""
+        value = values[self._group()]
+        return None if np.isnan(value) else float(value)
 
     def data_points(self):
-        """Return historical data in a list of named tuples."""
-        return self._session.query(AmzProductHistory.timestamp,
-                                   AmzProductHistory.salesrank,
-                                   AmzProductHistory.hasprime,
-                                   AmzProductHistory.merchant_id,
-                                   AmzProductHistory.offers).\
-                             filter_by(amz_listing_id=self._listing_id).\
-                             order_by(AmzProductHistory.timestamp.desc()).\
-                             all()
+        """Return the history of the listing given to __init__() in a list of named tuples, newest first."""
+        history = self.history
+        group = self._group()
+        rows = np.flatnonzero(history['group'] == group)[::-1]
+
+        def value(column, type_):
+            return [None if np.isnan(x) else type_(x) for x in history[column][rows].tolist()]
+
+        return [DataPoint(datetime.datetime.utcfromtimestamp(timestamp), *values)
+                for timestamp, *values in zip(history['timestamp'][rows].tolist(),
+                                              value('salesrank', int),
+                                              value('hasprime', bool),
+                                              value('merchant_id', int),
+                                              value('offers', int))]
 
     def avg_salesrank(self):
         """Return the listing's average sales rank."""
-        return self._session.query(func.avg(AmzProductHistory.salesrank)).\
-                             filter_by(amz_listing_id=self._listing_id).\
-                             scalar()
+        return self._scalar(self.average('salesrank'))
 
     def avg_90day_salesrank(self):
         """Return the listing's average sales rank over the last 90 days."""
-        start_date = datetime.date.today() - datetime.timedelta(days=90)
+        return self._scalar(self.average('salesrank', days=90))
 
-        return self._session.query(func.avg(AmzProductHistory.salesrank)).\
-                             filter(AmzProductHistory.amz_listing_id==self._listing_id,
-                                    AmzProductHistory.timestamp > start_date).\
-                             scalar()
+    def sales_points(self, amz_listing_id=None):
+        """Return the timestamps and sales ranks of data points signifying a sale, for the given listing or the one
+        given to __init__().
+        """
+        history = self.history
+        group = self._group(amz_listing_id)
+        sales = history['sale'] & (history['group'] == group)
 
-    def sales_points(self):
-        """Return the timestamps of data points signifying a sale."""
-        sales = []
-        last_point = None
+        return [SalePoint(datetime.datetime.utcfromtimestamp(timestamp), int(salesrank))
+                for timestamp, salesrank in zip(history['timestamp'][sales].tolist(),
+                                                history['salesrank'][sales].tolist())]
 
-        for point in self._session.query(AmzProductHistory.timestamp, AmzProductHistory.salesrank).\
-                                   filter_by(amz_listing_id=self._listing_id).\
-                                   order_by(AmzProductHistory.timestamp.\
-                                   asc()):
+    def is_sale(self, obs):
+        """Return True if the given AmzProductHistory object is believed to show a sale."""
+        if self._sale_ids is None:
+            self._sale_ids = set(self.history['id'][self.history['sale']].tolist())
+
+        return obs.id in self._sale_ids
+
+
+# A sale is a drop in sales rank steeper than sale_slope since the listing's previous observation, the same test that
+# ProductHistoryStats uses. The previous observation of the first one in the window is looked up through the index.
+_sales_estimate_sql = """
+    INSERT INTO amz_sales_estimates (amz_listing_id, sales_30day, sales_90day, updated)
+        SELECT recent.amz_listing_id,
+               coalesce(sum(recent.timestamp >= :since_30day AND {sale}), 0),
+               coalesce(sum({sale}), 0),
+               :updated
+        FROM (SELECT history.amz_listing_id, history.timestamp, history.salesrank,
+                     coalesce(lag(history.id) OVER listing_history,
+                              (SELECT earlier.id FROM amz_history AS earlier
+                               WHERE earlier.amz_listing_id = history.amz_listing_id
+                                 AND earlier.timestamp < history.timestamp
+                               ORDER BY earlier.timestamp DESC LIMIT 1)) AS previous_id
+              FROM amz_history AS history
+              WHERE history.timestamp >= :since_90day {listings}
+              WINDOW listing_history AS (PARTITION BY history.amz_listing_id ORDER BY history.timestamp)) AS recent
+        LEFT JOIN amz_history AS previous ON previous.id = recent.previous_id
+        GROUP BY recent.amz_listing_id"""
+
+_sale_test = '(recent.salesrank - previous.salesrank) / ' \
+             '((julianday(recent.timestamp) - julianday(previous.timestamp)) * 86400.0) < :sale_slope'
+
+
+def update_sales_estimates(session, amz_listing_ids=None):
+    """Estimate the number of sales in the last 30 and 90 days of the given Amazon listings, or of every listing if
+    amz_listing_ids is None, and store them in amz_sales_estimates. Listings without any history in the last 90 days
+    get no estimate. Returns the number of listings estimated.
+    """
+    session.flush()
 
-            if last_point:
-                slope = (point.salesrank - last_point.salesrank) \
-                        / (point.timestamp.timestamp() - last_point.timestamp.timestamp())
+    now = datetime.datetime.utcnow()
+    params = {'since_30day': now - datetime.timedelta(days=30),
+              'since_90day': now - datetime.timedelta(days=90),
+              'updated': now,
+              'sale_slope': sale_slope}
 
-                if slope < self._sale_slope:
-                    sales.append(point)
+    estimates = AmzSalesEstimate.__table__
+    date_params = [bindparam(name, type_=DateTime) for name in ('since_30day', 'since_90day', 'updated')]
 
-            last_point = point
+    if amz_listing_ids is None:
+        session.execute(estimates.delete())
 
-        return sales
+        insert = text(_sales_estimate_sql.format(sale=_sale_test, listings='')).bindparams(*date_params)
+        return session.execute(insert, params).rowcount
 
-    def is_sale(self, obs):
-        """Return True if the given AmzProductHistory object is believed to show a sale."""
+    insert = text(_sales_estimate_sql.format(sale=_sale_test,
+                                             listings='AND history.amz_listing_id IN :amz_listing_ids')).\
+             bindparams(bindparam('amz_listing_ids', expanding=True), *date_params)
 
-        # Get the observation immediately before this one
-        prior = self._session.query(AmzProductHistory).\
-                              filter(AmzProductHistory.amz_listing_id==obs.amz_listing_id,
-                                     AmzProductHistory.id < obs.id).\
-                              order_by(AmzProductHistory.timestamp.desc()).\
-                              first()
-
-        if prior:
-            # Calculate how much of a drop between prior.salesrank and obs.salesrank
-            try:
-                slope = (obs.salesrank - prior.salesrank) / (obs.timestamp.timestamp() - prior.timestamp.timestamp())
-                return slope < self._sale_slope
-            except ZeroDivisionError:
-                print('Zero division error: obs.id=%s, prior.id=%s' % (obs.id, prior.id))
-                return False
-        else:
-            return False
+    count = 0
+    for chunk in _chunks(set(amz_listing_ids), 500):
+        session.execute(estimates.delete().where(estimates.c.amz_listing_id.in_(chunk)))
+        count += session.execute(insert, dict(params, amz_listing_ids=chunk)).rowcount
+
+    return count
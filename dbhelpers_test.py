@@ -0,0 +1,250 @@
+import random
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import dbhelpers
+from database import *
+
+
+class ImportVendorListingsTest(unittest.TestCase):
+    """Test import_vendor_listings() and revert_vendor_import() in an in-memory database."""
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+
+        self.vendor = Vendor(name='Vendor')
+        self.other = Vendor(name='Other')
+        self.list = List(name='Imported')
+        self.session.add_all([self.vendor, self.other, self.list])
+        self.session.flush()
+
+        self.existing = VendorListing(vendor_id=self.vendor.id, sku='ABC-1', title='Old', price=1.0, quantity=1)
+        self.kept = VendorListing(vendor_id=self.vendor.id, sku='KEEP', title='Kept', price=3.0, quantity=1)
+        self.elsewhere = VendorListing(vendor_id=self.other.id, sku='NEW-1', title='Other vendor', price=9.0)
+        self.session.add_all([self.existing, self.kept, self.elsewhere])
+        self.session.flush()
+
+        self.session.add(ListMembership(list_id=self.list.id, listing_id=self.kept.id))
+        self.session.commit()
+
+        self.rows = [{'sku': 'abc-1', 'title': 'New', 'price': 2.0, 'quantity': 2},
+                     {'sku': 'NEW-1', 'title': 'First', 'price': 4.0, 'quantity': 1},
+                     {'sku': 'New-2', 'title': 'Second', 'price': 6.0, 'quantity': 1},
+                     {'sku': 'keep', 'title': 'Kept', 'price': 3.5, 'quantity': 1},
+                     {'sku': '', 'title': 'No SKU'},
+                     {'sku': 'new-1', 'title': 'First again', 'price': 5.0, 'quantity': 1}]
+
+    def tearDown(self):
+        self.session.close()
+
+    def listings(self):
+        return {listing.sku: listing for listing in self.session.query(VendorListing).
+                                                                 filter_by(vendor_id=self.vendor.id)}
+
+    def members(self):
+        return {listing_id for listing_id, in self.session.query(ListMembership.listing_id).
+                                                           filter_by(list_id=self.list.id)}
+
+    def run_import(self, journal=None):
+        return list(dbhelpers.import_vendor_listings(self.session, self.vendor.id, self.rows, list_id=self.list.id,
+                                                     chunk_size=2, journal=journal))
+
+    def test_import(self):
+        progress = self.run_import()
+        self.session.expire_all()
+
+        self.assertEqual(progress, [2, 4, 6])
+
+        # SKUs are matched without regard to case, and keep their original spelling
+        listings = self.listings()
+        self.assertEqual(sorted(listings), ['ABC-1', 'KEEP', 'NEW-1', 'New-2'])
+        self.assertEqual(listings['ABC-1'].id, self.existing.id)
+        self.assertEqual((listings['ABC-1'].title, listings['ABC-1'].price, listings['ABC-1'].quantity),
+                         ('New', 2.0, 2))
+        self.assertEqual(listings['KEEP'].price, 3.5)
+
+        # A new listing can be updated by a later chunk, once its id has been read back
+        self.assertEqual((listings['NEW-1'].title, listings['NEW-1'].price), ('First again', 5.0))
+        self.assertEqual(listings['New-2'].vendor_id, self.vendor.id)
+
+        # Other vendors' listings are left alone
+        self.assertEqual(self.session.query(Listing).get(self.elsewhere.id).title, 'Other vendor')
+
+        self.assertEqual(self.members(), {listing.id for listing in listings.values()})
+
+    def test_revert(self):
+        journal = {}
+        self.run_import(journal)
+
+        self.assertEqual(len(journal['inserted']), 2)
+        self.assertEqual(journal['memberships'], [{'list_id': self.list.id, 'listing_id': self.existing.id}])
+        self.assertEqual(sorted(old['listing_id'] for old in journal['updated']), [self.existing.id, self.kept.id])
+
+        dbhelpers.revert_vendor_import(self.session, journal)
+        self.session.expire_all()
+
+        listings = self.listings()
+        self.assertEqual(sorted(listings), ['ABC-1', 'KEEP'])
+        self.assertEqual((listings['ABC-1'].title, listings['ABC-1'].price, listings['ABC-1'].quantity),
+                         ('Old', 1.0, 1))
+        self.assertEqual(listings['KEEP'].price, 3.0)
+        self.assertEqual(self.members(), {self.kept.id})
+
+        # The vendor_listings rows of the new listings went with them
+        self.assertEqual(self.session.query(VendorListing.__table__).count(), 3)
+
+
+class SalesEstimateTest(unittest.TestCase):
+    """Test that update_sales_estimates() finds the same sales as ProductHistoryStats."""
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+
+        self.session.add(Vendor(id=0, name='Amazon'))
+        self.listings = [AmazonListing(vendor_id=0, sku='A%s' % i) for i in range(4)]
+        self.session.add_all(self.listings)
+        self.session.flush()
+        self.ids = [listing.id for listing in self.listings]
+
+        # A random walk of sales ranks over the last 100 days, with gaps and some missing ranks. The last listing
+        # has no recent history.
+        rng = random.Random(1)
+        now = datetime.utcnow()
+        for listing_id, days in zip(self.ids, (100, 100, 40, 200)):
+            timestamp = now - timedelta(days=days)
+            rank = 20000
+            while timestamp < now - timedelta(days=100 if days == 200 else 0, hours=1):
+                rank = max(1, rank + rng.choice([-8000, -2000, -300, 0, 40, 200, 500, 1500]))
+                self.session.add(AmzProductHistory(amz_listing_id=listing_id, timestamp=timestamp,
+                                                   salesrank=None if rng.random() < .05 else rank))
+                timestamp += timedelta(minutes=rng.randrange(5, 240))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_same_counts(self):
+        self.assertEqual(dbhelpers.update_sales_estimates(self.session), 3)
+        self.session.commit()
+
+        estimates = {row.amz_listing_id: (row.sales_30day, row.sales_90day)
+                     for row in self.session.query(AmzSalesEstimate)}
+
+        stats = dbhelpers.ProductHistoryStats(self.session, self.ids)
+        expected = dict(zip(self.ids, zip(stats.sales_counts(30).tolist(), stats.sales_counts(90).tolist())))
+        del expected[self.ids[3]]
+
+        self.assertEqual(estimates, expected)
+        self.assertTrue(all(sales_30day > 0 for sales_30day, sales_90day in estimates.values()))
+
+    def test_some_listings(self):
+        dbhelpers.update_sales_estimates(self.session, self.ids[1:3])
+        self.session.commit()
+
+        stats = dbhelpers.ProductHistoryStats(self.session, self.ids[1:3])
+        estimates = dict(self.session.query(AmzSalesEstimate.amz_listing_id, AmzSalesEstimate.sales_90day))
+        self.assertEqual(estimates, dict(zip(self.ids[1:3], stats.sales_counts(90).tolist())))
+
+
+class ProductHistoryStatsTest(unittest.TestCase):
+    """Test the statistics ProductHistoryStats calculates for several listings at once."""
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+
+        self.session.add(Vendor(id=0, name='Amazon'))
+        listings = [AmazonListing(vendor_id=0, sku='A%s' % i) for i in range(3)]
+        self.session.add_all(listings)
+        self.session.flush()
+        self.ids = [listing.id for listing in listings]
+
+        # The first listing sells 60 days and 2 days ago. The second listing's first observation is ranked well
+        # above the first listing's last one, just after it, which isn't a sale. The third listing has no history.
+        now = datetime.utcnow()
+        hour = timedelta(hours=1)
+        self.observations = [
+            (self.ids[0], now - timedelta(days=60), 12000),
+            (self.ids[0], now - timedelta(days=60) + hour, 4000),
+            (self.ids[0], now - timedelta(days=20), 9000),
+            (self.ids[0], now - timedelta(days=2), 9000),
+            (self.ids[0], now - timedelta(days=2) + hour, 3000),
+            (self.ids[1], now - timedelta(days=2) + hour + timedelta(minutes=10), 1000),
+            (self.ids[1], now - timedelta(days=1), 1100),
+            (self.ids[1], now - timedelta(hours=12), 990),
+        ]
+        self.rows = [AmzProductHistory(amz_listing_id=listing_id, timestamp=timestamp, salesrank=salesrank)
+                     for listing_id, timestamp, salesrank in self.observations]
+        self.session.add_all(self.rows)
+        self.session.commit()
+
+        self.stats = dbhelpers.ProductHistoryStats(self.session, self.ids)
+
+    def tearDown(self):
+        self.session.close()
+
+    def assertValues(self, actual, expected):
+        np.testing.assert_allclose(actual, expected, rtol=1e-4)
+
+    def test_average(self):
+        self.assertValues(self.stats.average(), [7400, 1030, np.nan])
+        self.assertValues(self.stats.average(days=30), [7000, 1030, np.nan])
+        self.assertValues(self.stats.average(days=1.5), [np.nan, 1045, np.nan])
+
+    def test_sales(self):
+        self.assertEqual(self.stats.sales_counts().tolist(), [2, 0, 0])
+        self.assertEqual(self.stats.sales_counts(30).tolist(), [1, 0, 0])
+        self.assertEqual(self.stats.sales_counts(90).tolist(), [2, 0, 0])
+
+        # The first observation of a listing is never a sale
+        self.assertTrue(self.stats.is_sale(self.rows[4]))
+        self.assertFalse(self.stats.is_sale(self.rows[5]))
+
+    def test_velocity(self):
+        # Measured from the first observation in the window; the second listing has less history than that
+        self.assertValues(self.stats.sales_velocity(30), [1 / 20, 0, np.nan])
+        self.assertEqual(self.stats.ranked_by_velocity(30).tolist(), self.ids)
+
+    def test_volatility(self):
+        self.assertValues(self.stats.volatility(), [np.std([-2 / 3, 1.25, 0, -2 / 3]), .1, np.nan])
+
+        # Changes from observations outside the window are left out
+        self.assertValues(self.stats.volatility(days=30), [1 / 3, .1, np.nan])
+
+    def test_points(self):
+        stats = dbhelpers.ProductHistoryStats(self.session, self.ids[0])
+        self.assertEqual(stats.avg_salesrank(), 7400)
+
+        points = stats.data_points()
+        self.assertEqual([point.salesrank for point in points], [3000, 9000, 9000, 4000, 12000])
+        self.assertLess(abs(points[0].timestamp - self.observations[4][1]), timedelta(seconds=1))
+
+        self.assertEqual([point.salesrank for point in stats.sales_points()], [4000, 3000])
+        self.assertEqual([point.salesrank for point in self.stats.sales_points(self.ids[0])], [4000, 3000])
+        self.assertEqual(self.stats.sales_points(self.ids[1]), [])
+
+        self.assertIsNone(dbhelpers.ProductHistoryStats(self.session, self.ids[2]).avg_salesrank())
+
+    def test_unloaded_listing(self):
+        # Listings that weren't loaded aren't mistaken for their neighbours
+        stats = dbhelpers.ProductHistoryStats(self.session, [self.ids[0], self.ids[2]])
+        for amz_listing_id in (0, self.ids[1], self.ids[2] + 1):
+            with self.assertRaises(ValueError):
+                stats.sales_points(amz_listing_id)
+
+        # With more than one listing loaded, one has to be given
+        with self.assertRaises(ValueError):
+            stats.avg_salesrank()
+        with self.assertRaises(ValueError):
+            stats.data_points()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -9,6 +9,8 @@ from PyQt5.QtWidgets import QDialog, QFileDialog, QDialogButtonBox, QMessageBox,
 from PyQt5.QtWidgets import QWidget
 from PyQt5.QtSql import QSqlTableModel
 
+from sqlalchemy import false
+
 from database import *
 from prowlerwidgets import AlchemyTableModel
 
@@ -540,6 +542,7 @@ class SearchListingsDialog(QDialog, Ui_searchListingsDialog):
 
         self.amazon = show_amazon
         self.dbsession = Session()
+        self.fulltext = has_fulltext(self.dbsession.connection())
 
         # Populate the sources combo box
         condition = Vendor.name == 'Amazon' if show_amazon else Vendor.name != 'Amazon'
@@ -570,12 +573,7 @@ class SearchListingsDialog(QDialog, Ui_searchListingsDialog):
 
     def search(self):
         """Search the database and populate the results table."""
-        keywords = self.keywordsLine.text() or 'abcdefghijklmnop123456789'
-        keywords = keywords.split()
-
-        brand_clauses = or_(*[Listing.brand.contains(term) for term in keywords])
-        model_clauses = or_(*[Listing.model.contains(term) for term in keywords])
-        title_clauses = or_(*[Listing.title.contains(term) for term in keywords])
+        keywords = self.keywordsLine.text().split()
 
         query = self.dbsession.query(Listing.id.label('id'),
                                      Vendor.name.label('Vendor'),
@@ -583,8 +581,7 @@ class SearchListingsDialog(QDialog, Ui_searchListingsDialog):
                                      Listing.brand.label('Brand'),
                                      Listing.model.label('Model'),
                                      Listing.title.label('Title')).\
-                                filter(Vendor.id == Listing.vendor_id,
-                                       or_(brand_clauses, model_clauses, title_clauses))
+                                filter(Vendor.id == Listing.vendor_id)
 
         source_name = self.sourceBox.currentText()
         if source_name == 'All Vendor products':
@@ -600,6 +597,19 @@ class SearchListingsDialog(QDialog, Ui_searchListingsDialog):
                 if list_id:
                     query = query.join(ListMembership).filter_by(list_id=list_id)
 
+        # With no keywords, return no results (but still populate the headers)
+        if not keywords:
+            query = query.filter(false())
+        elif self.fulltext:
+            # Rank the results using the full-text index
+            matches = fulltext_matches(keywords)
+            query = query.filter(Listing.id == matches.c.id).order_by(matches.c.rank)
+        else:
+            brand_clauses = or_(*[Listing.brand.contains(term) for term in keywords])
+            model_clauses = or_(*[Listing.model.contains(term) for term in keywords])
+            title_clauses = or_(*[Listing.title.contains(term) for term in keywords])
+            query = query.filter(or_(brand_clauses, model_clauses, title_clauses))
+
         self.resultsModel.query = query
 
     def keyPressEvent(self, event):
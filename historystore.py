@@ -0,0 +1,252 @@
+import zlib
+from datetime import timezone
+
+import numpy as np
+
+from database import *
+
+
+# The fields of an observation, in the order they are packed into a block, and the types they are stored as.
+# Timestamps are delta-encoded milliseconds since the start of the block's day. NULLs are stored as -1, or NaN
+# for prices.
+_packing = [('timestamp', np.uint32),
+            ('salesrank', np.int32),
+            ('price', np.float64),
+            ('offers', np.int32),
+            ('hasprime', np.int8),
+            ('merchant_id', np.int32)]
+
+fields = [name for name, dtype in _packing]
+
+_record_size = sum(np.dtype(dtype).itemsize for name, dtype in _packing)
+
+_day_msecs = 86400 * 1000
+
+# Add to a julian day to get seconds since the UNIX epoch
+_julian_epoch = 2440587.5
+
+
+def pack(msecs, values):
+    """Pack one day of observations into a compressed BLOB. msecs are the sorted timestamps, in milliseconds since
+    the start of the day, and values is a dictionary of arrays of the other fields, with NaN for NULL.
+    """
+    parts = [np.diff(msecs, prepend=0).astype(np.uint32)]
+
+    for name, dtype in _packing[1:]:
+        column = values[name]
+        if dtype is not np.float64:
+            column = np.where(np.isnan(column), -1, column)
+
+        parts.append(column.astype(dtype))
+
+    return zlib.compress(b''.join(part.tobytes() for part in parts))
+
+
+def unpack(blobs, counts):
+    """Unpack a list of BLOBs made by pack(), given the number of observations in each. All of the blocks are
+    decoded at once. Returns the timestamps, in milliseconds since the start of each block's day, and a dictionary
+    of float arrays of the other fields, with NaN for NULL.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    data = np.frombuffer(b''.join(zlib.decompress(blob) for blob in blobs), dtype=np.uint8)
+
+    # The block each observation is in, its position in the block, and where the block starts in data
+    block = np.repeat(np.arange(len(counts)), counts)
+    first = (np.cumsum(counts) - counts)[block]
+    position = np.arange(len(block)) - first
+    start = first * _record_size
+
+    values, field_offset = {}, 0
+    for name, dtype in _packing:
+        size = np.dtype(dtype).itemsize
+        index = start + field_offset * counts[block] + position * size
+        column = data[index[:, None] + np.arange(size)].view(dtype).ravel()
+        field_offset += size
+
+        if name == 'timestamp':
+            total = np.cumsum(column, dtype=np.int64)
+            msecs = total - (total[first] - column[first])
+        elif dtype is np.float64:
+            values[name] = column
+        else:
+            values[name] = np.where(column == -1, np.nan, column)
+
+    return msecs, values
+
+
+def _empty():
+    """Return an empty history table, as returned by read()."""
+    table = {name: np.empty(0) for name in fields}
+    table['amz_listing_id'] = np.empty(0, dtype=np.int64)
+    table['id'] = np.empty(0, dtype=np.int64)
+    return table
+
+
+def _concatenate(tables):
+    """Join history tables end to end."""
+    tables = [_empty()] + tables
+    return {name: np.concatenate([table[name] for table in tables]) for name in tables[0]}
+
+
+def append(session, amz_listing_id, timestamps, **values):
+    """Add observations of an Amazon listing to amz_history_blocks. timestamps are in seconds since the UNIX epoch.
+    The other fields are given as keyword arguments, each a list or array with one value per timestamp. Fields
+    that aren't given, and None values, are stored as NULL. Returns the number of observations added.
+    """
+    msecs = np.rint(np.asarray(timestamps, dtype=float) * 1000).astype(np.int64)
+    values = {name: np.full(len(msecs), np.nan) if values.get(name) is None else np.asarray(values[name], dtype=float)
+              for name in fields[1:]}
+
+    added = len(msecs)
+    if not added:
+        return 0
+
+    # Merge with the blocks already stored for the same days
+    days = msecs // _day_msecs
+    stored = session.query(AmzHistoryBlock.day, AmzHistoryBlock.count, AmzHistoryBlock.data).\
+                     filter(AmzHistoryBlock.amz_listing_id == amz_listing_id,
+                            AmzHistoryBlock.day >= int(days.min()),
+                            AmzHistoryBlock.day <= int(days.max())).\
+                     all()
+
+    if stored:
+        stored_days, counts, blobs = zip(*stored)
+        stored_msecs, stored_values = unpack(blobs, counts)
+        stored_days = np.repeat(np.array(stored_days, dtype=np.int64), counts)
+
+        merge = np.isin(stored_days, days)
+        msecs = np.concatenate([stored_msecs[merge] + stored_days[merge] * _day_msecs, msecs])
+        values = {name: np.concatenate([stored_values[name][merge], values[name]]) for name in values}
+
+    # Sort by time, then split into days
+    order = np.argsort(msecs, kind='stable')
+    msecs = msecs[order]
+    values = {name: values[name][order] for name in values}
+
+    days, starts = np.unique(msecs // _day_msecs, return_index=True)
+    ends = np.append(starts[1:], len(msecs))
+
+    blocks = []
+    for day, start, end in zip(days.tolist(), starts.tolist(), ends.tolist()):
+        blocks.append({'amz_listing_id': amz_listing_id,
+                       'day': day,
+                       'count': end - start,
+                       'data': pack(msecs[start:end] - day * _day_msecs,
+                                    {name: values[name][start:end] for name in values})})
+
+    session.execute(AmzHistoryBlock.__table__.insert().prefix_with('OR REPLACE'), blocks)
+    return added
+
+
+def _read_blocks(session, amz_listing_ids, start, end):
+    """Read the stored blocks of the given listings that overlap start to end, seconds since the UNIX epoch."""
+    blocks = AmzHistoryBlock.__table__
+    query = select([blocks.c.amz_listing_id, blocks.c.day, blocks.c.count, blocks.c.data]).\
+            where(blocks.c.amz_listing_id.in_(amz_listing_ids))
+
+    if start is not None:
+        query = query.where(blocks.c.day >= int(start // 86400))
+    if end is not None:
+        query = query.where(blocks.c.day <= int(end // 86400))
+
+    rows = session.execute(query).fetchall()
+    if not rows:
+        return _empty()
+
+    amz_listing_ids, days, counts, blobs = zip(*rows)
+    msecs, table = unpack(blobs, counts)
+
+    table['timestamp'] = (msecs + np.repeat(np.array(days, dtype=np.int64) * _day_msecs, counts)) / 1000
+    table['amz_listing_id'] = np.repeat(np.array(amz_listing_ids, dtype=np.int64), counts)
+    table['id'] = np.full(len(msecs), -1, dtype=np.int64)
+    return table
+
+
+def _read_rows(session, amz_listing_ids, start, end):
+    """Read the observations of the given listings in amz_history from start to end, naive UTC datetimes."""
+    timestamp = (func.julianday(AmzProductHistory.timestamp) - _julian_epoch) * 86400.0
+
+    query = session.query(AmzProductHistory.amz_listing_id, AmzProductHistory.id, timestamp,
+                          AmzProductHistory.salesrank, AmzProductHistory.price, AmzProductHistory.offers,
+                          AmzProductHistory.hasprime, AmzProductHistory.merchant_id).\
+                    filter(AmzProductHistory.amz_listing_id.in_(amz_listing_ids),
+                           AmzProductHistory.timestamp != None)
+
+    if start is not None:
+        query = query.filter(AmzProductHistory.timestamp >= start)
+    if end is not None:
+        query = query.filter(AmzProductHistory.timestamp < end)
+
+    rows = query.all()
+    columns = np.array(rows, dtype=float).reshape(len(rows), 8).T
+
+    table = dict(zip(['amz_listing_id', 'id', 'timestamp', 'salesrank', 'price', 'offers', 'hasprime',
+                      'merchant_id'], columns))
+    table['amz_listing_id'] = table['amz_listing_id'].astype(np.int64)
+    table['id'] = table['id'].astype(np.int64)
+
+    # julianday() only keeps milliseconds; drop the rounding error
+    table['timestamp'] = np.round(table['timestamp'], 3)
+    return table
+
+
+def read(session, amz_listing_ids, start=None, end=None):
+    """Return the product history of the given Amazon listings from start (inclusive) to end (exclusive), naive UTC
+    datetimes, or all of it if they are None. Observations are read from both amz_history_blocks and amz_history.
+    The result is a dictionary of NumPy arrays, sorted by listing and time: amz_listing_id, id (-1 for observations
+    in blocks), timestamp (in seconds since the UNIX epoch), and the other fields as floats, with NULLs as NaN.
+    """
+    start_secs = start.replace(tzinfo=timezone.utc).timestamp() if start is not None else None
+    end_secs = end.replace(tzinfo=timezone.utc).timestamp() if end is not None else None
+
+    amz_listing_ids = list(amz_listing_ids)
+    tables = []
+
+    for i in range(0, len(amz_listing_ids), 500):
+        chunk = amz_listing_ids[i:i + 500]
+        tables.append(_read_blocks(session, chunk, start_secs, end_secs))
+        tables.append(_read_rows(session, chunk, start, end))
+
+    table = _concatenate(tables)
+
+    # Blocks are whole days, so trim them to the range asked for
+    mask = np.ones(len(table['timestamp']), dtype=bool)
+    if start_secs is not None:
+        mask &= table['timestamp'] >= start_secs
+    if end_secs is not None:
+        mask &= table['timestamp'] < end_secs
+
+    order = np.lexsort((table['timestamp'][mask], table['amz_listing_id'][mask]))
+    return {name: column[mask][order] for name, column in table.items()}
+
+
+def compact(session, before, chunk_size=500, limit=None):
+    """Move the observations in amz_history from before the given naive UTC datetime into amz_history_blocks.
+    If limit is given, only the history of that many listings is moved. Returns the number of observations moved.
+    """
+    amz_listing_ids = [row[0] for row in session.query(AmzProductHistory.amz_listing_id).\
+                                                 filter(AmzProductHistory.timestamp < before).\
+                                                 distinct().\
+                                                 order_by(AmzProductHistory.amz_listing_id).\
+                                                 limit(limit)]
+    history = AmzProductHistory.__table__
+    moved = 0
+
+    for i in range(0, len(amz_listing_ids), chunk_size):
+        chunk = amz_listing_ids[i:i + chunk_size]
+        table = _read_rows(session, chunk, None, before)
+
+        # Put each listing's observations together, in order
+        order = np.lexsort((table['timestamp'], table['amz_listing_id']))
+        table = {name: column[order] for name, column in table.items()}
+        listing_ids, starts = np.unique(table['amz_listing_id'], return_index=True)
+        ends = np.append(starts[1:], len(order))
+
+        for amz_listing_id, start, end in zip(listing_ids.tolist(), starts.tolist(), ends.tolist()):
+            moved += append(session, amz_listing_id, table['timestamp'][start:end],
+                            **{name: table[name][start:end] for name in fields[1:]})
+
+        session.execute(history.delete().where(and_(history.c.amz_listing_id.in_(chunk),
+                                                    history.c.timestamp < before)))
+
+    return moved
@@ -0,0 +1,153 @@
+import unittest
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import dbhelpers
+import historystore
+from database import *
+
+
+class PackTest(unittest.TestCase):
+    """Test that pack() and unpack() give back what was stored."""
+
+    def test_round_trip(self):
+        msecs = np.array([0, 1500, 1500, 86399999])
+        values = {'salesrank': np.array([100, np.nan, 3, 2 ** 31 - 1]),
+                  'price': np.array([9.99, np.nan, 0, 1234.5]),
+                  'offers': np.array([1, 2, np.nan, 0]),
+                  'hasprime': np.array([1, 0, np.nan, 1]),
+                  'merchant_id': np.array([np.nan, 7, 7, 8])}
+
+        unpacked_msecs, unpacked = historystore.unpack([historystore.pack(msecs, values)], [4])
+
+        np.testing.assert_array_equal(unpacked_msecs, msecs)
+        for name in values:
+            np.testing.assert_array_equal(unpacked[name], values[name], err_msg=name)
+
+    def test_several_blocks(self):
+        blocks = [(np.array([5, 10]), 1), (np.array([0]), 2), (np.array([1, 2, 3]), 3)]
+        blobs, counts = [], []
+        for msecs, rank in blocks:
+            values = {name: np.full(len(msecs), np.nan) for name in historystore.fields[1:]}
+            values['salesrank'] = np.full(len(msecs), rank)
+            blobs.append(historystore.pack(msecs, values))
+            counts.append(len(msecs))
+
+        msecs, values = historystore.unpack(blobs, counts)
+
+        # Timestamps start again at the beginning of each block
+        np.testing.assert_array_equal(msecs, [5, 10, 0, 1, 2, 3])
+        np.testing.assert_array_equal(values['salesrank'], [1, 1, 2, 3, 3, 3])
+        self.assertTrue(np.isnan(values['price']).all())
+
+
+class HistoryStoreTest(unittest.TestCase):
+    """Test appending, reading and compacting history in an in-memory database."""
+
+    day = 18262 * 86400     # 2020-01-01 00:00 UTC
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+
+        self.session.add(Vendor(id=0, name='Amazon'))
+        self.session.add_all([AmazonMerchant(id=1, name='M1'), AmazonMerchant(id=2, name='M2')])
+        self.listings = [AmazonListing(vendor_id=0, sku='A%s' % i) for i in range(2)]
+        self.session.add_all(self.listings)
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def blocks(self, amz_listing_id):
+        return self.session.query(AmzHistoryBlock.day, AmzHistoryBlock.count).\
+                            filter_by(amz_listing_id=amz_listing_id).\
+                            order_by(AmzHistoryBlock.day).\
+                            all()
+
+    def test_append_across_days(self):
+        listing_id = self.listings[0].id
+        timestamps = [self.day + 86399.999, self.day + 86400, self.day + 10.5]
+
+        added = historystore.append(self.session, listing_id, timestamps, salesrank=[2, 3, 1], price=[5.0, None, 7.5])
+
+        self.assertEqual(added, 3)
+        self.assertEqual(self.blocks(listing_id), [(18262, 2), (18263, 1)])
+
+        table = historystore.read(self.session, [listing_id])
+        np.testing.assert_array_equal(table['timestamp'], sorted(timestamps))
+        np.testing.assert_array_equal(table['salesrank'], [1, 2, 3])
+        np.testing.assert_array_equal(table['price'], [7.5, 5.0, np.nan])
+        self.assertTrue(np.isnan(table['offers']).all())
+        np.testing.assert_array_equal(table['id'], [-1, -1, -1])
+
+    def test_append_merges_blocks(self):
+        listing_id = self.listings[0].id
+        historystore.append(self.session, listing_id, [self.day + 100, self.day + 300], salesrank=[1, 3])
+        historystore.append(self.session, listing_id, [self.day + 200, self.day + 86400 + 1], salesrank=[2, 4])
+
+        self.assertEqual(self.blocks(listing_id), [(18262, 3), (18263, 1)])
+
+        table = historystore.read(self.session, [listing_id])
+        np.testing.assert_array_equal(table['timestamp'] - self.day, [100, 200, 300, 86401])
+        np.testing.assert_array_equal(table['salesrank'], [1, 2, 3, 4])
+
+    def test_read_range(self):
+        listing_id = self.listings[0].id
+        historystore.append(self.session, listing_id, [self.day + 3600 * h for h in range(48)], salesrank=range(48))
+
+        start = datetime(2020, 1, 1, 12)
+        table = historystore.read(self.session, [listing_id], start, start + timedelta(hours=24))
+
+        np.testing.assert_array_equal(table['salesrank'], range(12, 36))
+
+    def test_compact(self):
+        first, second = (listing.id for listing in self.listings)
+        start = datetime(2020, 1, 1, 22)
+
+        for listing_id in (first, second):
+            for hour in range(5):
+                self.session.add(AmzProductHistory(amz_listing_id=listing_id,
+                                                   timestamp=start + timedelta(hours=hour),
+                                                   salesrank=1000 - hour,
+                                                   price=None if hour == 1 else 10.0 + hour,
+                                                   offers=hour,
+                                                   hasprime=hour % 2 == 0,
+                                                   merchant_id=None if hour == 2 else 1 + hour % 2))
+        self.session.commit()
+
+        # An observation already in the store, on the same day as some of the rows being moved
+        historystore.append(self.session, first, [self.day + 86400 + 30], salesrank=[5])
+
+        before = historystore.read(self.session, [first, second])
+        data_points = dbhelpers.ProductHistoryStats(self.session, first).data_points()
+        moved = historystore.compact(self.session, start + timedelta(hours=3), limit=1)
+        self.session.commit()
+
+        self.assertEqual(moved, 3)
+        self.assertEqual(self.session.query(AmzProductHistory).filter_by(amz_listing_id=first).count(), 2)
+        self.assertEqual(self.session.query(AmzProductHistory).filter_by(amz_listing_id=second).count(), 5)
+        self.assertEqual(self.blocks(first), [(18262, 2), (18263, 2)])
+
+        # The history reads back the same, from blocks instead of rows
+        after = historystore.read(self.session, [first, second])
+        for name in historystore.fields:
+            np.testing.assert_array_equal(after[name], before[name], err_msg=name)
+        np.testing.assert_array_equal(after['id'][:6] == -1, [True] * 4 + [False] * 2)
+
+        self.assertEqual(dbhelpers.ProductHistoryStats(self.session, first).data_points(), data_points)
+        self.assertEqual(data_points[0].timestamp, datetime(2020, 1, 2, 2))
+        self.assertEqual(data_points[1][1:], (997, False, 2, 3))
+        self.assertEqual(data_points[2][1:], (5, None, None, None))
+        self.assertEqual(data_points[5][1:], (1000, True, 1, 0))
+
+        # The rest of the history
+        moved = historystore.compact(self.session, start + timedelta(hours=3))
+        self.assertEqual(moved, 3)
+        self.assertEqual(self.session.query(AmzProductHistory).count(), 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
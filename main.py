@@ -1,13 +1,20 @@
 import sys
+import asyncio
 
 from PyQt5.QtWidgets import QApplication
+from qasync import QEventLoop
 from mainwindow import MainWindow
 
 
 if __name__ == '__main__':
     app = QApplication(sys.argv)
 
+    # Run asyncio on top of Qt's event loop, so operations can wait on the network without blocking the UI
+    loop = QEventLoop(app)
+    asyncio.set_event_loop(loop)
+
     window = MainWindow()
     window.show()
-    app.exec_()
-    app.exit()
\ No newline at end of file
+
+    with loop:
+        loop.run_forever()
@@ -0,0 +1,93 @@
+import numpy as np
+
+from database import *
+import dbhelpers
+
+
+def unit_cost_expression():
+    """Return an expression for a vendor listing's unit cost, including the vendor's tax and shipping rates."""
+    return Listing.unit_price * (1 + Vendor.tax_rate + Vendor.ship_rate)
+
+
+def best_unit_costs(session, amz_ids, min_confidence=0):
+    """Return a query of (amz_listing_id, unit_cost) giving the lowest unit cost among the vendor listings linked to
+    each Amazon listing with at least min_confidence. amz_ids is a list of ids, or a query that selects them. If
+    min_confidence is one of AmzBestCost.buckets, the costs are looked up in amz_best_cost.
+    """
+    if min_confidence in AmzBestCost.buckets:
+        return session.query(AmzBestCost.amz_listing_id, AmzBestCost.unit_cost).\
+                       filter(AmzBestCost.confidence == min_confidence,
+                              AmzBestCost.amz_listing_id.in_(amz_ids))
+
+    return session.query(LinkedProducts.amz_listing_id, func.min(unit_cost_expression()).label('unit_cost')).\
+                   join(Listing, Listing.id == LinkedProducts.vnd_listing_id).\
+                   join(Vendor, Vendor.id == Listing.vendor_id).\
+                   filter(LinkedProducts.amz_listing_id.in_(amz_ids),
+                          LinkedProducts.confidence >= min_confidence).\
+                   group_by(LinkedProducts.amz_listing_id)
+
+
+def margin_table(session, amz_ids, min_confidence=0):
+    """Return a dictionary of NumPy arrays, with one entry per Amazon listing in amz_ids that has a price, a quantity
+    and at least one linked vendor listing: id, price, quantity, unit_cost, and the price_point, fba, prep and ship
+    of its price point at the current price. Missing values are NaN. Everything is fetched with a single query.
+    """
+    costs = best_unit_costs(session, amz_ids, min_confidence).subquery()
+
+    rows = session.query(Listing.id, Listing.price, Listing.quantity,
+                         func.min(costs.c.unit_cost),
+                         func.min(AmzPriceAndFees.id),
+                         func.max(AmzPriceAndFees.fba),
+                         func.max(AmzPriceAndFees.prep),
+                         func.max(AmzPriceAndFees.ship)).\
+                   join(costs, costs.c.amz_listing_id == Listing.id).\
+                   outerjoin(AmzPriceAndFees, and_(AmzPriceAndFees.amz_listing_id == Listing.id,
+                                                   AmzPriceAndFees.price == Listing.price)).\
+                   filter(Listing.price != 0,
+                          Listing.quantity != 0).\
+                   group_by(Listing.id).\
+                   all()
+
+    names = ['id', 'price', 'quantity', 'unit_cost', 'price_point', 'fba', 'prep', 'ship']
+    columns = np.array(rows, dtype=float).reshape(len(rows), len(names)).T
+
+    table = dict(zip(names, columns))
+    table['id'] = table['id'].astype(int)
+    return table
+
+
+def test_margins(session, amz_ids, params, priority=0):
+    """Do the work of the TestMargins operation for many listings at once. Listings whose margin meets
+    params['threshold'] are added to the list params['list']. Listings that would need a fee estimate to decide get a
+    TestMargins operation, and a price point at their current price if they don't have one. Returns the number of
+    listings added to the list, and the number of operations queued.
+    """
+    table = margin_table(session, amz_ids, params.get('confidence', 0))
+    threshold = params['threshold']
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Test the margin based solely on cost
+        cost = table['unit_cost'] * table['quantity']
+        possible = (table['price'] - cost) / cost >= threshold
+
+        # Listings with a fee estimate can be decided right away
+        has_fees = ~np.isnan(table['fba'])
+        fba = np.where(table['fba'] != 0, table['fba'], table['price'] * .25)
+        cost = cost + np.nan_to_num(table['prep']) + np.nan_to_num(table['ship'])
+        margin = (table['price'] - cost - fba) / cost
+
+    passed = table['id'][possible & has_fees & (margin >= threshold)]
+    need_fees = possible & ~has_fees
+
+    if len(passed):
+        dbhelpers.add_ids_to_list(session, listing_ids=passed.tolist(), list_name=params['list'])
+
+    new_price_points = need_fees & np.isnan(table['price_point'])
+    session.bulk_insert_mappings(AmzPriceAndFees, [{'amz_listing_id': int(amz_id), 'price': float(price)}
+                                                   for amz_id, price in zip(table['id'][new_price_points],
+                                                                            table['price'][new_price_points])])
+
+    session.add_all([Operation.TestMargins(listing_id=int(amz_id), params=params, priority=priority)
+                     for amz_id in table['id'][need_fees]])
+
+    return len(passed), int(need_fees.sum())
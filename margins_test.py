@@ -0,0 +1,143 @@
+import unittest
+
+from database import *
+from margins import best_unit_costs
+
+
+class BestCostTest(unittest.TestCase):
+    """Test that the triggers keep amz_best_cost the same as calculating the best unit costs directly."""
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://')
+        Base.metadata.create_all(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+
+        self.session.add(Vendor(id=0, name='Amazon'))
+        self.vendor1 = Vendor(name='Vendor 1', tax_rate=.1, ship_rate=0)
+        self.vendor2 = Vendor(name='Vendor 2', tax_rate=0, ship_rate=.05)
+        self.session.add_all([self.vendor1, self.vendor2])
+        self.session.flush()
+
+        self.amz1 = AmazonListing(vendor_id=0, sku='A1')
+        self.amz2 = AmazonListing(vendor_id=0, sku='A2')
+        self.cheap = VendorListing(vendor_id=self.vendor1.id, sku='V1', price=10, quantity=1)       # 11.00
+        self.pack = VendorListing(vendor_id=self.vendor2.id, sku='V2', price=21, quantity=2)        # 11.025
+        self.no_price = VendorListing(vendor_id=self.vendor2.id, sku='V3', price=None, quantity=1)
+        self.dear = VendorListing(vendor_id=self.vendor1.id, sku='V4', price=30, quantity=2)        # 16.50
+        self.session.add_all([self.amz1, self.amz2, self.cheap, self.pack, self.no_price, self.dear])
+        self.session.flush()
+
+        self.session.add_all([self.link(self.amz1, self.cheap, 90),
+                              self.link(self.amz1, self.pack, 60),
+                              self.link(self.amz1, self.no_price, 95),
+                              self.link(self.amz2, self.dear, 50),
+                              self.link(self.amz2, self.pack, 85)])
+        self.session.commit()
+
+        # Plain ids, which can still be used after the listings are deleted
+        self.a1, self.a2 = self.amz1.id, self.amz2.id
+
+    def tearDown(self):
+        self.session.close()
+
+    @staticmethod
+    def link(amz, vnd, confidence):
+        return LinkedProducts(amz_listing_id=amz.id, vnd_listing_id=vnd.id, confidence=confidence)
+
+    def expected(self):
+        """Calculate the best costs with the query used before amz_best_cost, and find the cheapest listing of each."""
+        unit_cost = VendorListing.unit_price * (1 + Vendor.tax_rate + Vendor.ship_rate)
+        links = self.session.query(LinkedProducts.amz_listing_id, LinkedProducts.confidence, VendorListing.id,
+                                   unit_cost).\
+                             join(VendorListing, VendorListing.id == LinkedProducts.vnd_listing_id).\
+                             join(Vendor, Vendor.id == VendorListing.vendor_id).\
+                             all()
+
+        costs = {}
+        for bucket in AmzBestCost.buckets:
+            rows = self.session.query(LinkedProducts.amz_listing_id, func.min(unit_cost)).\
+                                join(VendorListing, VendorListing.id == LinkedProducts.vnd_listing_id).\
+                                join(Vendor, Vendor.id == VendorListing.vendor_id).\
+                                filter(LinkedProducts.confidence >= bucket).\
+                                group_by(LinkedProducts.amz_listing_id)
+
+            for amz_listing_id, best in rows:
+                if best is None:
+                    continue
+
+                cheapest = [vnd_listing_id for amz_id, confidence, vnd_listing_id, cost in links
+                            if amz_id == amz_listing_id and confidence >= bucket and cost == best]
+                costs[amz_listing_id, bucket] = (round(best, 6), cheapest[0])
+
+        return costs
+
+    def check(self, expected=None):
+        self.session.commit()
+        self.session.expire_all()
+
+        stored = {(row.amz_listing_id, row.confidence): (round(row.unit_cost, 6), row.vnd_listing_id)
+                  for row in self.session.query(AmzBestCost)}
+        self.assertEqual(stored, self.expected())
+
+        if expected is not None:
+            self.assertEqual(dict(best_unit_costs(self.session, [self.a1, self.a2], 80)), expected)
+
+    def test_link_insert(self):
+        self.check({self.a1: 11.0, self.a2: 11.025})
+
+        self.session.add(self.link(self.amz2, self.cheap, 70))
+        self.check({self.a1: 11.0, self.a2: 11.025})
+        self.assertEqual(dict(best_unit_costs(self.session, [self.a2], 70)), {self.a2: 11.0})
+
+    def test_link_delete(self):
+        self.session.query(LinkedProducts).filter_by(amz_listing_id=self.a1, vnd_listing_id=self.cheap.id).\
+                     delete()
+        self.check({self.a2: 11.025})
+
+    def test_link_confidence(self):
+        link = self.session.query(LinkedProducts).filter_by(amz_listing_id=self.a1,
+                                                            vnd_listing_id=self.cheap.id).one()
+        link.confidence = 55
+        self.check({self.a2: 11.025})
+
+        link.confidence = 100
+        self.check({self.a1: 11.0, self.a2: 11.025})
+
+    def test_listing_price_and_quantity(self):
+        self.pack.price = 8
+        self.check({self.a1: 11.0, self.a2: 4.2})
+
+        self.pack.quantity = 1
+        self.check({self.a1: 11.0, self.a2: 8.4})
+
+        self.no_price.price = 5
+        self.check({self.a1: 5.25, self.a2: 8.4})
+
+    def test_vendor_rates(self):
+        self.vendor1.tax_rate = .2
+        self.check({self.a1: 12.0, self.a2: 11.025})
+
+        self.vendor2.ship_rate = 0
+        self.check({self.a1: 12.0, self.a2: 10.5})
+
+    def test_listing_delete(self):
+        # Deleting a vendor listing deletes its links, which updates the best costs
+        self.session.execute(Listing.__table__.delete().where(Listing.id == self.cheap.id))
+        self.check({self.a2: 11.025})
+
+        # The best costs of a deleted Amazon listing go with it
+        self.session.execute(Listing.__table__.delete().where(Listing.id == self.a2))
+        self.check({})
+        self.assertEqual(self.session.query(AmzBestCost).filter_by(amz_listing_id=self.a2).count(), 0)
+
+    def test_backfill(self):
+        # Creating amz_best_cost in an existing database fills it in
+        self.session.close()
+        AmzBestCost.__table__.drop(self.engine)
+        Base.metadata.create_all(self.engine)
+
+        self.check({self.a1: 11.0, self.a2: 11.025})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+import re
+from collections import defaultdict
+
+import numpy as np
+
+from rapidfuzz import fuzz, process, utils
+
+from database import *
+import dbhelpers
+
+
+# Tokens that look like model numbers: at least three characters, including a digit
+re_model_token = re.compile(r'(?=[a-z]*\d)[a-z\d]{3,}')
+
+
+def normalize_brand(brand):
+    """Lower-case the brand, and strip out symbols and extra spaces."""
+    return ' '.join(remove_symbols(brand or '').lower().split())
+
+
+def normalize_upc(upc):
+    """Return the UPC as a string of digits without leading zeros, or None."""
+    digits = re.sub(r'\D', '', str(upc or '')).lstrip('0')
+    return digits or None
+
+
+def model_tokens(model, title=None):
+    """Return the set of model number tokens in model. Hyphens and other symbols are removed first, so 'AB-1234' and
+    'AB1234' give the same token. If there is no model, look for model-like tokens in the title instead.
+    """
+    tokens = set()
+
+    for text in (model, None if model else title):
+        if not text:
+            continue
+
+        text = text.lower()
+        tokens.update(re_model_token.findall(remove_symbols(text)))
+        tokens.update(re_model_token.findall(remove_symbols(text, ' ')))
+
+    return tokens
+
+
+class CandidateIndex:
+    """An in-memory blocking index over listings, used to propose likely matches without calling the API. Listings
+    are grouped into blocks by UPC, and by normalized brand plus model token. Two listings are candidates if they
+    share a block.
+    """
+
+    def __init__(self):
+        self._blocks = defaultdict(set)
+
+        # The highest listing id loaded from the database by load()
+        self.loaded_id = 0
+
+    @staticmethod
+    def keys(brand, model, upc, title=None):
+        """Return the blocking keys for a listing with the given details."""
+        keys = set()
+
+        upc = normalize_upc(upc)
+        if upc:
+            keys.add(('upc', upc))
+
+        brand = normalize_brand(brand)
+        for token in model_tokens(model, title):
+            keys.add(('model', brand, token))
+
+        return keys
+
+    def add(self, listing_id, brand, model, upc, title=None):
+        """Add a listing to the index."""
+        for key in self.keys(brand, model, upc, title):
+            self._blocks[key].add(listing_id)
+
+    def add_listings(self, rows):
+        """Add the listings in rows, an iterable of (id, brand, model, upc, title) tuples."""
+        for row in rows:
+            self.add(*row)
+
+    def load(self, rows):
+        """Add rows returned by amazon_rows(), and remember the highest id loaded."""
+        for row in rows:
+            self.add(*row)
+            self.loaded_id = max(self.loaded_id, row[0])
+
+    @staticmethod
+    def amazon_rows(session, after_id=0):
+        """Return (id, brand, model, upc, title) tuples for the Amazon listings with ids greater than after_id."""
+        return session.query(Listing.id, Listing.brand, Listing.model, Listing.upc, Listing.title).\
+                       filter(Listing.vendor_id == 0,
+                              Listing.id > after_id).\
+                       all()
+
+    @classmethod
+    def for_amazon(cls, session):
+        """Return an index of all the Amazon listings in the database."""
+        index = cls()
+        index.load(cls.amazon_rows(session))
+        return index
+
+    def candidates(self, brand, model, upc, title=None):
+        """Return the set of listing ids that share a block with a listing with the given details."""
+        ids = set()
+        for key in self.keys(brand, model, upc, title):
+            ids.update(self._blocks.get(key, ()))
+
+        return ids
+
+    def candidates_for(self, listing):
+        """Return the set of ids of indexed listings that might match the given listing."""
+        ids = self.candidates(listing.brand, listing.model, listing.upc, listing.title)
+        ids.discard(listing.id)
+        return ids
+
+
+def link_candidates(session, index, vnd_listing, min_confidence):
+    """Link vnd_listing to the Amazon listings in the index that match it with at least min_confidence. Returns the
+    list of links found.
+    """
+    candidate_ids = index.candidates_for(vnd_listing)
+    if not candidate_ids:
+        return []
+
+    links = []
+    for amz_listing in session.query(AmazonListing).filter(AmazonListing.id.in_(candidate_ids)):
+        link = dbhelpers.link_products(session, amz=amz_listing, vnd=vnd_listing)
+
+        if link.confidence >= min_confidence:
+            links.append(link)
+        elif link in session.new:
+            session.expunge(link)
+
+    return links
+
+
+class LinkScorer:
+    """Calculates the same match scores as LinkedProducts.build_confidence(), for many pairs of listings at once.
+    Each listing's strings are normalized once and cached by listing id, and the fuzzy comparisons are done in bulk.
+    """
+
+    def __init__(self):
+        self._listings = {}
+
+    def load(self, session, listing_ids):
+        """Load and normalize the listings with the given ids, if they aren't cached already."""
+        missing = [listing_id for listing_id in set(listing_ids) if listing_id not in self._listings]
+
+        for i in range(0, len(missing), 500):
+            for listing_id, brand, model, title in session.query(Listing.id, Listing.brand, Listing.model,
+                                                                 Listing.title).\
+                                                           filter(Listing.id.in_(missing[i:i + 500])):
+                self._listings[listing_id] = {'brand': remove_symbols(brand or '').lower(),
+                                              'model': remove_symbols(model or '').lower(),
+                                              'title': remove_symbols(title or '').lower(),
+                                              'raw_title': str(title or '').lower()}
+
+    @staticmethod
+    def _pairwise(scorer, queries, choices, **kwargs):
+        """Score each query against the choice in the same position."""
+        return process.cpdist(queries, choices, scorer=scorer, workers=-1, **kwargs)
+
+    def score(self, pairs):
+        """Return a list of (brand_match, model_match, title_match, confidence) for each (amz_listing_id,
+        vnd_listing_id) in pairs. The listings must already be loaded.
+        """
+        if not pairs:
+            return []
+
+        amz = [self._listings[amz_id] for amz_id, vnd_id in pairs]
+        vnd = [self._listings[vnd_id] for amz_id, vnd_id in pairs]
+
+        def column(listings, field):
+            return [listing[field] for listing in listings]
+
+        amz_brand, vnd_brand = column(amz, 'brand'), column(vnd, 'brand')
+        amz_model, vnd_model = column(amz, 'model'), column(vnd, 'model')
+        amz_title, vnd_title = column(amz, 'title'), column(vnd, 'title')
+
+        brand = np.maximum.reduce([self._pairwise(fuzz.partial_ratio, amz_brand, vnd_brand),
+                                   self._pairwise(fuzz.partial_ratio, amz_brand, vnd_title),
+                                   self._pairwise(fuzz.partial_ratio, vnd_brand, amz_title)])
+
+        model_vs_model = self._pairwise(fuzz.token_set_ratio, amz_model, vnd_model, processor=utils.default_process)
+        for i, (model1, model2) in enumerate(zip(amz_model, vnd_model)):
+            if model1.isdigit() and model2.isdigit():
+                model_vs_model[i] = 100 * (model1 in model2 or model2 in model1)
+
+        model = np.maximum.reduce([model_vs_model,
+                                   self._pairwise(fuzz.token_set_ratio, amz_model, vnd_title,
+                                                  processor=utils.default_process),
+                                   self._pairwise(fuzz.token_set_ratio, vnd_model, amz_title,
+                                                  processor=utils.default_process)])
+
+        title = self._pairwise(fuzz.token_set_ratio, column(amz, 'raw_title'), column(vnd, 'raw_title'),
+                               processor=utils.default_process)
+
+        scores = []
+        for b, m, t in zip(np.rint(brand).astype(int), np.rint(model).astype(int), np.rint(title).astype(int)):
+            b, m, t = int(b), int(m), int(t)
+            scores.append((b, m, t, sum([b * 2, m * 2, t]) / 5))
+
+        return scores
+
+
+def rescore_links(session, links_query=None, chunk_size=5000):
+    """Recalculate the scores of the links returned by links_query, or of every link if it is None, and write them
+    back with bulk updates. Returns the number of links scored.
+    """
+    links_query = links_query if links_query is not None else session.query(LinkedProducts)
+    pairs = links_query.with_entities(LinkedProducts.amz_listing_id, LinkedProducts.vnd_listing_id).all()
+
+    scorer = LinkScorer()
+    for i in range(0, len(pairs), chunk_size):
+        chunk = pairs[i:i + chunk_size]
+        scorer.load(session, [listing_id for pair in chunk for listing_id in pair])
+
+        mappings = []
+        for (amz_id, vnd_id), (brand, model, title, confidence) in zip(chunk, scorer.score(chunk)):
+            mappings.append({'amz_listing_id': amz_id,
+                             'vnd_listing_id': vnd_id,
+                             'brand_match': brand,
+                             'model_match': model,
+                             'title_match': title,
+                             'confidence': confidence})
+
+        session.bulk_update_mappings(LinkedProducts, mappings)
+
+    return len(pairs)
@@ -0,0 +1,120 @@
+import unittest
+
+from database import *
+from matching import CandidateIndex, link_candidates, model_tokens, normalize_brand, normalize_upc
+
+
+class NormalizeTest(unittest.TestCase):
+    """Test the normalization used to build blocking keys."""
+
+    def test_upc(self):
+        self.assertEqual(normalize_upc('0012-3456 7890'), '1234567890')
+        self.assertEqual(normalize_upc(12345), '12345')
+        self.assertIsNone(normalize_upc('000'))
+        self.assertIsNone(normalize_upc(None))
+
+    def test_brand(self):
+        self.assertEqual(normalize_brand('  Acme,  Inc. '), normalize_brand('acme inc'))
+        self.assertEqual(normalize_brand(None), '')
+
+    def test_model_tokens(self):
+        self.assertTrue(model_tokens('AB-1234') & model_tokens('ab1234'))
+        self.assertIn('1234', model_tokens('AB 1234'))
+
+        # Tokens need a digit and at least three characters
+        self.assertEqual(model_tokens('XL'), set())
+        self.assertEqual(model_tokens('A1'), set())
+
+    def test_model_tokens_from_title(self):
+        self.assertIn('x500', model_tokens(None, 'Acme X500 Widget'))
+        self.assertNotIn('x500', model_tokens('Y200', 'Acme X500 Widget'))
+
+
+class CandidateIndexTest(unittest.TestCase):
+    """Test which listings CandidateIndex proposes as candidates."""
+
+    def setUp(self):
+        self.index = CandidateIndex()
+        self.index.load([(1, 'Acme', 'AB-1234', None, 'Acme widget'),
+                         (2, 'Acme', 'CD-5678', '0001234567890', 'Acme gadget'),
+                         (3, 'Other', 'AB-1234', None, 'Other widget'),
+                         (4, None, None, None, 'Widget model X500')])
+
+    def test_brand_and_model(self):
+        self.assertEqual(self.index.candidates('ACME', 'ab1234', None), {1})
+        self.assertEqual(self.index.candidates('Other', 'AB 1234', None), {3})
+
+    def test_upc(self):
+        # Matching UPCs are candidates, whatever the brand and model
+        self.assertEqual(self.index.candidates('Unknown', 'ZZ-9999', '1234567890'), {2})
+
+    def test_title(self):
+        self.assertEqual(self.index.candidates(None, None, None, 'Replacement for X500'), {4})
+        self.assertEqual(self.index.candidates('Acme', None, None, 'New AB-1234 widget'), {1})
+
+    def test_no_keys(self):
+        self.assertEqual(self.index.candidates('Acme', None, None), set())
+        self.assertEqual(self.index.candidates('Acme', 'QQ-0000', None), set())
+
+    def test_load(self):
+        self.assertEqual(self.index.loaded_id, 4)
+
+        # Listings added one at a time don't count as loaded
+        self.index.add(10, 'Acme', 'EF-1111', None)
+        self.assertEqual(self.index.loaded_id, 4)
+        self.assertEqual(self.index.candidates('Acme', 'EF-1111', None), {10})
+
+
+class LinkCandidatesTest(unittest.TestCase):
+    """Test link_candidates() against Amazon listings in an in-memory database."""
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+
+        self.session.add(Vendor(id=0, name='Amazon'))
+        self.vendor = Vendor(name='Vendor')
+        self.session.add(self.vendor)
+        self.session.flush()
+
+        self.match = AmazonListing(vendor_id=0, sku='B000000001', brand='Acme', model='AB-1234',
+                                   title='Acme AB-1234 Cordless Drill')
+        self.same_upc = AmazonListing(vendor_id=0, sku='B000000002', brand='Zenith', model='ZZ-9',
+                                      title='Zenith garden hose', upc='1234567890')
+        self.unrelated = AmazonListing(vendor_id=0, sku='B000000003', brand='Acme', model='CD-5678',
+                                       title='Acme CD-5678 Cordless Drill')
+        self.vnd_listing = VendorListing(vendor_id=self.vendor.id, sku='V1', brand='Acme', model='AB1234',
+                                         title='Acme AB1234 cordless drill', upc='001234567890')
+        self.session.add_all([self.match, self.same_upc, self.unrelated, self.vnd_listing])
+        self.session.commit()
+
+        self.index = CandidateIndex.for_amazon(self.session)
+
+    def tearDown(self):
+        self.session.close()
+
+    def test_index_has_only_amazon_listings(self):
+        self.assertEqual(self.index.loaded_id, self.unrelated.id)
+        self.assertEqual(self.index.candidates_for(self.vnd_listing), {self.match.id, self.same_upc.id})
+
+    def test_confidence_cutoff(self):
+        links = link_candidates(self.session, self.index, self.vnd_listing, min_confidence=80)
+        self.session.commit()
+
+        self.assertEqual([link.amz_listing_id for link in links], [self.match.id])
+        self.assertGreaterEqual(links[0].confidence, 80)
+
+        # Candidates below the cutoff aren't saved
+        self.assertEqual(self.session.query(LinkedProducts.amz_listing_id).all(), [(self.match.id,)])
+
+    def test_no_candidates(self):
+        vnd_listing = VendorListing(vendor_id=self.vendor.id, sku='V2', brand='Nobody', model='QQ-0000')
+        self.session.add(vnd_listing)
+        self.session.flush()
+
+        self.assertEqual(link_candidates(self.session, self.index, vnd_listing, min_confidence=0), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
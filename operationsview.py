@@ -1,3 +1,6 @@
+import time
+from collections import deque
+
 from PyQt5.QtCore import QTimer
 from PyQt5.QtWidgets import QMessageBox, QWidget
 
@@ -7,10 +10,14 @@ from operations import OperationsManager, Operation
 from baseview import BaseView
 from operationsview_ui import Ui_operationsView
 from dialogs import OperationDialog
+from margins import test_margins
 
 
 class OperationsView(BaseView, Ui_operationsView):
 
+    # Number of seconds of history used to measure throughput
+    throughput_window = 5 * 60
+
     def __init__(self, parent=None):
         super(OperationsView, self).__init__(parent=parent)
         self.setupUi(self)
@@ -31,6 +38,7 @@ class OperationsView(BaseView, Ui_operationsView):
         self.actionPause.triggered.connect(self.opsman.stop)
         self.actionNew_batch.triggered.connect(self.new_batch_operation)
 
+        self.samples = deque()
         self.update_counts()
 
         self.update_timer = QTimer(self)
@@ -38,23 +46,41 @@ class OperationsView(BaseView, Ui_operationsView):
         self.update_timer.start(5000)
 
     def update_counts(self):
-        pending = self.dbsession.query(Operation).filter(and_(Operation.complete == False, Operation.error == False)).count()
-        completed = self.dbsession.query(Operation).filter(Operation.complete == True).count()
-        errors = self.dbsession.query(Operation).filter(Operation.error == True).count()
+        counts = self.dbsession.query(OperationCount).all()
+        now = time.monotonic()
 
-        est_time = 0
-        for op_name in self.opsman.supported_ops:
-            num = self.dbsession.query(Operation).\
-                                 filter(and_(Operation.complete == False, Operation.error == False)).\
-                                 filter(Operation.operation == op_name).\
-                                 count()
+        pending = sum(c.pending for c in counts)
+        completed = sum(c.complete for c in counts)
+        errors = sum(c.error for c in counts)
+
+        # Keep a few minutes of samples, to measure how quickly each type of operation is being finished
+        self.samples.append((now, {c.operation: c.complete + c.error for c in counts}))
+        while now - self.samples[0][0] > self.throughput_window:
+            self.samples.popleft()
 
-            est_time += num * self.opsman.get_wait(op_name, -1)
+        start_time, start_finished = self.samples[0]
+        elapsed = now - start_time
+
+        est_time = 0
+        measured = True
+        for count in counts:
+            if not count.pending:
+                continue
+
+            finished = count.complete + count.error - start_finished.get(count.operation, 0)
+            if finished > 0:
+                est_time += count.pending * elapsed / finished
+            else:
+                measured = False
 
         self.pendingBox.setValue(pending)
         self.completedBox.setValue(completed)
         self.errorBox.setValue(errors)
 
+        if not measured:
+            self.timeRemaining.setText('Unknown')
+            return
+
         m, s = divmod(est_time, 60)
         h, m = divmod(m, 60)
 
@@ -73,7 +99,7 @@ class OperationsView(BaseView, Ui_operationsView):
             query = self.dbsession.query(Listing).filter(Listing.vendor_id != 0)
         else:
             vendor_id = self.dbsession.query(Vendor.id).filter_by(name=source).scalar()
-            if vendor_id:
+            if vendor_id is not None:
                 query = self.dbsession.query(Listing).filter_by(vendor_id=vendor_id)
             else:
                 list_id = self.dbsession.query(List.id).filter_by(name=source).scalar()
@@ -88,6 +114,16 @@ class OperationsView(BaseView, Ui_operationsView):
         if dialog.filter_price:
             query = query.filter(Listing.price.between(dialog.min_price, dialog.max_price))
 
+        # Margins can be tested in bulk; only the listings that need fee estimates get an operation
+        if dialog.operation == 'TestMargins':
+            added, queued = test_margins(self.dbsession, query.with_entities(Listing.id), dialog.params)
+            self.dbsession.commit()
+            self.update_counts()
+
+            QMessageBox.information(self, 'Test margins', '%s listings added to \'%s\'. %s listings queued for fee '
+                                                          'estimates.' % (added, dialog.params['list'], queued))
+            return
+
         # Add to the operation table
         for row in query:
             op = Operation.GenericOperation(operation=dialog.operation,
@@ -107,11 +143,15 @@ class OperationsView(BaseView, Ui_operationsView):
     def on_clear_completed(self):
         if QMessageBox.question(self, 'Confirm', 'Delete all completed operations?') == QMessageBox.Yes:
             self.dbsession.query(Operation).filter_by(complete=True, error=False).delete()
+            self.dbsession.query(OperationArchive).filter_by(complete=True, error=False).delete()
             self.dbsession.commit()
+            self.samples.clear()
             self.update_counts()
 
     def on_clear_errors(self):
         if QMessageBox.question(self, 'Confirm', 'Delete all failed operations?') == QMessageBox.Yes:
             self.dbsession.query(Operation).filter_by(error=True).delete()
+            self.dbsession.query(OperationArchive).filter_by(error=True).delete()
             self.dbsession.commit()
+            self.samples.clear()
             self.update_counts()
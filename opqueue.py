@@ -0,0 +1,74 @@
+import heapq
+
+
+class OperationQueue:
+    """An in-memory index of the pending operations. Keeps one heap of (scheduled, id) for each operation type and
+    priority, so the next operation to run can be found without querying the database. Entries that have been
+    changed or removed are left in the heaps, and skipped when they reach the top.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._heaps = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, op_id):
+        return op_id in self._entries
+
+    def clear(self):
+        """Remove all operations from the queue."""
+        self._entries = {}
+        self._heaps = {}
+
+    def push(self, op_id, operation, priority, scheduled):
+        """Add an operation to the queue, or update its position if it's already there."""
+        entry = (operation, priority, scheduled)
+        if self._entries.get(op_id) == entry:
+            return
+
+        self._entries[op_id] = entry
+        heap = self._heaps.setdefault(operation, {}).setdefault(priority, [])
+        heapq.heappush(heap, (scheduled, op_id))
+
+    def discard(self, op_id):
+        """Remove an operation from the queue, if it's there."""
+        self._entries.pop(op_id, None)
+
+    def next(self, operation, min_priority, now):
+        """Return the id of the next operation of the given type with a priority of at least min_priority. This is
+        the highest-priority operation that is overdue, or if nothing is overdue, the one scheduled soonest.
+        """
+        heaps = self._heaps.get(operation, {})
+        soonest = None
+
+        for priority in sorted(heaps, reverse=True):
+            if priority < min_priority:
+                break
+
+            top = self._top(operation, priority)
+            if top is None:
+                continue
+
+            scheduled, op_id = top
+            if scheduled <= now:
+                return op_id
+            elif soonest is None or scheduled < soonest[0]:
+                soonest = top
+
+        return soonest[1] if soonest is not None else None
+
+    def _top(self, operation, priority):
+        """Return the first valid entry in the given heap, dropping any stale ones on top of it."""
+        heap = self._heaps[operation][priority]
+
+        while heap:
+            scheduled, op_id = heap[0]
+            if self._entries.get(op_id) == (operation, priority, scheduled):
+                return heap[0]
+
+            heapq.heappop(heap)
+
+        del self._heaps[operation][priority]
+        return None
@@ -0,0 +1,88 @@
+import unittest
+from datetime import datetime, timedelta
+
+from opqueue import OperationQueue
+
+
+class OperationQueueTest(unittest.TestCase):
+    """Test the order that OperationQueue.next() returns operations in."""
+
+    now = datetime(2020, 1, 1, 12)
+
+    def setUp(self):
+        self.queue = OperationQueue()
+
+    def at(self, minutes):
+        return self.now + timedelta(minutes=minutes)
+
+    def test_empty(self):
+        self.assertIsNone(self.queue.next('UpdateAmazonListing', 0, self.now))
+        self.assertEqual(len(self.queue), 0)
+
+    def test_overdue_by_priority(self):
+        self.queue.push(1, 'UpdateAmazonListing', 0, self.at(-10))
+        self.queue.push(2, 'UpdateAmazonListing', 10, self.at(-1))
+        self.queue.push(3, 'UpdateAmazonListing', 10, self.at(-5))
+
+        self.assertEqual(self.queue.next('UpdateAmazonListing', 0, self.now), 3)
+
+    def test_overdue_before_soonest(self):
+        self.queue.push(1, 'UpdateAmazonListing', 10, self.at(1))
+        self.queue.push(2, 'UpdateAmazonListing', 0, self.at(-1))
+
+        self.assertEqual(self.queue.next('UpdateAmazonListing', 0, self.now), 2)
+
+    def test_soonest(self):
+        self.queue.push(1, 'UpdateAmazonListing', 10, self.at(5))
+        self.queue.push(2, 'UpdateAmazonListing', 0, self.at(2))
+
+        self.assertEqual(self.queue.next('UpdateAmazonListing', 0, self.now), 2)
+
+    def test_min_priority(self):
+        self.queue.push(1, 'UpdateAmazonListing', 0, self.at(-10))
+        self.queue.push(2, 'UpdateAmazonListing', 10, self.at(5))
+
+        self.assertEqual(self.queue.next('UpdateAmazonListing', 10, self.now), 2)
+        self.assertIsNone(self.queue.next('UpdateAmazonListing', 20, self.now))
+
+    def test_operation_types(self):
+        self.queue.push(1, 'UpdateAmazonListing', 0, self.at(-10))
+        self.queue.push(2, 'TestMargins', 0, self.at(-1))
+
+        self.assertEqual(self.queue.next('TestMargins', 0, self.now), 2)
+        self.assertIsNone(self.queue.next('SearchAmazon', 0, self.now))
+
+    def test_stale_entries(self):
+        self.queue.push(1, 'UpdateAmazonListing', 0, self.at(-10))
+        self.queue.push(2, 'UpdateAmazonListing', 0, self.at(-5))
+        self.queue.push(3, 'UpdateAmazonListing', 0, self.at(-1))
+
+        # Rescheduled and removed operations are skipped
+        self.queue.push(1, 'UpdateAmazonListing', 0, self.at(30))
+        self.queue.discard(2)
+
+        self.assertEqual(len(self.queue), 2)
+        self.assertNotIn(2, self.queue)
+        self.assertEqual(self.queue.next('UpdateAmazonListing', 0, self.now), 3)
+
+        self.queue.discard(3)
+        self.assertEqual(self.queue.next('UpdateAmazonListing', 0, self.now), 1)
+
+    def test_changed_priority(self):
+        self.queue.push(1, 'UpdateAmazonListing', 0, self.at(-10))
+        self.queue.push(2, 'UpdateAmazonListing', 5, self.at(-1))
+        self.queue.push(1, 'UpdateAmazonListing', 10, self.at(-10))
+
+        self.assertEqual(self.queue.next('UpdateAmazonListing', 0, self.now), 1)
+        self.assertIsNone(self.queue.next('UpdateAmazonListing', 20, self.now))
+
+    def test_clear(self):
+        self.queue.push(1, 'UpdateAmazonListing', 0, self.at(-10))
+        self.queue.clear()
+
+        self.assertEqual(len(self.queue), 0)
+        self.assertIsNone(self.queue.next('UpdateAmazonListing', 0, self.now))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,993 @@
+import arrow
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import datetime, timedelta
+import amazonmws as mws
+import mwskeys, pakeys
+
+from itertools import chain
+
+from responseparser import ListMatchingProductsParser, ErrorResponseParser, GetLowestOfferListingsForASINParser
+from responseparser import GetMyFeesEstimateParser, GetCompetitivePricingForASINParser, ItemLookupParser
+from responseparser import ParseError
+from requestengine import RequestEngine
+from opqueue import OperationQueue
+from matching import CandidateIndex, link_candidates
+from margins import best_unit_costs
+
+from database import *
+import dbhelpers
+import historystore
+
+from sqlalchemy import case
+from sqlalchemy.event import listen
+
+
+logger = logging.getLogger(__name__)
+
+
+class OperationsEngine:
+    """Processes the operations in the database. Doesn't depend on Qt: operations are scheduled and run on the
+    current asyncio event loop. Subclasses can override notify_status() and notify_complete() to observe progress.
+    """
+
+    supported_ops = ['TestMargins', 'FindAmazonMatches', 'GetMyFeesEstimate', 'UpdateAmazonListing', 'SearchAmazon']
+
+    # The maximum number of operations of a given type that can be sent in a single request. ItemLookup accepts up
+    # to 10 ItemId's, GetLowestOfferListingsForASIN up to 20 ASINs, and GetMyFeesEstimate up to 20 fee requests.
+    batch_sizes = {'UpdateAmazonListing': 10,
+                   'GetMyFeesEstimate': 20,
+                   'TestMargins': 20}
+
+    # How long a worker may hold a claim on an operation before others can take it over
+    lease_time = timedelta(minutes=10)
+
+    # How often, in seconds, to check for operations added or released by other workers
+    poll_interval = 30
+
+    # How often, in seconds, to move finished operations into the archive
+    archive_interval = 60 * 60
+
+    # Product history older than this is moved into compact storage. Sales estimates are calculated from the
+    # uncompacted history, so this should be more than 90 days
+    history_retention = timedelta(days=91)
+
+    # How many listings' history to compact at a time, so the event loop isn't blocked for long
+    compact_listings = 50
+
+    # How often, in seconds, to rebuild the index of Amazon listings used to find matches locally
+    match_index_interval = 60 * 60
+
+    # FindAmazonMatches links local candidates with at least this confidence, if linkif doesn't give one
+    local_match_confidence = 80
+
+    def __init__(self, mws_keys=mwskeys, pa_keys=pakeys, worker_id=None, retention=timedelta(days=1),
+                 compact=False):
+        self.loop = asyncio.get_event_loop()
+        self.dbsession = Session()
+        self.worker_id = worker_id or '%s-%s-%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.retention = retention
+        self.request_engine = RequestEngine()
+        self.queue = OperationQueue()
+        self.scheduled = {}
+        self.in_flight = set()
+        self.running = False
+        self.closed = False
+        self._callbacks = {}
+        self._tasks = set()
+        self._restart = None
+        self._poll = None
+        self._archive = None
+        self._compact = None
+        self._match_index = None
+        self._match_index_built = None
+        self._touched = set()
+        self._reload = False
+
+        listen(self.dbsession, 'after_flush', self._after_flush_listener)
+        listen(self.dbsession, 'after_bulk_delete', self._after_bulk_delete_listener)
+        listen(self.dbsession, 'after_commit', self._after_commit_listener)
+        listen(self.dbsession, 'after_rollback', self._after_rollback_listener)
+
+        # Set up the Amazon api's and throttling managers
+        self.mwsapi = mws.Throttler(mws.Products(mws_keys.accesskey, mws_keys.secretkey, mws_keys.sellerid),
+                                    limits=mws.PRODUCTS_LIMITS,
+                                    blocking=True)
+        self.paapi = mws.Throttler(mws.ProductAdvertising(pa_keys.accesskey, pa_keys.secretkey, pa_keys.associatetag),
+                                   limits=mws.PRODUCT_ADVTERTISING_LIMITS,
+                                   blocking=True)
+
+        self.request_engine.bind(self.mwsapi)
+        self.request_engine.bind(self.paapi)
+
+        # Set the priority limits
+        for operation in self.mwsapi.limits:
+            self.mwsapi.set_priority_quota(operation, priority=0, quota=self.mwsapi.limits[operation].quota_max - 2)
+            self.mwsapi.set_priority_quota(operation, priority=10, quota=2)
+
+        # Schedule the next operations, and keep an eye out for changes made by other workers
+        self.poll()
+        self.archive()
+
+        # Only one process needs to compact the history, and it shouldn't be the GUI
+        if compact:
+            self.compact_history()
+
+    def register_callback(self, op, callback):
+        self._callbacks[op] = callback
+
+    def notify_status(self, message):
+        """Called with a status message whenever something happens. Logs the message by default."""
+        logger.info(message)
+
+    def notify_complete(self, op):
+        """Called when an operation has been completed."""
+
+    def _after_flush_listener(self, session, flush_context):
+        """Remember any Operations that were added, modified or deleted, so the queue can be updated on commit."""
+        for item in chain(session.new, session.dirty, session.deleted):
+            if isinstance(item, Operation):
+                self._touched.add(item.id)
+
+    def _after_bulk_delete_listener(self, update_context):
+        """Operations deleted with Query.delete() don't show up in the flush, so reload the whole queue."""
+        if update_context.mapper.class_ is Operation:
+            self._reload = True
+
+    def _after_commit_listener(self, session):
+        """Update the queue once the session is free to run queries again."""
+        if self._touched or self._reload:
+            self.loop.call_soon(self.refresh_queue)
+
+    def _after_rollback_listener(self, session):
+        self._touched = set()
+
+    def start(self):
+        """Starts processing operations in the database."""
+        if self._restart is not None:
+            self._restart.cancel()
+            self._restart = None
+
+        self.notify_status('Begin processing operations...')
+        self.running = True
+        self.load_next()
+
+    def stop(self):
+        """Remove all pending operations from the queue."""
+        self.notify_status('Stopping all operations.')
+        self.running = False
+
+        for handle, op in self.scheduled.values():
+            handle.cancel()
+        self.scheduled = {}
+
+    def pause(self, seconds):
+        """Stop processing operations, and start again after the given number of seconds."""
+        self.stop()
+
+        if self._restart is not None:
+            self._restart.cancel()
+        self._restart = self.loop.call_later(seconds, self.start)
+
+    async def shutdown(self):
+        """Stop scheduling operations, and wait for the ones already in progress to finish."""
+        self.closed = True
+
+        if self._restart is not None:
+            self._restart.cancel()
+            self._restart = None
+
+        for handle in (self._poll, self._archive, self._compact):
+            if handle is not None:
+                handle.cancel()
+        self._poll = self._archive = self._compact = None
+
+        self.stop()
+
+        if self._tasks:
+            await asyncio.wait(self._tasks)
+
+        self.dbsession.close()
+        self.request_engine.shutdown()
+
+    def poll(self):
+        """Release expired claims and reload the queue, then call again after poll_interval seconds. Operations
+        added by other processes don't trigger our session events, so this is how we find out about them.
+        """
+        self.recover_leases()
+        self.reload_queue()
+        self.load_next()
+        self._poll = self.loop.call_later(self.poll_interval, self.poll)
+
+    def archive(self):
+        """Move finished operations older than self.retention into the archive, then call again after
+        archive_interval seconds. A retention of None keeps everything in the operations table.
+        """
+        if self.retention is None:
+            return
+
+        archived = dbhelpers.archive_operations(self.dbsession, self.retention)
+        self.dbsession.commit()
+
+        if archived:
+            self.notify_status('%s: archived %s finished operations.' % (time.asctime(), archived))
+
+        self._archive = self.loop.call_later(self.archive_interval, self.archive)
+
+    def compact_history(self):
+        """Move the product history of up to compact_listings listings into compact storage. Call again as soon as
+        the event loop is free if there is more to do, otherwise after archive_interval seconds.
+        """
+        try:
+            compacted = historystore.compact(self.dbsession, datetime.utcnow() - self.history_retention,
+                                             limit=self.compact_listings)
+            self.dbsession.commit()
+        except Exception:
+            logger.exception('Could not compact product history.')
+            self.dbsession.rollback()
+            compacted = 0
+
+        if compacted:
+            self.notify_status('%s: compacted %s product history entries.' % (time.asctime(), compacted))
+            self._compact = self.loop.call_soon(self.compact_history)
+        else:
+            self._compact = self.loop.call_later(self.archive_interval, self.compact_history)
+
+    def recover_leases(self):
+        """Release the claims on any unfinished operations whose lease has expired."""
+        recovered = self.dbsession.query(Operation).\
+                                   filter(Operation.complete == False,
+                                          Operation.error == False,
+                                          Operation.lease_expires < datetime.utcnow()).\
+                                   update({Operation.claimed_by: None, Operation.lease_expires: None},
+                                          synchronize_session=False)
+
+        if recovered:
+            self.dbsession.commit()
+            self.notify_status('%s: recovered %s operations from expired leases.' % (time.asctime(), recovered))
+
+    def pending_ops(self):
+        """Return a query for the id, operation, priority and scheduled time of operations waiting to be run."""
+        return self.dbsession.query(Operation.id, Operation.operation, Operation.priority, Operation.scheduled).\
+                              filter(Operation.operation.in_(self.supported_ops),
+                                     Operation.complete == False,
+                                     Operation.error == False,
+                                     or_(Operation.claimed_by == None,
+                                         Operation.lease_expires < datetime.utcnow()))
+
+    def reload_queue(self):
+        """Rebuild the queue from the database."""
+        self._reload = False
+        self._touched = set()
+
+        self.queue.clear()
+        for row in self.pending_ops():
+            self.queue.push(*row)
+
+    def refresh_queue(self):
+        """Update the queue entries of the operations changed since the last commit, then reschedule."""
+        if self.closed:
+            return
+
+        if self._reload:
+            self.reload_queue()
+        else:
+            touched, self._touched = list(self._touched), set()
+
+            # Keep under SQLite's limit on query parameters
+            for i in range(0, len(touched), 500):
+                chunk = touched[i:i + 500]
+                for op_id in chunk:
+                    self.queue.discard(op_id)
+
+                for row in self.pending_ops().filter(Operation.id.in_(chunk)):
+                    self.queue.push(*row)
+
+        self.load_next()
+
+    def load_next(self):
+        """Load and schedule the next operation of each type listed in self.supported_ops."""
+        # Nothing is scheduled while shutting down or paused
+        if self.closed or self._restart is not None:
+            return
+
+        if self.running:
+            min_priority = 0
+        else:
+            min_priority = 1
+
+        now = datetime.utcnow()
+
+        for op_name in self.supported_ops:
+            # Operations being processed are re-scheduled when they finish
+            if op_name in self.in_flight:
+                continue
+
+            # Get the highest-priority overdue op, or if nothing is overdue, the one scheduled soonest
+            next_op = None
+            while next_op is None:
+                op_id = self.queue.next(op_name, min_priority, now)
+                if op_id is None:
+                    break
+
+                next_op = self.dbsession.query(Operation).get(op_id)
+                if next_op is None:
+                    self.queue.discard(op_id)
+
+            # If no more ops of this type, skip to the next one
+            if next_op is None:
+                continue
+
+            # Make sure only one operation of this type is scheduled at a time
+            if op_name in self.scheduled:
+                handle, sched_op = self.scheduled.pop(op_name)
+                handle.cancel()
+
+            self.schedule_op(next_op)
+
+    def schedule_op(self, op, wait=None):
+        """Get the required wait and schedule a call to run the given operation."""
+        if wait is None:
+            # Get next available time from the throttler
+            throttled_wait = self.get_wait(op.operation, op.priority)
+
+            delta = op.scheduled - arrow.utcnow().naive
+            scheduled_wait = delta.total_seconds()
+
+            wait = max(throttled_wait, scheduled_wait, 0)
+
+        # Schedule the call
+        handle = self.loop.call_later(wait * 1.1, self.run_scheduled, op.operation)
+        self.scheduled[op.operation] = (handle, op)
+
+    def get_wait(self, operation, priority):
+        """Return the wait time, in seconds, before the given api_call can be executed. If priority is negative,
+        return the restore rate of the operation.
+        """
+        if operation == 'FindAmazonMatches':
+            return self.mwsapi.request_wait('ListMatchingProducts', priority) if priority >= 0 else \
+                   self.mwsapi.limits['ListMatchingProducts'].restore_rate
+
+        elif operation == 'TestMargins' or operation == 'GetMyFeesEstimate':
+            return self.mwsapi.request_wait('GetMyFeesEstimate', priority) if priority >= 0 else \
+                   self.mwsapi.limits['GetMyFeesEstimate'].restore_rate
+
+        elif operation == 'UpdateAmazonListing':
+            if priority >= 0:
+                return self.paapi.request_wait('ItemLookup', priority) \
+                       + self.mwsapi.request_wait('GetLowestOfferListingsForASIN', priority)
+            else:
+                return self.paapi.limits['ItemLookup'].restore_rate \
+                       + self.mwsapi.limits['GetLowestOfferListingsForASIN'].restore_rate
+
+        elif operation == 'SearchAmazon':
+            return self.mwsapi.request_wait('ListMatchingProducts', priority) if priority >= 0 else \
+                   self.mwsapi.limits['ListMatchingProducts'].restore_rate
+
+        else:
+            if priority >= 0:
+                return max(self.mwsapi.request_wait(operation, priority), self.paapi.request_wait(operation, priority))
+            else:
+                return max(getattr(self.mwsapi.limits, operation, 0), getattr(self.paapi.limits, operation, 0))
+
+    def run_scheduled(self, op_name):
+        """Start the operation scheduled for the given operation type."""
+        handle, op = self.scheduled.pop(op_name)
+
+        # If the op was deleted just load the next one
+        try:
+            op.id
+        except ObjectDeletedError:
+            self.load_next()
+            return
+
+        # Handle the operation, along with any others that can share the same request
+        handler = getattr(self, op.operation, None)
+        if handler is None:
+            op.error = True
+            op.message = 'No handler found.'
+            self.dbsession.commit()
+
+            self.notify_status('%s: \'%s\', priority=%s, error: No handler found.' %
+                               (time.asctime(), op.operation, op.priority))
+            return
+
+        # Another worker might have got to it first. Either way, it's no longer waiting in our queue
+        ops = self.claim_batch(op)
+        self.queue.discard(op.id)
+        for claimed in ops:
+            self.queue.discard(claimed.id)
+
+        if not ops:
+            self.load_next()
+            return
+
+        task = asyncio.ensure_future(self.process(handler, ops))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def process(self, handler, ops):
+        """Run the handler coroutine on a batch of operations, then commit and report the results. Operations of
+        other types can be processed while this one waits on the network.
+
+        All of the handlers share self.dbsession, which other batches commit while a handler is waiting. So handlers
+        must not change anything in the session until after their last await; otherwise, a half-finished update
+        could be committed, or rolled back along with another batch's error.
+        """
+        op_name = ops[0].operation
+        self.in_flight.add(op_name)
+
+        try:
+            await handler(*ops)
+        except Exception as e:
+            logger.exception('%s failed.', op_name)
+            self.dbsession.rollback()
+
+            if isinstance(e, ParseError):
+                message = 'Could not parse response: %s' % e
+            else:
+                message = '%s: %s' % (type(e).__name__, e)
+
+            for op in ops:
+                op.error = True
+                op.message = message
+        finally:
+            self.in_flight.discard(op_name)
+
+            for op in ops:
+                op.claimed_by = None
+                op.lease_expires = None
+
+        self.dbsession.commit()
+
+        for op in ops:
+            self.report(op)
+
+    def claim_batch(self, op):
+        """Claim op, along with any other overdue operations of the same type and priority that can share its
+        request, up to the limit given in self.batch_sizes. The claim is made in a single UPDATE, so two workers
+        can't claim the same operation. Returns the claimed operations, starting with op if we got it.
+        """
+        now = datetime.utcnow()
+        expires = now + self.lease_time
+        batch_size = self.batch_sizes.get(op.operation, 1)
+        lead_first = case([(Operation.id == op.id, 0)], else_=1)
+
+        claimable = and_(Operation.complete == False,
+                         Operation.error == False,
+                         or_(Operation.claimed_by == None,
+                             Operation.lease_expires < now))
+
+        candidates = self.dbsession.query(Operation.id).\
+                                    filter(claimable,
+                                           or_(Operation.id == op.id,
+                                               and_(Operation.operation == op.operation,
+                                                    Operation.priority == op.priority,
+                                                    Operation.scheduled <= now))).\
+                                    order_by(lead_first, Operation.scheduled).\
+                                    limit(batch_size)
+
+        claimed = self.dbsession.query(Operation).\
+                                 filter(Operation.id.in_(candidates.subquery()), claimable).\
+                                 update({Operation.claimed_by: self.worker_id, Operation.lease_expires: expires},
+                                        synchronize_session=False)
+
+        # Commit straight away, so other workers can see the claim
+        self.dbsession.commit()
+
+        if not claimed:
+            return []
+
+        return self.dbsession.query(Operation).\
+                              filter(Operation.claimed_by == self.worker_id,
+                                     Operation.lease_expires == expires).\
+                              order_by(lead_first, Operation.scheduled).\
+                              all()
+
+    def report(self, op):
+        """Call any callbacks registered for op, and send the appropriate notifications."""
+        if (op.complete or op.error) and op in self._callbacks:
+            self._callbacks.pop(op)(op)
+
+        status_message = '%s: \'%s\', priority=%s' % (time.asctime(), op.operation, op.priority)
+
+        if op.complete:
+            status_message += ': %s' % (op.message or 'complete.')
+            self.notify_complete(op)
+        elif op.error:
+            status_message += ', error: %s' % op.message
+        else:
+            status_message += ': %s' % (op.message or '')
+
+        self.notify_status(status_message)
+
+    def is_error_response(self, reply, *ops):
+        """Test if the response is an error, and take appropriate action for each of the operations it was sent for."""
+        status_code = reply.status_code
+
+        if status_code == 200:
+            return False
+
+        # Try to parse the error response, if there is one
+        msg = 'Status code %s, ' % status_code
+        try:
+            parser = ErrorResponseParser(reply.content)
+            msg += '%s - %s' % (parser.code, parser.message)
+        except ParseError:
+            msg += 'no parsable response.'
+
+        # 400 usually means an invalid parameter
+        if status_code in [400]:
+            for op in ops:
+                op.error = True
+        # 401, 403, 404 means there was a problem with the keys, signature, or address used
+        elif status_code in [401, 403, 404]:
+            self.stop()
+        # 500 or 503 usually means internal service error or throttling
+        elif status_code in [500, 503]:
+            self.pause(5 * 60)
+        # Connection reset, timed out, network session failure, etc
+        elif reply.network_error:
+            self.pause(15 * 60)
+            msg += ' Connection reset, timed out, or service unavailable. Waiting 15 minutes.'
+        # Anything else (429, 502, a bad redirect or encoding...) won't be fixed by trying again right away
+        else:
+            self.pause(5 * 60)
+            if reply.exception is not None:
+                msg += ' %s: %s.' % (type(reply.exception).__name__, reply.exception)
+            msg += ' Waiting 5 minutes.'
+
+        for op in ops:
+            op.message = msg
+
+        return True
+
+    async def TestMargins(self, *ops):
+        """Look at the potential profit margin for a listing, based on available sources. Add the listing to a list
+        if the margin meets a minimum threshold. Fee estimates needed by several operations are requested together; if
+        one can't be had, the fees are taken to be 25% of the price.
+
+        Parameters:         confidence=     The minimum confidence level for sources to be considered.
+                            threshold=      The minimum profit margin to be added to the list.
+                            list=           The name of the list to add matches to.
+        """
+        candidates = []
+
+        # Get the lowest vendor costs for all of the listings at once, for each confidence level asked for
+        unit_costs = {}
+        for min_confidence in {op.params.get('confidence', 0) for op in ops}:
+            listing_ids = [op.listing_id for op in ops if op.params.get('confidence', 0) == min_confidence]
+            unit_costs[min_confidence] = dict(best_unit_costs(self.dbsession, listing_ids, min_confidence))
+
+        # Load the existing price points
+        price_points = {}
+        for price_point in self.dbsession.query(AmzPriceAndFees).\
+                                          filter(AmzPriceAndFees.amz_listing_id.in_([op.listing_id for op in ops])).\
+                                          order_by(AmzPriceAndFees.id):
+            price_points.setdefault((price_point.amz_listing_id, price_point.price), price_point)
+
+        rejected = []
+        for op in ops:
+            amz_listing = op.listing
+            params = op.params
+
+            if not amz_listing.price or not amz_listing.quantity:
+                rejected.append(op)
+                continue
+
+            vnd_unit_cost = unit_costs[params.get('confidence', 0)].get(amz_listing.id)
+
+            if vnd_unit_cost is None:
+                rejected.append(op)
+                continue
+
+            # Test the margin based solely on cost
+            cost = vnd_unit_cost * amz_listing.quantity
+            profit = amz_listing.price - cost
+
+            if profit / cost < params['threshold']:
+                rejected.append(op)
+                continue
+
+            candidates.append((op, vnd_unit_cost))
+
+        # Now get fees for any price points that don't have them
+        def has_fees(op):
+            price_point = price_points.get((op.listing.id, op.listing.price))
+            return price_point is not None and price_point.fba is not None
+
+        need_fees = [op for op, cost in candidates if not has_fees(op)]
+        if need_fees:
+            results = await self.get_fees_estimates(*need_fees)
+        else:
+            results = {}
+
+        # All of the requests have been made, so the results can be written to the session
+        for op in rejected:
+            op.complete = True
+
+        list_ids = {}
+        for op, vnd_unit_cost in candidates:
+            amz_listing = op.listing
+            params = op.params
+
+            price_point = price_points.get((amz_listing.id, amz_listing.price))
+            fba = price_point.fba if price_point is not None else None
+
+            if fba is None and results is not None:
+                fees = results.get(self.fees_identifier(amz_listing.sku, amz_listing.price))
+                if fees is not None and fees['status'] == 'Success':
+                    fba = fees['amount']
+
+                    # Only save a price point once there is a fee estimate to go with it
+                    if price_point is None:
+                        price_point = AmzPriceAndFees(amz_listing_id=amz_listing.id, price=amz_listing.price)
+                        price_points[amz_listing.id, amz_listing.price] = price_point
+                        self.dbsession.add(price_point)
+
+                    price_point.fba = fba
+                else:
+                    op.message = fees['errormessage'] if fees else \
+                                 'No fee estimate returned for ASIN %s.' % amz_listing.sku
+
+            # Without a fee estimate, assume the fees are 25% of the price
+            fba = fba or amz_listing.price * .25
+            prep = (price_point.prep or 0) if price_point is not None else 0
+            ship = (price_point.ship or 0) if price_point is not None else 0
+
+            # Calculate the margin
+            cost = vnd_unit_cost * amz_listing.quantity + prep + ship
+            profit = amz_listing.price - cost - fba
+
+            if profit / cost >= params['threshold']:
+                list_ids.setdefault(params['list'], []).append(amz_listing.id)
+
+            op.complete = True
+
+        # Add to the lists
+        for list_name, listing_ids in list_ids.items():
+            dbhelpers.add_ids_to_list(self.dbsession, listing_ids=listing_ids, list_name=list_name)
+
+    async def SearchAmazon(self, op):
+        """Find Amazon listings based on given search terms. Add the results to a list.
+
+        Parameters:     terms=      A string containing search terms.
+                        addtolist=  A list name to add results to.
+        """
+        params = op.params
+
+        r = await self.request_engine.call(self.mwsapi, 'ListMatchingProducts', priority=op.priority,
+                                           MarketplaceId=self.mwsapi.api.market_id(), Query=params['terms'])
+        if self.is_error_response(r, op):
+            return
+
+        parser = ListMatchingProductsParser(r.content)
+
+        for product in parser.products:
+            # Update the product's info
+            amz_listing = dbhelpers.get_or_create(self.dbsession, AmazonListing, sku=product.asin)
+            product.update(amz_listing)
+
+            # Update the product's category
+            category = dbhelpers.get_or_create_category(self.dbsession, product.product_category_id, product.product_group)
+            amz_listing.category = category
+
+            # Schedule an update to fill in the rest of the product info
+            self.dbsession.add(Operation.UpdateAmazonListing(listing=amz_listing, priority=op.priority))
+
+            # Add to list
+            if 'addtolist' in params:
+                add_list = dbhelpers.get_or_create(self.dbsession, List, name=params['addtolist'], is_amazon=True)
+                dbhelpers.get_or_create(self.dbsession, ListMembership, list=add_list, listing=amz_listing)
+
+        op.complete = True
+
+    async def FindAmazonMatches(self, op):
+        """Query Amazon for products matching a given listing.
+
+        Parameters:     linkif:         create a link only if the conditions are met
+                            conf=       match confidence greater than or equal to the given value.
+
+                        testmargins:    Create a TestMargins operation if the conditions are met.
+                            salesrank=  Maximum sales rank
+                            list=       The name of the list given to TestMargins
+                            threshold=  The minimum margin threshold given to TestMargins
+        """
+        vnd_listing = op.listing
+        params = op.params
+
+        # Try to find matches among the Amazon listings we already know about, and save the API call
+        if 'linkif' in params and 'conf' in params['linkif']:
+            min_confidence = float(params['linkif']['conf'])
+        else:
+            min_confidence = self.local_match_confidence
+
+        match_index = await self.get_match_index()
+        links = link_candidates(self.dbsession, match_index, vnd_listing, min_confidence)
+        if links:
+            if 'testmargins' in params:
+                for link in links:
+                    self.add_testmargins_op(link.amz_listing, link.amz_listing.salesrank, params, op.priority)
+
+            op.message = '%s links found locally.' % len(links)
+            op.complete = True
+            return
+
+        title = str(vnd_listing.title).replace(vnd_listing.brand, '').replace(vnd_listing.model, '').strip()
+        query = ' '.join([vnd_listing.brand, vnd_listing.model, title])
+
+        r = await self.request_engine.call(self.mwsapi, 'ListMatchingProducts', priority=op.priority,
+                                           MarketplaceId=self.mwsapi.api.market_id(), Query=query)
+        if self.is_error_response(r, op):
+            return
+
+        parser = ListMatchingProductsParser(r.content)
+
+        for product in parser.products:
+            # Update the product info
+            amz_listing = dbhelpers.get_or_create(self.dbsession, AmazonListing, sku=product.asin)
+            product.update(amz_listing)
+
+            # Update the product category
+            category = dbhelpers.get_or_create_category(self.dbsession, product.product_category_id, product.product_group)
+            amz_listing.category = category
+
+            # Create a link between the two listings. If it doesn't meet the criteria, expunge() it below.
+            link = dbhelpers.link_products(self.dbsession, amz=amz_listing, vnd=vnd_listing)
+
+            # Link criteria - it meets the threshold, or no threshold was provided
+            add_cond_1 = 'linkif' in params \
+                            and 'conf' in params['linkif'] \
+                            and link.confidence >= float(params['linkif']['conf'])
+            add_cond_2 = 'linkif' not in params
+
+            if add_cond_1 or add_cond_2:
+                # Test margins?
+                if 'testmargins' in params:
+                    self.add_testmargins_op(amz_listing, product.salesrank, params, op.priority)
+            else:
+                self.dbsession.expunge(link)
+
+            match_index.add(amz_listing.id, amz_listing.brand, amz_listing.model, amz_listing.upc,
+                                 amz_listing.title)
+
+        op.message = '%s links found.' % len(vnd_listing.amz_links)
+        op.complete = True
+
+    def add_testmargins_op(self, amz_listing, salesrank, params, priority):
+        """Queue an UpdateAmazonListing operation to test the margins of amz_listing, if it meets the salesrank
+        limit given in params['testmargins'].
+        """
+        if 'salesrank' not in params['testmargins'] \
+                or (salesrank and salesrank <= params['testmargins']['salesrank']):
+
+            update_op = Operation.UpdateAmazonListing(listing=amz_listing,
+                                                      params={'testmargins': params['testmargins']},
+                                                      priority=priority)
+            self.dbsession.add(update_op)
+
+    async def get_match_index(self):
+        """Return a CandidateIndex of the Amazon listings in the database. The first call builds it in a worker thread;
+        after that, listings added since the last load are added every match_index_interval seconds.
+        """
+        if self._match_index is None:
+            self._match_index_built = time.monotonic()
+            self._match_index = await self.in_new_session(CandidateIndex.for_amazon)
+        elif time.monotonic() - self._match_index_built > self.match_index_interval:
+            self._match_index_built = time.monotonic()
+            self._match_index.load(await self.in_new_session(CandidateIndex.amazon_rows, self._match_index.loaded_id))
+
+        return self._match_index
+
+    def in_new_session(self, func, *args):
+        """Call func(session, *args) in a worker thread, with a session of its own, so that long queries don't block
+        the event loop. Returns an awaitable of the result.
+        """
+        def run():
+            session = Session.session_factory()
+            try:
+                return func(session, *args)
+            finally:
+                session.close()
+
+        return self.loop.run_in_executor(None, run)
+
+    async def GetMyFeesEstimate(self, *ops):
+        """Get an FBA fees estimate for the given listings. Fees for all of the operations given are requested at the
+        same time.
+
+        Parameters:     price=  Update all price points at the given price. If not provided, update all price points
+                                at the current listing price. Create a new price point if none exist.
+
+                        fees=   Set the fees to the given value. If not provided, request fees from Amazon.
+        """
+        requested = [op for op in ops if self.fees_price(op) is not None and 'fees' not in op.params]
+        results = await self.get_fees_estimates(*requested) if requested else None
+
+        # All of the requests have been made, so the results can be written to the session
+        for op in ops:
+            params = op.params
+
+            if self.fees_price(op) is None:
+                op.error = True
+                op.message = 'No price given for ASIN %s.' % op.listing.sku
+            elif 'fees' in params:
+                self.set_fba_fees(op.listing, self.fees_price(op), float(params['fees']))
+                op.complete = True
+
+        if results is None:
+            return
+
+        for op in requested:
+            amz_listing = op.listing
+            price = self.fees_price(op)
+
+            fees = results.get(self.fees_identifier(amz_listing.sku, price))
+            if fees is None or fees['status'] != 'Success':
+                op.error = True
+                op.message = fees['errormessage'] if fees else 'No fee estimate returned for ASIN %s.' % amz_listing.sku
+                continue
+
+            self.set_fba_fees(amz_listing, price, fees['amount'])
+            op.complete = True
+
+    @staticmethod
+    def fees_price(op):
+        """Return the price an operation wants fees estimated at: the 'price' parameter, or the listing's price."""
+        params = op.params
+        return float(params['price']) if 'price' in params else op.listing.price
+
+    @staticmethod
+    def fees_identifier(asin, price):
+        """Return the identifier used to match a fee estimate to the listing and price it was requested for."""
+        return '%s@%.2f' % (asin, price)
+
+    async def get_fees_estimates(self, *ops):
+        """Request FBA fee estimates for each operation's listing and price, using a single GetMyFeesEstimate call.
+        Return a dictionary of results keyed by fees_identifier(), or None if the request failed.
+        """
+        feerequests = {}
+        for op in ops:
+            asin = op.listing.sku
+            price = self.fees_price(op)
+            identifier = self.fees_identifier(asin, price)
+
+            feerequests[identifier] = {'MarketplaceId': self.mwsapi.api.market_id(),
+                                       'IdType': 'ASIN',
+                                       'IdValue': asin,
+                                       'Identifier': identifier,
+                                       'IsAmazonFulfilled': 'true',
+                                       'PriceToEstimateFees.ListingPrice.CurrencyCode': 'USD',
+                                       'PriceToEstimateFees.ListingPrice.Amount': price}
+
+        r = await self.request_engine.call(self.mwsapi, 'GetMyFeesEstimate', priority=ops[0].priority,
+                                           FeesEstimateRequestList=list(feerequests.values()))
+        if self.is_error_response(r, *ops):
+            return None
+
+        parser = GetMyFeesEstimateParser(r.content)
+        return {fees['identifier']: fees for fees in parser.get_fees()}
+
+    def set_fba_fees(self, amz_listing, price, fba_fees):
+        """Update all price points for the listing at the given price. Create a new price point if none exist."""
+        price_point = None
+        for price_point in self.dbsession.query(AmzPriceAndFees).filter_by(amz_listing_id=amz_listing.id, price=price):
+            price_point.fba = fba_fees
+
+        if price_point is None:
+            self.dbsession.add(AmzPriceAndFees(amz_listing_id=amz_listing.id, price=price, fba=fba_fees))
+
+    async def UpdateAmazonListing(self, *ops):
+        """Update pricing, salesrank, offers, and merchant info for listings, then add to product history. Several
+        operations can be given at once, in which case their listings are looked up in the same requests.
+
+        Parameters:         log=            Add the new product data to the log
+                            repeat=         Repeat this operation after the given number of minutes.
+                            testmargins:    Create a TestMargins operation if the criteria are met.
+                                salesrank=  Sales Rank must be below the given value.
+                                threshold=  The minimum require profit margin to add to the list.
+                                list=       The name of the list to add matches to.
+        """
+        priority = ops[0].priority
+        asins = list(dict.fromkeys(op.listing.sku for op in ops))
+
+        r = await self.request_engine.call(self.paapi, 'ItemLookup', priority=priority,
+                                           ItemId=','.join(asins),
+                                           ResponseGroup='OfferFull,SalesRank,ItemAttributes')
+
+        if self.is_error_response(r, *ops):
+            return
+
+        parser = ItemLookupParser(r.content)
+        products = {product.asin: product for product in parser.products}
+
+        found = [op for op in ops if op.listing.sku in products]
+        missing = [op for op in ops if op.listing.sku not in products]
+
+        # ItemLookup tells us the current buy box price, but not including shipping. Call GetLowestOffListings
+        # to get the lowest offer INCLUDING shipping. This is *probably* the buy box price
+        if found:
+            r = await self.request_engine.call(self.mwsapi, 'GetLowestOfferListingsForASIN', priority=priority,
+                                               MarketplaceId=self.mwsapi.api.market_id(),
+                                               ASINList=list(dict.fromkeys(op.listing.sku for op in found)),
+                                               ItemCondition='New')
+
+        # All of the requests have been made, so the results can be written to the session
+        for op in missing:
+            code, message = parser.get_error(op.listing.sku)
+
+            op.error = True
+            op.message = 'ItemLookup failed for ASIN %s: %s. %s' % (op.listing.sku, code, message)
+
+        updated = []
+        for op in found:
+            amz_listing = op.listing
+            products[amz_listing.sku].update(amz_listing)
+
+            # Update the merchant
+            merchant = dbhelpers.get_or_create(self.dbsession, AmazonMerchant,
+                                               name=products[amz_listing.sku].merchant or 'N/A')
+            amz_listing.merchant = merchant
+
+            updated.append(op)
+
+        if not updated:
+            return
+
+        if self.is_error_response(r, *updated):
+            return
+
+        parser = GetLowestOfferListingsForASINParser(r.content)
+        results = {result['asin']: result for result in parser.get_product_info()}
+
+        for op in updated:
+            amz_listing = op.listing
+            params = op.params
+            result = results.get(amz_listing.sku)
+
+            if result is None:
+                op.error = True
+                op.message = 'GetLowestOfferListingsForASIN returned no result for ASIN %s.' % amz_listing.sku
+                continue
+            elif result['error']:
+                op.error = True
+                op.message = result['message']
+                continue
+            else:
+                amz_listing.price = max(amz_listing.price or 0, result['price'] or 0) or None
+                # amz_listing.hasprime = result['prime']
+
+            # Test margins?
+            if 'testmargins' in params:
+                if 'salesrank' not in params['testmargins'] \
+                    or (amz_listing.salesrank and amz_listing.salesrank <= params['testmargins']['salesrank']):
+
+                    test_op = Operation.TestMargins(listing=amz_listing,
+                                                    params=params['testmargins'],
+                                                    priority=op.priority)
+                    self.dbsession.add(test_op)
+
+            if 'log' in params and params['log'] == True:
+                self.dbsession.add(AmzProductHistory(amz_listing_id=amz_listing.id,
+                                                     salesrank=amz_listing.salesrank,
+                                                     hasprime=amz_listing.hasprime,
+                                                     price=amz_listing.price,
+                                                     merchant_id=amz_listing.merchant_id,
+                                                     offers=amz_listing.offers,
+                                                     timestamp=func.now()))
+
+            op.message = None
+
+            if 'repeat' in params and params['repeat'] > 0:
+                op.scheduled = datetime.utcnow() + timedelta(minutes=params['repeat'])
+            else:
+                op.complete = True
+
+        # Keep the sales estimates of the logged listings current
+        logged = [op.listing.id for op in updated if op.params.get('log') == True and not op.error]
+        if logged:
+            dbhelpers.update_sales_estimates(self.dbsession, logged)
@@ -0,0 +1,260 @@
+import asyncio
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import requests
+
+from database import *
+from requestengine import ApiReply
+
+# opsengine needs the amazonmws package and the mwskeys and pakeys credential modules
+try:
+    from opsengine import OperationsEngine
+except ImportError:
+    OperationsEngine = None
+
+
+def reply(content, status_code=200):
+    """Return an ApiReply holding a response with the given body."""
+    response = requests.Response()
+    response.status_code = status_code
+    response._content = content.encode()
+    return ApiReply(response)
+
+
+def item_lookup_response(items, errors=()):
+    """Return an ItemLookup response with an Item for each (asin, price) in items, and an error for each ASIN in
+    errors.
+    """
+    xml = '<ItemLookupResponse xmlns="http://webservices.amazon.com/AWSECommerceService/2011-08-01"><Items>'
+    xml += '<Request><Errors>'
+    for asin in errors:
+        xml += '<Error><Code>AWS.InvalidParameterValue</Code>' \
+               '<Message>%s is not a valid value for ItemId.</Message></Error>' % asin
+    xml += '</Errors></Request>'
+
+    for asin, price in items:
+        xml += '<Item><ASIN>%s</ASIN><SalesRank>500</SalesRank>' \
+               '<ItemAttributes><Brand>Acme</Brand><Title>Widget %s</Title></ItemAttributes>' \
+               '<OfferSummary><TotalNew>4</TotalNew></OfferSummary>' \
+               '<Offers><Offer><Merchant><Name>Shop</Name></Merchant>' \
+               '<OfferListing><Price><Amount>%d</Amount></Price></OfferListing></Offer></Offers>' \
+               '</Item>' % (asin, asin, price * 100)
+
+    return xml + '</Items></ItemLookupResponse>'
+
+
+def lowest_offers_response(prices, errors=()):
+    """Return a GetLowestOfferListingsForASIN response with a result for each (asin, landed price) in prices, and an
+    error for each ASIN in errors.
+    """
+    xml = '<GetLowestOfferListingsForASINResponse xmlns="http://mws.amazonservices.com/schema/Products/2011-10-01">'
+    for asin, price in prices:
+        xml += '<GetLowestOfferListingsForASINResult ASIN="%s" status="Success"><Product>' \
+               '<Identifiers><MarketplaceASIN><ASIN>%s</ASIN></MarketplaceASIN></Identifiers>' \
+               '<LowestOfferListings><LowestOfferListing>' \
+               '<Qualifiers><FulfillmentChannel>Merchant</FulfillmentChannel></Qualifiers>' \
+               '<Price><LandedPrice><Amount>%.2f</Amount></LandedPrice></Price>' \
+               '</LowestOfferListing></LowestOfferListings>' \
+               '</Product></GetLowestOfferListingsForASINResult>' % (asin, asin, price)
+    for asin in errors:
+        xml += '<GetLowestOfferListingsForASINResult ASIN="%s" status="ClientError">' \
+               '<Error><Type>Sender</Type><Code>InvalidParameterValue</Code>' \
+               '<Message>ASIN %s is not valid for marketplace.</Message></Error>' \
+               '</GetLowestOfferListingsForASINResult>' % (asin, asin)
+
+    return xml + '</GetLowestOfferListingsForASINResponse>'
+
+
+def fees_response(fees, errors=()):
+    """Return a GetMyFeesEstimate response with an estimate for each (identifier, amount) in fees, and an error for
+    each identifier in errors.
+    """
+    xml = '<GetMyFeesEstimateResponse xmlns="http://mws.amazonservices.com/schema/Products/2011-10-01">' \
+          '<GetMyFeesEstimateResult><FeesEstimateResultList>'
+    for identifier, amount in fees:
+        xml += '<FeesEstimateResult><Status>Success</Status>' \
+               '<FeesEstimateIdentifier><IdValue>%s</IdValue><SellerInputIdentifier>%s</SellerInputIdentifier>' \
+               '</FeesEstimateIdentifier>' \
+               '<FeesEstimate><TotalFeesEstimate><Amount>%.2f</Amount></TotalFeesEstimate></FeesEstimate>' \
+               '</FeesEstimateResult>' % (identifier.split('@')[0], identifier, amount)
+    for identifier in errors:
+        xml += '<FeesEstimateResult><Status>ClientError</Status>' \
+               '<FeesEstimateIdentifier><IdValue>%s</IdValue><SellerInputIdentifier>%s</SellerInputIdentifier>' \
+               '</FeesEstimateIdentifier>' \
+               '<Error><Type>Sender</Type><Code>InvalidParameterValue</Code><Message>No fees for %s.</Message>' \
+               '</Error></FeesEstimateResult>' % (identifier.split('@')[0], identifier, identifier)
+
+    return xml + '</FeesEstimateResultList></GetMyFeesEstimateResult></GetMyFeesEstimateResponse>'
+
+
+@unittest.skipIf(OperationsEngine is None, 'opsengine needs amazonmws, mwskeys and pakeys')
+class OperationsEngineTest(unittest.TestCase):
+    """Test batching and claiming operations, with the API calls answered by self.replies."""
+
+    past = datetime.utcnow() - timedelta(minutes=5)
+
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        dbengine = create_engine('sqlite:///' + os.path.join(self.tempdir.name, 'test.db'))
+        Base.metadata.create_all(dbengine)
+        Session.configure(bind=dbengine)
+
+        self.session = Session()
+        self.session.add(Vendor(id=0, name='Amazon'))
+        self.listings = {asin: AmazonListing(vendor_id=0, sku=asin, price=20.0, quantity=1)
+                         for asin in ('A1', 'A2', 'A3', 'A4')}
+        self.session.add_all(self.listings.values())
+        self.session.commit()
+
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        self.engine = self.new_engine('worker-1')
+        self.calls = []
+        self.replies = {}
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.engine.shutdown())
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+        Session.remove()
+        self.tempdir.cleanup()
+
+    def new_engine(self, worker_id):
+        engine = OperationsEngine(worker_id=worker_id)
+        engine.request_engine.call = self.call
+        return engine
+
+    async def call(self, throttler, api_call, priority=0, **params):
+        self.calls.append((api_call, params))
+        return self.replies[api_call]
+
+    def add_ops(self, factory, asins, params=None, priority=0):
+        ops = [factory(listing=self.listings[asin], params=params, priority=priority, scheduled=self.past)
+               for asin in asins]
+        self.session.add_all(ops)
+        self.session.commit()
+        return ops
+
+    def run_batch(self, op):
+        """Claim a batch of operations starting with op, and process it."""
+        ops = self.engine.claim_batch(op)
+        handler = getattr(self.engine, op.operation)
+        self.loop.run_until_complete(self.engine.process(handler, ops))
+        return ops
+
+    def test_update_shares_requests(self):
+        ops = self.add_ops(Operation.UpdateAmazonListing, ['A1', 'A2', 'A3'])
+
+        # Results come back in a different order than they were asked for
+        self.replies['ItemLookup'] = reply(item_lookup_response([('A3', 30), ('A1', 10)], errors=['A2']))
+        self.replies['GetLowestOfferListingsForASIN'] = reply(lowest_offers_response([('A3', 25.0), ('A1', 12.5)]))
+
+        batch = self.run_batch(ops[0])
+
+        self.assertEqual([op.id for op in batch], [op.id for op in ops])
+        self.assertEqual([api_call for api_call, params in self.calls], ['ItemLookup', 'GetLowestOfferListingsForASIN'])
+        self.assertEqual(self.calls[0][1]['ItemId'], 'A1,A2,A3')
+        self.assertEqual(self.calls[1][1]['ASINList'], ['A1', 'A3'])
+
+        self.session.expire_all()
+        a1, a2, a3 = ops
+        self.assertEqual((a1.complete, a1.error), (True, False))
+        self.assertEqual((a3.complete, a3.error), (True, False))
+        self.assertEqual(self.listings['A1'].price, 12.5)
+        self.assertEqual(self.listings['A3'].price, 30.0)
+
+        # Only the missing ASIN's operation fails
+        self.assertTrue(a2.error)
+        self.assertIn('A2', a2.message)
+
+        # The claims are released
+        self.assertEqual([op.claimed_by for op in ops], [None] * 3)
+
+    def test_update_lowest_offer_error(self):
+        ops = self.add_ops(Operation.UpdateAmazonListing, ['A1', 'A2'])
+        self.replies['ItemLookup'] = reply(item_lookup_response([('A1', 10), ('A2', 10)]))
+        self.replies['GetLowestOfferListingsForASIN'] = reply(lowest_offers_response([('A1', 12.5)], errors=['A2']))
+
+        self.run_batch(ops[0])
+
+        self.session.expire_all()
+        self.assertEqual([(op.complete, op.error) for op in ops], [(True, False), (False, True)])
+        self.assertIn('A2', ops[1].message)
+
+    def test_fees_share_request(self):
+        ops = self.add_ops(Operation.GetMyFeesEstimate, ['A1', 'A2', 'A3'])
+        ops.append(Operation.GetMyFeesEstimate(listing=self.listings['A4'], params={'fees': 3.5}, scheduled=self.past))
+        self.session.add(ops[-1])
+        self.listings['A3'].price = None
+        self.session.commit()
+
+        self.replies['GetMyFeesEstimate'] = reply(fees_response([('A1@20.00', 4.5)], errors=['A2@20.00']))
+
+        self.run_batch(ops[0])
+
+        # One request, for the operations that need one
+        self.assertEqual(len(self.calls), 1)
+        identifiers = [request['Identifier'] for request in self.calls[0][1]['FeesEstimateRequestList']]
+        self.assertEqual(identifiers, ['A1@20.00', 'A2@20.00'])
+
+        self.session.expire_all()
+        self.assertEqual([(op.complete, op.error) for op in ops],
+                         [(True, False), (False, True), (False, True), (True, False)])
+        self.assertEqual(ops[1].message, 'No fees for A2@20.00.')
+
+        fees = {(price_point.amz_listing_id, price_point.price): price_point.fba
+                for price_point in self.session.query(AmzPriceAndFees)}
+        self.assertEqual(fees, {(self.listings['A1'].id, 20.0): 4.5, (self.listings['A4'].id, 20.0): 3.5})
+
+    def test_claim_batch(self):
+        ops = self.add_ops(Operation.UpdateAmazonListing, ['A1', 'A2', 'A3'])
+        other_priority = self.add_ops(Operation.UpdateAmazonListing, ['A4'], priority=10)[0]
+
+        claimed = self.engine.claim_batch(ops[1])
+
+        # The operation asked for comes first
+        self.assertEqual([op.id for op in claimed], [ops[1].id, ops[0].id, ops[2].id])
+        self.assertNotIn(other_priority.id, [op.id for op in claimed])
+
+    def test_claims_are_exclusive(self):
+        ops = self.add_ops(Operation.UpdateAmazonListing, ['A1', 'A2'])
+        self.engine.claim_batch(ops[0])
+
+        # Both engines would share the thread's scoped session, so give the second one its own
+        other = self.new_engine('worker-2')
+        other.dbsession = Session.session_factory()
+        try:
+            self.assertEqual(other.claim_batch(other.dbsession.query(Operation).get(ops[0].id)), [])
+            self.assertEqual(other.claim_batch(other.dbsession.query(Operation).get(ops[1].id)), [])
+
+            # Once the lease runs out, the operations can be claimed again
+            self.session.query(Operation).update({Operation.lease_expires: self.past})
+            self.session.commit()
+
+            claimed = other.claim_batch(other.dbsession.query(Operation).get(ops[1].id))
+            self.assertEqual([op.id for op in claimed], [ops[1].id, ops[0].id])
+            self.assertEqual({op.claimed_by for op in claimed}, {'worker-2'})
+        finally:
+            self.loop.run_until_complete(other.shutdown())
+
+    def test_unrecognized_failure_pauses(self):
+        ops = self.add_ops(Operation.UpdateAmazonListing, ['A1'])
+        self.replies['ItemLookup'] = reply('', status_code=429)
+
+        self.engine.start()
+        self.run_batch(ops[0])
+
+        self.session.expire_all()
+        self.assertFalse(self.engine.running)
+        self.assertIsNotNone(self.engine._restart)
+        self.assertFalse(ops[0].complete)
+        self.assertIn('429', ops[0].message)
+
+
+if __name__ == '__main__':
+    unittest.main()
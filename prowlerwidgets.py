@@ -1,55 +1,516 @@
-from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot, QSortFilterProxyModel, QAbstractTableModel, QModelIndex, QVariant
+import logging
+import sys
+
+from array import array
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, pyqtSignal, pyqtSlot, QAbstractTableModel, QModelIndex, QVariant, QObject, QThread
+from PyQt5.QtCore import QCoreApplication, QTimer
 from PyQt5.QtWidgets import QWidget, QTableView, QAbstractItemView, QVBoxLayout, QHeaderView, QMenu, QDataWidgetMapper
+from PyQt5.QtWidgets import QLineEdit
 from PyQt5.QtSql import QSqlTableModel
 from delegates import DataMapperDelegate
 
 from database import *
 import sqlalchemy.orm
+from sqlalchemy import false, cast
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import ColumnElement, UnaryExpression, Label, _label_reference
+
+
+logger = logging.getLogger(__name__)
+
+
+class RowFetcher(QObject):
+    """Runs AlchemyTableModel's page queries in a background thread, using its own database sessions. Results are
+    sent back through the fetched signal, along with the request object they were made for. If a query fails, the
+    rows are None.
+    """
+    __instance__ = None
+    @classmethod
+    def get_instance(cls):
+        if cls.__instance__ is None:
+            cls.__instance__ = RowFetcher()
+        return cls.__instance__
+
+    fetched = pyqtSignal(object, object)
+    _requested = pyqtSignal(object, object, object)
+
+    def __init__(self):
+        super(RowFetcher, self).__init__()
+        self._sessions = {}
+
+        self._thread = QThread()
+        self.moveToThread(self._thread)
+        self._requested.connect(self._run)
+        self._thread.start()
+
+        QCoreApplication.instance().aboutToQuit.connect(self.stop)
+
+    @staticmethod
+    def can_fetch(query):
+        """Return True if query can be run in the background. In-memory SQLite databases can't be shared between
+        threads.
+        """
+        bind = query.session.get_bind()
+        return not (bind.dialect.name == 'sqlite' and bind.url.database in (None, '', ':memory:'))
+
+    def fetch(self, request, query):
+        """Run query in the background, and emit fetched(request, rows) when it's done."""
+        self._requested.emit(request, query, query.session.get_bind())
+
+    @pyqtSlot(object, object, object)
+    def _run(self, request, query, bind):
+        """Run a query. Called in the background thread."""
+        session = self._sessions.get(bind)
+        if session is None:
+            session = self._sessions[bind] = session_factory(bind=bind)
+
+        try:
+            rows = [tuple(row) for row in query.with_session(session)]
+        except Exception:
+            logger.exception('Background query failed.')
+            rows = None
+        finally:
+            session.close()
+
+        self.fetched.emit(request, rows)
+
+    def stop(self):
+        """Stop the background thread."""
+        self._thread.quit()
+        self._thread.wait()
+
+
+class ColumnBlock:
+    """A block of table rows, stored column by column. Columns of ints or floats are kept in typed arrays, along with
+    the set of rows that are NULL, and strings are interned.
+    """
+
+    __slots__ = ('columns', 'nulls')
+
+    def __init__(self, rows, column_count):
+        self.columns = []
+        self.nulls = []
+
+        for values in (zip(*rows) if rows else [()] * column_count):
+            column, nulls = self.pack(values)
+            self.columns.append(column)
+            self.nulls.append(nulls)
+
+    @staticmethod
+    def pack(values):
+        """Return a compact container for a column's values, and the set of indexes that are NULL (or None)."""
+        types = {type(value) for value in values if value is not None}
+        nulls = frozenset(i for i, value in enumerate(values) if value is None) or None
+
+        if types == {int}:
+            try:
+                return array('q', [value or 0 for value in values]), nulls
+            except OverflowError:
+                pass
+        elif types == {float}:
+            return array('d', [value or 0.0 for value in values]), nulls
+        elif types == {str}:
+            return [sys.intern(value) if value is not None else None for value in values], None
+
+        return list(values), None
+
+    def get(self, row, col):
+        """Return the value at row, col."""
+        nulls = self.nulls[col]
+        if nulls is not None and row in nulls:
+            return None
+
+        return self.columns[col][row]
+
+
+class RowCache:
+    """Holds the rows loaded by an AlchemyTableModel, in ColumnBlocks of block_size rows. Only the max_blocks most
+    recently used blocks are kept in memory. The key column (usually 'id') is never evicted, and neither is the sort
+    key of the row before each block, so evicted blocks can be loaded again.
+    """
+
+    def __init__(self, column_count, block_size=100, max_blocks=100, key_column=None):
+        self.column_count = column_count
+        self.block_size = block_size
+        self.max_blocks = max_blocks
+        self.key_column = key_column
+        self.start_keys = []
+
+        self._blocks = OrderedDict()
+        self._key_values = []
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def block_range(self, block):
+        """Return the first and last row numbers in a block."""
+        first = block * self.block_size
+        return first, min(first + self.block_size, self._length) - 1
+
+    def extend(self, rows, keys=None, start_key=None):
+        """Add rows to the end of the cache. Only the last block may be partly full, so rows can only be added after
+        whole blocks. keys is the sort key of each row, and start_key is the sort key of the row before the first.
+        """
+        assert(self._length % self.block_size == 0)
+
+        for start in range(0, len(rows), self.block_size):
+            block_rows = rows[start:start + self.block_size]
+            block = len(self.start_keys)
+
+            self.start_keys.append(keys[start - 1] if keys and start else start_key)
+            if self.key_column is not None:
+                self._key_values.append(ColumnBlock.pack([row[self.key_column] for row in block_rows]))
+
+            self._store(block, block_rows)
+
+        self._length += len(rows)
+
+    def fill(self, block, rows):
+        """Store the reloaded rows of an evicted block. Padded or trimmed to the block's original length."""
+        first, last = self.block_range(block)
+        length = last - first + 1
+
+        rows = rows[:length] + [(None,) * self.column_count] * (length - len(rows))
+        self._store(block, rows)
+
+    def _store(self, block, rows):
+        """Store a block, evicting the least recently used blocks if there are too many."""
+        self._blocks[block] = ColumnBlock(rows, self.column_count)
+        self._blocks.move_to_end(block)
+
+        while len(self._blocks) > self.max_blocks:
+            self._blocks.popitem(last=False)
+
+    def is_loaded(self, row, col=None):
+        """Return True if the value at row, col (or the whole row, if col is None) is in memory."""
+        return (col is not None and col == self.key_column) or row // self.block_size in self._blocks
+
+    def get(self, row, col):
+        """Return the value at row, col. The value must be loaded."""
+        block, offset = divmod(row, self.block_size)
+
+        if col is not None and col == self.key_column:
+            column, nulls = self._key_values[block]
+            return None if nulls is not None and offset in nulls else column[offset]
+
+        self._blocks.move_to_end(block)
+        return self._blocks[block].get(offset, col)
 
 
 class AlchemyTableModel(QAbstractTableModel):
-    """A table model that binds to a SQLAlchemy query object."""
+    """A table model that binds to a SQLAlchemy query object. If the query has an 'id' column, rows are loaded a page
+    at a time by seeking past the last loaded row's sort key, so loading a page costs the same no matter how far down
+    the table it is. Sorting and filtering are done by the database, by adding ORDER BY and WHERE clauses to the
+    query. After the first page, pages are loaded by a RowFetcher in the background; placeholder rows are shown until
+    they arrive. Loaded rows are kept in a RowCache, which only keeps the most recently viewed pages in memory.
+    """
+
+    page_size = 100
+    max_cached_pages = 100
+    background_fetch = True
+    placeholder = 'Loading...'
+
+    # How long to wait, in milliseconds, before running a failed background query again
+    retry_interval = 2000
 
     def __init__(self, parent=None):
         """Initialize the model."""
         super(AlchemyTableModel, self).__init__(parent=parent)
 
+        self._base_query = None
+        self._sort_column = -1
+        self._sort_order = Qt.AscendingOrder
+        self._filter_text = ''
+        self._filter_column = -1
+
         self._sa_query = None
         self._column_names = []
-        self._cache = []
+        self._cache = RowCache(0)
         self._edit_cache = {}
         self._query_count = 0
+        self._sort_keys = None
+        self._last_key = None
+        self._exhausted = True
+        self._pending = None
+        self._placeholders = 0
+        self._reloads = {}
+        self._fetcher = None
 
     @property
     def query(self):
         """Return the SqlAlchemy query object used by the model."""
-        return self._sa_query
+        return self._base_query
 
     @query.setter
     def query(self, value):
         """Set the model's SqlAlchemy query and update the model."""
-        assert(isinstance(value, sqlalchemy.orm.query.Query) or isinstance(value, None))
+        assert(isinstance(value, sqlalchemy.orm.query.Query) or value is None)
+        self._base_query = value
+        self.reset_query()
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        """Sort the rows by the given column, and reload them from the database."""
+        self._sort_column = column
+        self._sort_order = order
+        self.reset_query()
+
+    def set_filter(self, text, column=-1):
+        """Only show rows where the given column contains text, or any column if column is -1. An empty string removes
+        the filter.
+        """
+        self._filter_text = text
+        self._filter_column = column
+        self.reset_query()
+
+    def _column_expression(self, column):
+        """Return the SQL expression for the column with the given index, or None if it isn't a simple column."""
+        expr = self._base_query.column_descriptions[column]['expr']
+
+        while isinstance(expr, Label):
+            expr = expr.element
+
+        return expr if isinstance(expr, ColumnElement) else None
+
+    def sorted_filtered_query(self):
+        """Return the model's query, with the current sort and filter applied."""
+        query = self._base_query
+        columns = range(len(query.column_descriptions))
+
+        if self._filter_text:
+            filter_columns = columns if self._filter_column < 0 else [self._filter_column]
+            exprs = [self._column_expression(column) for column in filter_columns if column in columns]
+            query = query.filter(or_(*[cast(expr, String).contains(self._filter_text, autoescape=True)
+                                       for expr in exprs if expr is not None]))
+
+        if self._sort_column in columns:
+            expr = self._column_expression(self._sort_column)
+            if expr is not None:
+                query = query.order_by(None).\
+                              order_by(expr.desc() if self._sort_order == Qt.DescendingOrder else expr.asc())
+
+        return query
+
+    def reset_query(self):
+        """Re-run the query, and reload the first rows."""
         self.beginResetModel()
 
-        self._sa_query = value
-        self._cache = []
+        self._sa_query = None
+        self._cache = RowCache(0)
         self._edit_cache = {}
         self._column_names = []
         self._query_count = 0
-
-        if value is not None:
+        self._sort_keys = None
+        self._last_key = None
+        self._exhausted = True
+        self._pending = None
+        self._placeholders = 0
+        self._reloads = {}
+
+        if self._base_query is not None:
+            self._sa_query = self.sorted_filtered_query()
             self._column_names = [col['name'] for col in self._sa_query.column_descriptions]
-            self._query_count = self._sa_query.count()
-            self._cache.extend(self._sa_query[:300])
+            self._cache = RowCache(len(self._column_names), self.page_size, self.max_cached_pages,
+                                   key_column=self.fieldIndex('id') if 'id' in self._column_names else None)
+            self._query_count = None
+            self._sort_keys = self.sort_keys(self._sa_query)
+            self._exhausted = False
+            self._fetch(3 * self.page_size)
 
         self.endResetModel()
 
+    @staticmethod
+    def sort_keys(query):
+        """Return a list of (expression, descending) pairs giving a unique ordering of the query's rows: the query's
+        ORDER BY terms, followed by its 'id' column. Returns None if the query can't be paged this way.
+        """
+        if query._group_by or query._limit is not None or query._offset is not None:
+            return None
+
+        id_col = next((col['expr'] for col in query.column_descriptions if col['name'] == 'id'), None)
+        if not isinstance(id_col, ColumnElement):
+            return None
+
+        keys = []
+        for clause in list(query._order_by or []) + [id_col]:
+            descending = False
+            if isinstance(clause, UnaryExpression):
+                if clause.modifier not in (operators.asc_op, operators.desc_op):
+                    return None
+
+                descending = clause.modifier is operators.desc_op
+                clause = clause.element
+
+            while isinstance(clause, (Label, _label_reference)):
+                clause = clause.element
+
+            if not isinstance(clause, ColumnElement):
+                return None
+
+            keys.append((clause, descending))
+
+        return keys
+
+    @staticmethod
+    def _after(keys, values):
+        """Return a clause selecting the rows that sort after a row with the given key values. SQLite sorts NULLs
+        before any other value.
+        """
+        clause = false()
+        for (expr, descending), value in reversed(list(zip(keys, values))):
+            if value is None:
+                beyond = false() if descending else expr.isnot(None)
+                equal = expr.is_(None)
+            else:
+                beyond = or_(expr < value, expr.is_(None)) if descending else expr > value
+                equal = expr == value
+
+            clause = or_(beyond, and_(equal, clause))
+
+        return clause
+
+    def _page_query(self, count, start_key=None, offset=0):
+        """Return a query for count rows, starting after the row with the sort key start_key. If the query isn't
+        paged by key, start at offset instead.
+        """
+        if self._sort_keys is None:
+            return self._sa_query.offset(offset).limit(count)
+
+        query = self._sa_query.\
+                add_columns(*[expr for expr, descending in self._sort_keys]).\
+                order_by(self._sort_keys[-1][0])
+
+        if start_key is not None:
+            query = query.filter(self._after(self._sort_keys, start_key))
+
+        return query.limit(count)
+
+    def _next_page_query(self, count):
+        """Return a query for the count rows following the ones already loaded, plus one extra."""
+        return self._page_query(count + 1, self._last_key, len(self._cache))
+
+    def _add_page(self, rows, count):
+        """Add the results of a page query to the cache. Returns the number of rows added."""
+        columns = len(self._column_names)
+
+        # The extra row just tells us whether there are more to come
+        self._exhausted = len(rows) <= count
+        rows = rows[:count]
+
+        keys = [tuple(row[columns:]) for row in rows] if self._sort_keys is not None else None
+        self._cache.extend([tuple(row[:columns]) for row in rows], keys, self._last_key)
+
+        if keys:
+            self._last_key = keys[-1]
+
+        return len(rows)
+
+    def _fetch(self, count):
+        """Load up to count rows following the ones already cached. Returns the number of rows loaded."""
+        if self._exhausted:
+            return 0
+
+        return self._add_page(self._next_page_query(count).all(), count)
+
+    def _get_fetcher(self):
+        """Return the RowFetcher, connecting to it the first time."""
+        if self._fetcher is None:
+            self._fetcher = RowFetcher.get_instance()
+            self._fetcher.fetched.connect(self._on_fetched)
+
+        return self._fetcher
+
+    def _fetch_background(self):
+        """Add a page of placeholder rows, and start loading the real rows in the background."""
+        self._pending = object()
+        self._get_fetcher().fetch(self._pending, self._next_page_query(self.page_size))
+
+        cached = len(self._cache)
+
+        self.beginInsertRows(QModelIndex(), cached, cached + self.page_size - 1)
+        self._placeholders = self.page_size
+        self.endInsertRows()
+
+    def _reload(self, block):
+        """Load an evicted block of rows again."""
+        if block in self._reloads.values():
+            return
+
+        first, last = self._cache.block_range(block)
+        query = self._page_query(last - first + 1, self._cache.start_keys[block], first)
+
+        if self.background_fetch and RowFetcher.can_fetch(self._sa_query):
+            request = object()
+            self._reloads[request] = block
+            self._get_fetcher().fetch(request, query)
+        else:
+            self._cache.fill(block, [tuple(row[:self.columnCount()]) for row in query])
+
+    def _retry_later(self, request):
+        """Run a failed background query again after retry_interval. The placeholders stay in the meantime."""
+        timer = QTimer(self)
+        timer.setSingleShot(True)
+        timer.timeout.connect(lambda: self._retry(request))
+        timer.timeout.connect(timer.deleteLater)
+        timer.start(self.retry_interval)
+
+    def _retry(self, request):
+        """Run a failed background query again, unless the model has been reset since."""
+        if request in self._reloads:
+            self._reload(self._reloads.pop(request))
+        elif request is self._pending:
+            self._pending = object()
+            self._get_fetcher().fetch(self._pending, self._next_page_query(self.page_size))
+
+    def _on_fetched(self, request, rows):
+        """Add rows loaded in the background, in place of the placeholder rows or an evicted block."""
+        if rows is None:
+            if request in self._reloads or request is self._pending:
+                self._retry_later(request)
+            return
+
+        if request in self._reloads:
+            block = self._reloads.pop(request)
+            self._cache.fill(block, [tuple(row[:self.columnCount()]) for row in rows])
+
+            first, last = self._cache.block_range(block)
+            self.dataChanged.emit(self.index(first, 0), self.index(last, self.columnCount() - 1))
+            return
+
+        if request is not self._pending:
+            return
+
+        self._pending = None
+
+        start = len(self._cache)
+        count = min(len(rows), self.page_size)
+
+        # Remove any placeholders that weren't needed
+        if count < self.page_size:
+            self.beginRemoveRows(QModelIndex(), start + count, start + self.page_size - 1)
+
+        self._add_page(rows, self.page_size)
+        self._placeholders = 0
+
+        if count < self.page_size:
+            self.endRemoveRows()
+
+        if count:
+            self.dataChanged.emit(self.index(start, 0), self.index(start + count - 1, self.columnCount() - 1))
+
     def rowCount(self, parent_idx=QModelIndex()):
         """Return the number of rows currently loaded."""
-        return len(self._cache)
+        return len(self._cache) + self._placeholders
 
     def totalRows(self):
-        """Return the total number of rows in the query."""
+        """Return the total number of rows in the query. The count is only run the first time it is needed, and not
+        at all if every row has already been loaded.
+        """
+        if self._query_count is None:
+            self._query_count = len(self._cache) if self._exhausted else self._sa_query.count()
+
         return self._query_count
 
     def columnCount(self, parent_idx=QModelIndex()):
@@ -75,10 +536,18 @@ class AlchemyTableModel(QAbstractTableModel):
         col = index.column()
 
         try:
-            return self._edit_cache[row][col]
+            return self._edit_cache[row, col]
         except KeyError:
-            data = self._cache[row][col]
-            return data if data is not None else ''
+            pass
+
+        if row < len(self._cache) and not self._cache.is_loaded(row, col):
+            self._reload(row // self.page_size)
+
+        if row >= len(self._cache) or not self._cache.is_loaded(row, col):
+            return self.placeholder if role == Qt.DisplayRole else QVariant()
+
+        data = self._cache.get(row, col)
+        return data if data is not None else ''
 
     def setData(self, index, value, role=Qt.EditRole):
         """Set a given index's data. Currently, edits are cached, but never get written to the database. dataChanged()
@@ -87,16 +556,16 @@ class AlchemyTableModel(QAbstractTableModel):
         row = index.row()
         col = index.column()
 
-        if self._edit_cache.get(row):
-            self._edit_cache[row][col] = value
-        else:
-            self._edit_cache[row] = {col: value}
+        self._edit_cache[row, col] = value
 
         self.dataChanged.emit(index, index, [role])
         return True
 
     def flags(self, index):
         """Return the flags for a given index."""
+        if index.row() >= len(self._cache):
+            return Qt.NoItemFlags
+
         return Qt.ItemIsEnabled | Qt.ItemIsSelectable | Qt.ItemIsEditable
 
     def fieldIndex(self, field):
@@ -108,16 +577,28 @@ class AlchemyTableModel(QAbstractTableModel):
 
     def canFetchMore(self, parent_idx):
         """Return True if more rows can be loaded from the query."""
-        return len(self._cache) < self._query_count
+        return not self._exhausted and self._pending is None
 
     def fetchMore(self, parent_idx):
-        """Loads another 100 rows from the query, if possible."""
+        """Loads another page of rows from the query, if possible."""
+        if not self.canFetchMore(parent_idx):
+            return
+
+        if self.background_fetch and RowFetcher.can_fetch(self._sa_query):
+            self._fetch_background()
+            return
+
+        rows = self._next_page_query(self.page_size).all()
+        count = min(len(rows), self.page_size)
         cached = len(self._cache)
-        extend = min(cached + 100, self._query_count)
 
-        self.beginInsertRows(QModelIndex(), cached, extend - 1)
-        self._cache.extend(self._sa_query[cached:extend])
-        self.endInsertRows()
+        if count:
+            self.beginInsertRows(QModelIndex(), cached, cached + count - 1)
+
+        self._add_page(rows, self.page_size)
+
+        if count:
+            self.endInsertRows()
 
 
 class ProwlerSqlWidget(QWidget):
@@ -154,16 +635,31 @@ class ProwlerTableWidget(ProwlerSqlWidget):
     selection_changed = pyqtSignal()
     double_clicked = pyqtSignal()
 
+    # Show a box above the table for filtering its rows in the database
+    filterable = False
+
+    # How long to wait, in milliseconds, after typing in the filter box before filtering
+    filter_delay = 300
+
     def __init__(self, parent=None):
         super(ProwlerTableWidget, self).__init__(parent=parent)
         self.context_menu_actions = []
 
-        # Set up the model and table
-        sort_model = QSortFilterProxyModel(self)
-        sort_model.setSourceModel(self.model)
+        # Set up the filter box. Filtering waits until typing pauses, so each key press doesn't run a query
+        self.filter_edit = QLineEdit(self)
+        self.filter_edit.setPlaceholderText('Filter')
+        self.filter_edit.setClearButtonEnabled(True)
+        self.filter_edit.setVisible(self.filterable)
+
+        self._filter_timer = QTimer(self)
+        self._filter_timer.setSingleShot(True)
+        self._filter_timer.setInterval(self.filter_delay)
+        self._filter_timer.timeout.connect(self.apply_filter)
+        self.filter_edit.textChanged.connect(lambda text: self._filter_timer.start())
 
+        # Set up the table. Sorting is done by the model, in the database
         self.table = QTableView(self)
-        self.table.setModel(sort_model)
+        self.table.setModel(self.model)
         self.table.setSortingEnabled(True)
 
         # Extended row selection by default
@@ -185,12 +681,17 @@ class ProwlerTableWidget(ProwlerSqlWidget):
         layout = QVBoxLayout(self)
         layout.setContentsMargins(0, 0, 0, 0)
 
+        layout.addWidget(self.filter_edit)
         layout.addWidget(self.table)
         self.setLayout(layout)
 
         # Connect the double_clicked signal
         self.table.doubleClicked.connect(self.double_clicked)
 
+    def apply_filter(self):
+        """Only show the rows with a column that contains the text in the filter box."""
+        self.model.set_filter(self.filter_edit.text().strip())
+
     @property
     def selected_ids(self):
         """Return the values in the 'id' column for each selected row."""
@@ -0,0 +1,80 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+class ApiReply:
+    """The result of an API request. Wraps either a requests.Response, or the exception raised while making it."""
+
+    def __init__(self, response=None, exception=None):
+        self._response = response
+        self.exception = exception
+
+    @property
+    def status_code(self):
+        """The HTTP status code, or None if no response was received."""
+        return self._response.status_code if self._response is not None else None
+
+    @property
+    def content(self):
+        """The body of the response, in bytes."""
+        return self._response.content if self._response is not None else b''
+
+    @property
+    def text(self):
+        """The body of the response, decoded to a string."""
+        return self.content.decode()
+
+    @property
+    def network_error(self):
+        """True if the connection was refused, reset, or timed out."""
+        return isinstance(self.exception, (requests.ConnectionError, requests.Timeout))
+
+
+class RequestEngine:
+    """Makes throttled API calls from an asyncio event loop. Requests run in a pool of worker threads, so several can
+    be in flight at once. Each API operation has its own throttle bucket, and a call only waits on its own bucket.
+    """
+
+    def __init__(self, timeout=30, max_workers=8):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self._buckets = {}
+
+    def bind(self, throttler):
+        """Route the requests made by a Throttler's api through this engine."""
+        throttler.api.make_request = self.make_request
+
+    def make_request(self, *args, **kwargs):
+        """Start the network request in a worker thread. Returns a concurrent.futures.Future of an ApiReply."""
+        return self._executor.submit(self._send, kwargs['method'], kwargs['url'], kwargs['headers'], kwargs['data'])
+
+    def _send(self, method, url, headers, data):
+        """Make the actual network request. Runs in a worker thread."""
+        try:
+            response = requests.request(method, url, headers=headers, data=data, timeout=self.timeout)
+        except requests.RequestException as e:
+            return ApiReply(exception=e)
+
+        return ApiReply(response)
+
+    async def call(self, throttler, api_call, priority=0, **params):
+        """Wait for the api_call's throttle bucket to allow a request at the given priority, then make the request
+        and return its ApiReply.
+        """
+        bucket = self._buckets.setdefault((id(throttler), api_call), asyncio.Lock())
+
+        async with bucket:
+            wait = throttler.request_wait(api_call, priority)
+            while wait > 0:
+                await asyncio.sleep(wait)
+                wait = throttler.request_wait(api_call, priority)
+
+            future = getattr(throttler, api_call)(priority=priority, **params)
+
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self):
+        """Stop the worker threads, once any requests in progress have finished."""
+        self._executor.shutdown(wait=True)
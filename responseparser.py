@@ -1,5 +1,8 @@
 import re
 import itertools
+import functools
+from fractions import Fraction
+from collections import Counter
 
 from lxml import etree
 
@@ -7,75 +10,121 @@ from database import *
 import dbhelpers
 
 
-# Attempt to translate a 'human-friendly' quantity to a number
-def read_quantity(string, pairs_singular=False):
-    string = string.lower()
+# Match 'container' words, abbreviations and plurals. Ex: matches 'pk', 'pks', 'pack', or 'packs'
+_containers = r'(?:(?<![a-z])(?:package|pack|pk|case|cs|set|st|boxe|box|bx|count|ct|carton|bag|bg|roll|rl|sleeve|quantity)s?(?![a-z]))'
 
-    # Match 'container' words, abbreviations and plurals. Ex: matches 'pk', 'pks', 'pack', or 'packs'
-    containers = r'(?:(?<![a-z])(?:package|pack|pk|case|cs|set|st|boxe|box|bx|count|ct|carton|bag|bg|roll|rl|sleeve|quantity)s?(?![a-z]))'
+# Match 'multiplier' words, abbreviations, and plurals. Ex: matches 'dz', 'dzs', 'dozen', or 'dozens'
+_multipliers = r'(?:(?<![a-z])(?P<mult>ea|each|unit|pc|piece|pr|pair|dz|doz|dozen)s?(?![a-z]))'
 
-    # Match 'multiplier' words, abbreviations, and plurals. Ex: matches 'dz', 'dzs', 'dozen', or 'dozens'
-    multipliers = r'(?:(?<![a-z])(?P<mult>ea|each|unit|pc|piece|pr|pair|dz|doz|dozen)s?(?![a-z]))'
-
-    # Match numbers given in plain form, comma-separated, and/or enclosed in parentheses. Ex: (1,000)
-    # Now recognizes fractions: 1/2, 1,000/2, (1/2), etc
-    numbers = r'\(?(?P<num>\d[\d,]*(?:/\d[\d,]*)?)\)?'
-
-    # Sometimes it's useful to consider a 'pair' as one item. Like a pair of shoes.
-    pair_value = 1 if pairs_singular else 2
-    mult_lookup = {'ea': 1, 'each': 1,
-                   'unit': 1,
-                   'pc': 1, 'piece': 1,
-                   'pr': pair_value, 'pair': pair_value,
-                   'dz': 12, 'doz': 12, 'dozen': 12}
+# Match numbers given in plain form, comma-separated, and/or enclosed in parentheses. Ex: (1,000)
+# Now recognizes fractions: 1/2, 1,000/2, (1/2), etc
+_numbers = r'\(?(?P<num>\d[\d,]*(?:/\d[\d,]*)?)\)?'
 
+_quantity_patterns = [
     # Match "(number)(container) of/consists of (quantity)" phrases
-    r1 = re.compile(r'{container}(?:\s+consists?)?(?:\s+of)\s*{number}\s*{multiplier}?'\
-                    .format(container=containers, number=numbers, multiplier=multipliers),
-                    re.IGNORECASE)
+    re.compile(r'{container}(?:\s+consists?)?(?:\s+of)\s*{number}\s*{multiplier}?'
+               .format(container=_containers, number=_numbers, multiplier=_multipliers)),
 
     # Match "(quantity) (per) (container)" phrases
-    r2 = re.compile(r'{number}\s*{multiplier}?(?:\s*[a-z]+)?\s*(?:per|/|-| )?\s*{container}'\
-                    .format(number=numbers, multiplier=multipliers, container=containers),
-                    re.IGNORECASE)
+    re.compile(r'{number}\s*{multiplier}?(?:\s*[a-z]+)?\s*(?:per|/|-| )?\s*{container}'
+               .format(number=_numbers, multiplier=_multipliers, container=_containers)),
 
     # Match "(quantity)(multiplier)" as in '2 dozen' or '6 each'
-    r3 = re.compile(r'{number}\s*[-/]?\s*{multiplier}(?![a-z])'\
-                    .format(number=numbers, multiplier=multipliers),
-                    re.IGNORECASE)
-
-    # Match "(number) (containers) of (number)"
-    r4 = re.compile()
+    re.compile(r'{number}\s*[-/]?\s*{multiplier}(?![a-z])'
+               .format(number=_numbers, multiplier=_multipliers)),
+]
+
+_multiplier_values = {'ea': 1, 'each': 1,
+                      'unit': 1,
+                      'pc': 1, 'piece': 1,
+                      'dz': 12, 'doz': 12, 'dozen': 12}
+
+
+def _read_number(string):
+    """Convert a matched number like '1,000' or '1/2' to a Fraction, or None if it can't be read."""
+    numerator, _, denominator = string.replace(',', '').partition('/')
+    try:
+        return Fraction(int(numerator), int(denominator or 1))
+    except ZeroDivisionError:
+        return None
 
 
+@functools.lru_cache(maxsize=65536)
+def _read_normalized_quantity(string, pairs_singular):
+    """read_quantity() for a string that is already lower-case, with its whitespace collapsed."""
+    # Sometimes it's useful to consider a 'pair' as one item. Like a pair of shoes.
+    pair_value = 1 if pairs_singular else 2
 
     quants = []
-    matches = itertools.chain(r1.finditer(string),
-                              r2.finditer(string),
-                              r3.finditer(string),
-                              r4.finditer(string))
-    for match in matches:
-        num = eval(match.group('num').replace(',', ''))
-        mult = mult_lookup.get(match.group('mult'), 1)
+    for match in itertools.chain.from_iterable(pattern.finditer(string) for pattern in _quantity_patterns):
+        num = _read_number(match.group('num'))
+        if num is None:
+            continue
+
+        mult = match.group('mult')
+        mult = pair_value if mult in ('pr', 'pair') else _multiplier_values.get(mult, 1)
         quants.append(num * mult)
 
     if not quants:
         return None
 
     # Calculate the modes (plural) of the quantities, and choose the largest one
-    most = max(list(map(quants.count, quants)))
-    modes = list(set(filter(lambda x: quants.count(x) == most, quants)))
+    counts = Counter(quants)
+    most = max(counts.values())
+    quantity = max(quant for quant, count in counts.items() if count == most)
+
+    return int(quantity) if quantity.denominator == 1 else float(quantity)
+
 
-    if modes:
-        return max(modes)
+# Attempt to translate a 'human-friendly' quantity to a number
+def read_quantity(string, pairs_singular=False):
+    return _read_normalized_quantity(' '.join(string.lower().split()), pairs_singular)
+
+
+def read_quantities(strings, pairs_singular=False):
+    """Run read_quantity() over a pandas Series or a list of strings, returning the same type. Each distinct
+    string is only read once. Values that aren't strings, or have no quantity, give None (NaN in a Series).
+    """
+    is_series = hasattr(strings, 'map')
+    if not is_series:
+        strings = list(strings)
+
+    quantities = {string: read_quantity(string, pairs_singular) if isinstance(string, str) else None
+                  for string in set(strings)}
+
+    if is_series:
+        return strings.map(quantities)
     else:
-        return max(quants)
+        return [quantities[string] for string in strings]
 
 
 class ParseError(Exception):
     pass
 
 
+@functools.lru_cache(maxsize=None)
+def ns_path(path):
+    """Convert a path like './/Error/Code' into one that matches tags in any namespace: './/{*}Error/{*}Code'."""
+    return '/'.join(step if step in ('', '.', '..') or step.startswith('{') else '{*}' + step
+                    for step in path.split('/'))
+
+
+def localname(tag):
+    """Return a tag name without its namespace."""
+    return tag.rpartition('}')[2]
+
+
+def parse_xml(xml):
+    """Parse an XML response, given as bytes or a string, and return the root element."""
+    if isinstance(xml, str):
+        xml = xml.encode()
+
+    try:
+        return etree.fromstring(xml)
+    except Exception as e:
+        raise ParseError(repr(e))
+
+
 class XmlResponseElement:
     """Base class for an XML response element."""
 
@@ -91,16 +140,18 @@ class XmlResponseElement:
         self._tag = value
 
     def xpath_get(self, path, dtype=str, default=None):
-        """Use XPath to get values under the current tag. Return a value of type dtype, or the default value."""
-        items = self._tag.xpath(path)
+        """Get the first value with the given path under the current tag, ignoring namespaces. Return a value of type
+        dtype, or the default value.
+        """
+        item = self._tag.find(ns_path(path))
         try:
-            return dtype(items[0].text)
-        except (TypeError, IndexError):
+            return dtype(item.text)
+        except (TypeError, AttributeError):
             return default
 
     def xpath_get_all(self, path, dtype=str, default=None):
         """Return a list of all values with the given path."""
-        items = self._tag.xpath(path)
+        items = self._tag.findall(ns_path(path))
         response = []
         for item in items:
             try:
@@ -112,33 +163,91 @@ class XmlResponseElement:
 
 
 class AmzResponseParser(XmlResponseElement):
-    """Base class for parsing XML responses from the Amazon MWS or Product Advertising APIs."""
-
-    # Regexes for removing namespaces from the XML - makes it easier to parse
-    re_ns_decl = re.compile(r' xmlns(:\w*)?="[^"]*"', re.IGNORECASE)
-    re_ns_open = re.compile(r'<\w+:')
-    re_ns_close = re.compile(r'/\w+:')
+    """Base class for parsing XML responses from the Amazon MWS or Product Advertising APIs. Takes the response
+    body as bytes, and looks up tags by their local names, whatever namespace they're in.
+    """
 
     def __init__(self, xml):
-        super(AmzResponseParser, self).__init__()
+        super(AmzResponseParser, self).__init__(parse_xml(xml))
 
-        try:
-            tree = etree.fromstring(self._remove_namespace(xml))
-        except Exception as e:
-            raise ParseError(repr(e))
 
-        self._tag = tree
+class ProductParser(XmlResponseElement):
+    """Provides a normalized way to access information in a 'Product' or 'Item' tag. The tag is walked once, when
+    the parser is created, and the values are kept in a plain dictionary, self.record.
+    """
 
-    def _remove_namespace(self, xml):
-        """Remove all traces of namespaces from an XML string."""
-        response = self.re_ns_decl.sub('', xml)          # Remove namespace declarations
-        response = self.re_ns_open.sub('<', response)    # Remove namespaces in opening tags
-        response = self.re_ns_close.sub('/', response)   # Remove namespaces in closing tags
-        return response
+    # Tags whose text is collected from anywhere under the product. As with './/Tag', the first one found is used.
+    text_tags = {'ASIN', 'Brand', 'Manufacturer', 'Label', 'Publisher', 'Studio', 'Model', 'PartNumber', 'MPN',
+                 'Title', 'SalesRank', 'UPC', 'NumberOfItems', 'PackageQuantity', 'IsEligibleForPrime',
+                 'ProductCategoryId', 'ProductGroup'}
 
+    # Tags that are only collected under the given parents, stored under their full path, e.g. 'SalesRank/Rank'
+    nested_tags = {'Rank': ('SalesRank',),
+                   'TotalNew': ('OfferSummary',),
+                   'Amount': ('OfferListing', 'Price'),
+                   'Name': ('Offer', 'Merchant')}
 
-class ProductParser(XmlResponseElement):
-    """Provides a normalized way to access information in a 'Product' or 'Item' tag."""
+    def __init__(self, tag=None):
+        super(ProductParser, self).__init__(tag)
+        self.record = self._parse()
+
+    def _parse(self):
+        """Walk the product tag, and return a dictionary of the product's details."""
+        texts = {}
+        features = []
+        has_offers = False
+
+        for element in self._tag.iterdescendants(etree.Element):
+            name = localname(element.tag)
+
+            if name == 'Feature':
+                features.append(element.text)
+            elif name == 'Offers':
+                has_offers = True
+            elif name in self.text_tags:
+                texts.setdefault(name, element.text)
+            elif name in self.nested_tags:
+                # Check the parent tags, from the nearest outwards
+                path = [name]
+                parent = element
+                for parent_name in reversed(self.nested_tags[name]):
+                    parent = parent.getparent()
+                    if parent is None or localname(parent.tag) != parent_name:
+                        break
+                    path.insert(0, parent_name)
+                else:
+                    texts.setdefault('/'.join(path), element.text)
+
+        def get(tag, dtype=str, default=None):
+            try:
+                return dtype(texts[tag])
+            except (KeyError, TypeError, ValueError):
+                return default
+
+        record = {}
+        record['asin'] = get('ASIN')
+        record['title'] = get('Title')
+        record['brand'] = get('Brand') or get('Manufacturer') or get('Label') or get('Publisher') or get('Studio')
+        record['model'] = get('Model') or get('PartNumber') or get('MPN')
+        record['upc'] = get('UPC')
+        record['salesrank'] = get('SalesRank/Rank', int) or get('SalesRank', int)
+        record['offers'] = get('OfferSummary/TotalNew', int)
+        record['merchant'] = get('Offer/Merchant/Name')
+        record['prime'] = bool(get('IsEligibleForPrime', int, default=0))
+        record['product_category_id'] = get('ProductCategoryId')
+        record['product_group'] = get('ProductGroup')
+        record['url'] = "http://www.amazon.com/dp/%s" % record['asin']
+        record['has_offers'] = has_offers
+
+        price = get('OfferListing/Price/Amount', int)
+        record['price'] = price / 100 if price else price
+
+        # Check if quantity is specified in the product data, then check the title and 'features' section
+        quantity = max(get('NumberOfItems', int, default=1), get('PackageQuantity', int, default=1))
+        features.append(record['title'])
+        record['quantity'] = max(quantity, read_quantity(' '.join(f for f in features if f)) or 1)
+
+        return record
 
     def update(self, amz_listing):
         """Update the given Amazon listing with the information in this parser."""
@@ -154,85 +263,64 @@ class ProductParser(XmlResponseElement):
         amz_listing.hasprime = self.prime
 
         # Only update price if price information is provided
-        if self._tag.xpath('.//Offers'):
+        if self.record['has_offers']:
             amz_listing.price = self.price
 
     @property
     def asin(self):
-        return self.xpath_get('.//ASIN')
+        return self.record['asin']
 
     @property
     def brand(self):
-        return self.xpath_get('.//Brand') \
-            or self.xpath_get('.//Manufacturer') \
-            or self.xpath_get('.//Label') \
-            or self.xpath_get('.//Publisher') \
-            or self.xpath_get('.//Studio')
+        return self.record['brand']
 
     @property
     def model(self):
-        return self.xpath_get('.//Model') \
-            or self.xpath_get('.//PartNumber') \
-            or self.xpath_get('.//MPN')
+        return self.record['model']
 
     @property
     def title(self):
-        return self.xpath_get('.//Title')
+        return self.record['title']
 
     @property
     def salesrank(self):
-        return self.xpath_get('.//SalesRank/Rank', dtype=int) \
-            or self.xpath_get('.//SalesRank', dtype=int)
+        return self.record['salesrank']
 
     @property
     def price(self):
-        price = self.xpath_get('.//OfferListing/Price/Amount', dtype=int)
-        if price:
-            price /= 100
-
-        return price
+        return self.record['price']
 
     @property
     def upc(self):
-        return self.xpath_get('.//UPC')
+        return self.record['upc']
 
     @property
     def quantity(self):
-        quantities = []
-
-        # Check it quantity is specified in the product data
-        quantities.append(max(self.xpath_get('.//NumberOfItems', dtype=int, default=1),
-                              self.xpath_get('.//PackageQuantity', dtype=int, default=1)))
-
-        # Check the title and 'features' section
-        features = [tag.text for tag in self._tag.iterdescendants('Feature')]
-        features.append(self.title)
-
-        return max(*quantities, read_quantity(' '.join(features)) or 1)
+        return self.record['quantity']
 
     @property
     def offers(self):
-        return self.xpath_get('.//OfferSummary/TotalNew', dtype=int)
+        return self.record['offers']
 
     @property
     def merchant(self):
-        return self.xpath_get('.//Offer/Merchant/Name')
+        return self.record['merchant']
 
     @property
     def prime(self):
-        return bool(self.xpath_get('.//IsEligibleForPrime', dtype=int, default=0))
+        return self.record['prime']
 
     @property
     def url(self):
-        return "http://www.amazon.com/dp/%s" % self.asin
+        return self.record['url']
 
     @property
     def product_category_id(self):
-        return self.xpath_get('.//ProductCategoryId')
+        return self.record['product_category_id']
 
     @property
     def product_group(self):
-        return self.xpath_get('.//ProductGroup')
+        return self.record['product_group']
 
 
 class ListMatchingProductsParser(AmzResponseParser):
@@ -241,38 +329,23 @@ class ListMatchingProductsParser(AmzResponseParser):
     @property
     def products(self):
         """Iterate through the 'Product' response tags."""
-        for tag in self._tag.iterdescendants('Product'):
+        for tag in self._tag.iterdescendants('{*}Product'):
             yield ProductParser(tag)
 
 
 class MWSResponseParser:
-    """Base class for the response parsers. Provides methods for parsing XML."""
-
-    # Regexes for removing namespaces from the XML - makes it easier to parse
-    re_ns_decl = re.compile(r' xmlns(:\w*)?="[^"]*"', re.IGNORECASE)
-    re_ns_open = re.compile(r'<\w+:')
-    re_ns_close = re.compile(r'/\w+:')
+    """Base class for the response parsers. Provides methods for parsing XML, ignoring namespaces."""
 
     def __init__(self, xml):
-        try:
-            self.tree = etree.fromstring(self._remove_namespace(xml))
-        except Exception as e:
-            raise ParseError(repr(e))
-
-    def _remove_namespace(self, xml):
-        """Remove all traces of namespaces from an XML string."""
-        response = self.re_ns_decl.sub('', xml)          # Remove namespace declarations
-        response = self.re_ns_open.sub('<', response)    # Remove namespaces in opening tags
-        response = self.re_ns_close.sub('/', response)   # Remove namespaces in closing tags
-        return response
+        self.tree = parse_xml(xml)
 
     def xpath_get(self, path, root=None, dtype=str, default=None):
-        """Use XPath to get values under a root node, including type casting and a default value."""
+        """Get the first value with the given path under a root node, including type casting and a default value."""
         root = root if root is not None else self.tree
-        items = root.xpath(path)
+        item = root.find(ns_path(path))
         try:
-            return dtype(items[0].text)
-        except (TypeError, IndexError):
+            return dtype(item.text)
+        except (TypeError, AttributeError):
             return default
 
 
@@ -332,11 +405,11 @@ class GetCompetitivePricingForASINParser(MWSResponseParser):
 
     def get_product_info(self):
 
-        for tag in self.tree.iterdescendants('Product'):
+        for tag in self.tree.iterdescendants('{*}Product'):
             product = {}
             product['asin'] = self.xpath_get('.//ASIN', tag)
 
-            for comp_price in tag.iterdescendants('CompetitivePrice'):
+            for comp_price in tag.iterdescendants('{*}CompetitivePrice'):
                 if comp_price.attrib['condition'] == 'New':
                     product['landed price'] = self.xpath_get('.//LandedPrice/Amount', tag, float)
                     product['list price'] = self.xpath_get('.//ListingPrice/Amount', tag, float)
@@ -350,7 +423,7 @@ class GetCompetitivePricingForASINParser(MWSResponseParser):
             product['salesrank'] = self.xpath_get('.//SalesRank/Rank', tag, int)
 
             product['newlistings'] = 0
-            for count in tag.iterdescendants('OfferListingCount'):
+            for count in tag.iterdescendants('{*}OfferListingCount'):
                 if count.attrib['condition'] == 'New':
                     product['newlistings'] = int(count.text)
 
@@ -361,7 +434,7 @@ class GetLowestOfferListingsForASINParser(MWSResponseParser):
 
     def get_product_info(self):
 
-        for result_tag in self.tree.iterdescendants('GetLowestOfferListingsForASINResult'):
+        for result_tag in self.tree.iterdescendants('{*}GetLowestOfferListingsForASINResult'):
             result = {}
 
             if result_tag.attrib['status'] != 'Success':
@@ -389,10 +462,11 @@ class GetMyFeesEstimateParser(MWSResponseParser):
 
     def get_fees(self):
 
-        for tag in self.tree.iterdescendants('FeesEstimateResult'):
+        for tag in self.tree.iterdescendants('{*}FeesEstimateResult'):
             result = {}
             result['status'] = self.xpath_get('.//Status', tag)
             result['asin'] = self.xpath_get('.//IdValue', tag)
+            result['identifier'] = self.xpath_get('.//SellerInputIdentifier', tag)
             result['amount'] = self.xpath_get('.//TotalFeesEstimate/Amount', tag, float)
             result['errortype'] = self.xpath_get('.//Error/Type', tag)
             result['errorcode'] = self.xpath_get('.//Error/Code', tag)
@@ -405,12 +479,31 @@ class ItemLookupParser(AmzResponseParser):
 
     @property
     def product(self):
-        items = self._tag.xpath('//Item')
-        if items:
-            return ProductParser(items[0])
+        item = self._tag.find('.//{*}Item')
+        if item is not None:
+            return ProductParser(item)
         else:
             return None
 
+    @property
+    def products(self):
+        """Iterate through the 'Item' response tags."""
+        for tag in self._tag.iterdescendants('{*}Item'):
+            yield ProductParser(tag)
+
+    def get_error(self, asin=None):
+        """Return the (code, message) of the error concerning the given ASIN. If there is no such error, return the
+        first error in the response, or (None, None).
+        """
+        codes = self.xpath_get_all('.//Error/Code')
+        messages = self.xpath_get_all('.//Error/Message')
+
+        for code, message in zip(codes, messages):
+            if asin and asin in (message or ''):
+                return code, message
+
+        return (codes[0], messages[0]) if codes else (None, None)
+
 
 # class ItemLookupParser(MWSResponseParser):
 #
@@ -1,12 +1,14 @@
 import csv
+import itertools
 
-from PyQt5.QtCore import Qt, QCoreApplication
+from PyQt5.QtCore import Qt, QThread, pyqtSignal
 from PyQt5.QtGui import QIcon
 from PyQt5.QtWidgets import QWidget, QAction, QHeaderView, QDialog, QAbstractItemView, QDataWidgetMapper
 from PyQt5.QtWidgets import QVBoxLayout, QHBoxLayout, QTabWidget, QFrame, QMessageBox
 
 from database import *
 import dbhelpers
+import matching
 
 from prowlerwidgets import ProwlerTableWidget, ProductDetailsWidget
 from baseview import BaseSourceView
@@ -94,6 +96,8 @@ class VndProductLinksWidget(ProwlerTableWidget):
 class VndSourceViewWidget(ProwlerTableWidget):
     """Shows listings belonging to a vendor or vendor-product list."""
 
+    filterable = True
+
     def __init__(self, parent=None):
         super(VndSourceViewWidget, self).__init__(parent=parent)
 
@@ -124,11 +128,66 @@ class VndSourceViewWidget(ProwlerTableWidget):
         return query
 
 
+class ImportCSVThread(QThread):
+    """Imports a vendor's CSV file in the background, using its own database session. Rows are committed in chunks
+    of chunk_size, and progress is reported after each one.
+    """
+
+    progress = pyqtSignal(int)
+
+    def __init__(self, bind, file_name, vendor_id, start_row, end_row, list_id=None, chunk_size=1000, parent=None):
+        super(ImportCSVThread, self).__init__(parent=parent)
+        self.bind = bind
+        self.file_name = file_name
+        self.vendor_id = vendor_id
+        self.start_row = start_row
+        self.end_row = end_row
+        self.list_id = list_id
+        self.chunk_size = chunk_size
+
+        self.cancelled = False
+        self.rollback = False
+        self.error = None
+
+    def cancel(self, rollback=False):
+        """Stop after the current chunk. If rollback is True, also undo the chunks already committed."""
+        self.rollback = rollback
+        self.cancelled = True
+
+    def run(self):
+        session = session_factory(bind=self.bind)
+        journal = {}
+
+        try:
+            with open(self.file_name) as file:
+                reader = csv.DictReader(file)
+                rows = itertools.takewhile(lambda row: reader.line_num <= self.end_row,
+                                           itertools.dropwhile(lambda row: reader.line_num < self.start_row, reader))
+
+                for count in dbhelpers.import_vendor_listings(session, self.vendor_id, rows,
+                                                              list_id=self.list_id,
+                                                              chunk_size=self.chunk_size,
+                                                              journal=journal):
+                    self.progress.emit(count)
+                    if self.cancelled:
+                        break
+
+            if self.cancelled and self.rollback:
+                dbhelpers.revert_vendor_import(session, journal)
+
+        except Exception as e:
+            session.rollback()
+            self.error = str(e)
+        finally:
+            session.close()
+
+
 class VendorView(BaseSourceView):
     """View of a vendor-based source, with product details and linked listings widgets."""
     def __init__(self, parent=None):
         super(VendorView, self).__init__(parent=parent)
         self.shows_amazon = False
+        self.import_threads = []
 
         layout = QVBoxLayout(self)
         self.setLayout(layout)
@@ -187,11 +246,31 @@ class VendorView(BaseSourceView):
         self.action_import_csv = QAction(QIcon('icons/open.png'), 'Import from CSV...', self)
         self.action_import_csv.triggered.connect(self.on_import_csv)
 
-        self.add_toolbar_action(self.action_import_csv)
+        self.action_rescore_links = QAction(QIcon('icons/reload.png'), 'Rescore links', self)
+        self.action_rescore_links.triggered.connect(self.on_rescore_links)
+
+        self.add_toolbar_actions([self.action_import_csv, self.action_rescore_links])
 
         # Populate the sources list
         self.populate_source_box()
 
+    def on_rescore_links(self):
+        """Recalculate the confidence of all links to the listings in the current source."""
+        source = self.selected_source
+        vnd_ids = self.dbsession.query(Listing.id).filter(Listing.vendor_id != 0)
+
+        if isinstance(source, Vendor):
+            vnd_ids = vnd_ids.filter(Listing.vendor_id == source.id)
+        elif isinstance(source, List):
+            vnd_ids = vnd_ids.join(ListMembership).filter(ListMembership.list_id == source.id)
+
+        links = self.dbsession.query(LinkedProducts).filter(LinkedProducts.vnd_listing_id.in_(vnd_ids.subquery()))
+        count = matching.rescore_links(self.dbsession, links)
+        self.dbsession.commit()
+
+        self.product_links.reload()
+        QMessageBox.information(self, 'Rescore links', '%s links rescored.' % count)
+
     def on_import_csv(self):
         """Opens the 'Import CSV' dialog, imports the contents into the database."""
         # Show the dialog
@@ -206,51 +285,46 @@ class VendorView(BaseSourceView):
         end_row = dialog.endrow
 
         vendor = dbhelpers.get_or_create(self.dbsession, Vendor, name=vendor_name)
-        self.dbsession.flush()
-
         add_list = dbhelpers.get_or_create(self.dbsession, List, name=dialog.list_name) if dialog.list_name else None
+        self.dbsession.commit()
 
-        with open(file_name) as file:
-            dialog = ProgressDialog(minimum=start_row, maximum=end_row, parent=self)
-            dialog.setModal(True)
-            dialog.show()
+        list_id = add_list.id if add_list else None
 
-            reader = csv.DictReader(file)
+        # Run the import in the background
+        thread = ImportCSVThread(self.dbsession.get_bind(), file_name, vendor.id, start_row, end_row, list_id=list_id,
+                                 parent=self)
 
-            for row in reader:
-                if reader.line_num < start_row:
-                    continue
-                elif reader.line_num > end_row:
-                    break
+        dialog = ProgressDialog(minimum=0, maximum=end_row - start_row, parent=self)
+        dialog.show()
 
-                if dialog.result() == QDialog.Rejected:
-                    dialog.close()
-                    self.dbsession.rollback()
-                    return
+        def on_progress(count):
+            dialog.progress_value = count
+            dialog.status_text = 'Imported {} of {} rows...'.format(count, end_row - start_row)
 
-                dialog.progress_value = reader.line_num
-                dialog.status_text = 'Importing row {} of {}...'.format(reader.line_num - start_row, end_row - start_row)
-                QCoreApplication.processEvents()
+        def on_cancel():
+            if thread.isFinished():
+                return
 
-                sku = row.get('sku')
+            keep = QMessageBox.question(self, 'Cancel import', 'Keep the rows that have already been imported?')
+            thread.cancel(rollback=keep != QMessageBox.Yes)
+            dialog.status_text = 'Cancelling...'
 
-                product = dbhelpers.get_or_create(self.dbsession, VendorListing, vendor_id=vendor.id, sku=sku)
+        def on_finished():
+            # Closing a visible dialog rejects it, which would look like a cancel
+            dialog.rejected.disconnect(on_cancel)
+            dialog.close()
+            self.import_threads.remove(thread)
 
-                product.title = row.get('title')
-                product.brand = row.get('brand')
-                product.model = row.get('model')
-                product.upc = row.get('upc')
-                product.quantity = row.get('quantity')
-                product.price = row.get('price')
-                product.url = row.get('url')
-                product.updated = func.now()
+            if thread.error:
+                QMessageBox.critical(self, 'Error', 'Import failed: %s' % thread.error)
 
-                if add_list:
-                    dbhelpers.get_or_create(self.dbsession, ListMembership, list=add_list, listing=product)
+            self.populate_source_box()
+            self.sourceBox.setCurrentText(vendor_name)
+            self.sourceBox.activated.emit(0)
 
-        self.dbsession.commit()
+        thread.progress.connect(on_progress)
+        thread.finished.connect(on_finished)
+        dialog.rejected.connect(on_cancel)
 
-        dialog.close()
-        self.populate_source_box()
-        self.sourceBox.setCurrentText(vendor_name)
-        self.sourceBox.activated.emit(0)
+        self.import_threads.append(thread)
+        thread.start()
@@ -0,0 +1,67 @@
+import sys
+import signal
+import asyncio
+import logging
+import argparse
+import importlib
+from datetime import timedelta
+
+from database import *
+from opsengine import OperationsEngine
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='prowler-worker',
+                                     description='Process the operations queue without the GUI.')
+    parser.add_argument('--database', default='sqlite:///prowler.db', help='SQLAlchemy URL of the database to use.')
+    parser.add_argument('--worker-id', help='Name used to claim operations. Defaults to the host name and pid.')
+    parser.add_argument('--mws-keys', default='mwskeys', help='Module holding the MWS credentials for this worker.')
+    parser.add_argument('--pa-keys', default='pakeys', help='Module holding the Product Advertising credentials.')
+    parser.add_argument('--retention', type=float, default=24,
+                        help='Hours to keep finished operations before archiving them. Negative to never archive.')
+    parser.add_argument('--no-compact', action='store_true',
+                        help="Don't move old product history into compact storage. Only one worker needs to.")
+    parser.add_argument('--log-level', default='INFO', help='Logging level: DEBUG, INFO, WARNING, or ERROR.')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stdout,
+                        level=args.log_level.upper(),
+                        format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    # Set up the database connection
+    dbengine = create_engine(args.database)
+    Session.configure(bind=dbengine)
+    Base.metadata.create_all(dbengine)
+
+    dbsession = Session()
+    dbsession.merge(Vendor(id=0, name='Amazon', url='www.amazon.com'))
+    dbsession.commit()
+
+    # The engine schedules its operations on the current event loop
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    stop_requested = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop_requested.set)
+
+    # Each worker can use its own seller account; claims keep them from running the same operation twice
+    engine = OperationsEngine(mws_keys=importlib.import_module(args.mws_keys),
+                              pa_keys=importlib.import_module(args.pa_keys),
+                              worker_id=args.worker_id,
+                              retention=timedelta(hours=args.retention) if args.retention >= 0 else None,
+                              compact=not args.no_compact)
+    engine.start()
+
+    try:
+        loop.run_until_complete(stop_requested.wait())
+        logging.info('Shutting down, waiting for operations in progress to finish...')
+        loop.run_until_complete(engine.shutdown())
+    finally:
+        loop.close()
+
+    logging.info('Stopped.')
+
+
+if __name__ == '__main__':
+    main()